@@ -5,4 +5,5 @@
 from .err import *
 from .album_dir import *
 from .archiver import *
+from .iso import *
 from .util import *
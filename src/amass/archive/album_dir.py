@@ -111,6 +111,12 @@ class DirLayout(object):
     def getRipLogDir(self):
         return os.path.join(self.getMetadataDir(), 'rip_logs')
 
+    def getCheckpointDir(self):
+        return os.path.join(self.getMetadataDir(), 'checkpoints')
+
+    def getDisagreementDir(self):
+        return os.path.join(self.getMetadataDir(), 'disagreements')
+
     def getMetadataInfoPath(self):
         return os.path.join(self.getMetadataDir(), 'info')
 
@@ -132,6 +138,10 @@ class DirLayout(object):
     def getDataTrackDir(self):
         return os.path.join(self.path, 'data')
 
+    def getDataTrackPath(self, track_number):
+        return os.path.join(self.getDataTrackDir(),
+                            'track%02d.bin' % (track_number,))
+
     def getWavDir(self):
         return os.path.join(self.path, 'wav')
 
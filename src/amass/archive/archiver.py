@@ -3,6 +3,7 @@
 # Copyright (c) 2009-2010, Adam Simpkins
 #
 import os
+import StringIO
 import subprocess
 import sys
 import traceback
@@ -10,8 +11,13 @@ import traceback
 from .. import cdrom
 from .. import cddb
 from .. import file_util
+from .. import flac
+from .. import mb
 from .. import notify
+from .. import proc
 from .. import rip
+from .. import rip_merge
+from .. import scsi_sg
 from .. import simplelog
 
 from . import album_dir
@@ -19,8 +25,46 @@ from . import err
 
 
 class Archiver(object):
-    def __init__(self, device):
+    def __init__(self, device, display=None):
         self.device_name = device
+        if display is None:
+            self.display = rip.CliDisplay()
+        else:
+            self.display = display
+
+        # If encodeFlac is True, audio tracks are encoded to flac as they
+        # are ripped.  By default the ripped audio is piped straight into the
+        # encoder, and no .wav files are written.  If keepWav is True, each
+        # track is ripped to a .wav file and then encoded.
+        # (keepWav is ignored if encodeFlac is False.  Streaming straight into
+        # the encoder is only supported in the rip.RIP_PARANOIA rip mode.)
+        self.encodeFlac = False
+        self.keepWav = False
+
+        # If encodePool is set to a workers.WorkerPool, flac encoding uses
+        # the pool: each track is ripped to a .wav file and then encoded in
+        # the background, while the drive moves on to the next track.
+        # The .wav files are removed after encoding unless keepWav is True.
+        self.encodePool = None
+        self.encodeJobs = []
+
+        # How to read audio tracks.  One of the rip.RIP_* modes.
+        self.ripMode = rip.RIP_PARANOIA
+
+        # The drives.DriveProfile for this drive, if it has been probed.
+        # This supplies the read offset, and lets us skip work the drive
+        # doesn't need.
+        self.driveProfile = None
+
+        # If speedController is set to a rip.SpeedController, the native rip
+        # modes use it to adjust the drive speed based on how many errors
+        # they see.  (cdparanoia always rips at the drive's default speed.)
+        self.speedController = None
+
+        # If scsiStats is True, statistics about the SCSI commands sent while
+        # reading each track are saved in the rip log directory, as
+        # trackNN.scsi.json.  See scsi_stats for details.
+        self.scsiStats = False
 
     def archive(self):
         # Read the TOC and CD-TEXT data
@@ -43,7 +87,8 @@ class Archiver(object):
         # Create the album directory
         self.outputDir = album_dir.AlbumDir('%08x' % (cddb_id,), self.toc)
         self.layout = self.outputDir.layout
-        print 'Archiving CD data to %s%s' % (self.layout.path, os.sep)
+        self.display.message('Archiving CD data to %s%s' %
+                             (self.layout.path, os.sep))
 
         # Store the full toc data
         toc_file = file_util.open_new(self.layout.getTocPath())
@@ -67,19 +112,44 @@ class Archiver(object):
         # as pause sectors.  Storing the indices is probably sufficient for
         # now, since usually only index 0 is pause.
 
-        # Store extra track information via icedax
+        # Store extra track information from the Q sub-channel
         # (This includes things like the locations of the indices and
         # pregap within each track, the ISRC numbers, and the MCN number.)
-        print 'Reading track metadata (this may take some time)...'
+        self.display.message('Reading track metadata...')
         icedax_dir = self.layout.getIcedaxDir()
         os.makedirs(icedax_dir)
-        cdrom.icedax.write_info_files(self.device_name, icedax_dir)
+        self.writeTrackInfo(icedax_dir, cddb_id)
 
         # Store the track data
         self.archiveTracks()
 
         return self.outputDir
 
+    def writeTrackInfo(self, dir, cddb_id):
+        """
+        Write audio_XX.inf files describing each audio track.
+
+        The files use the same format as icedax, but the information is read
+        directly from the Q sub-channel, which is much faster than running
+        icedax.  If the drive can't return Q sub-channel data, fall back to
+        running icedax.
+        """
+        try:
+            with cdrom.binary.Device(self.device_name) as device:
+                (mcn, info_list) = cdrom.binary.read_subchannel_info(device,
+                                                                     self.toc)
+        except scsi_sg.CheckConditionError, ex:
+            notify.warn('unable to read Q sub-channel data; '
+                        'falling back to icedax: %s' % (ex,))
+            cdrom.icedax.write_info_files(self.device_name, dir)
+            return
+
+        cdindex_id = mb.get_mb_id(self.toc)
+        for info in info_list:
+            name = 'audio_%02d.inf' % (info.track.number,)
+            cdrom.icedax.write_info_file(os.path.join(dir, name), info, mcn,
+                                         cddb_id, cdindex_id)
+
     def resume(self):
         """
         resume(path)
@@ -94,6 +164,14 @@ class Archiver(object):
         partially-ripped files being deleted before resuming.  (The archiving
         code attempts to remove any partially-ripped files if an error does
         occur, so this usually should do the right thing.)
+
+        The exception is tracks ripped in burst or C2 mode, which save
+        checkpoints as they go.  A partially-ripped track with a checkpoint
+        is kept, and ripping continues from the last checkpoint.
+
+        Tracks that have a disagreement index from merge_rips.py (saved as
+        metadata/disagreements/trackNN.idx) have their contested sectors
+        re-read from the disc and merged again.
         """
         # Read the TOC so we can compute the CDDB ID
         with cdrom.binary.Device(self.device_name) as device:
@@ -108,66 +186,359 @@ class Archiver(object):
 
         # Resume archiving the track data
         self.archiveTracks(skip_existing=True)
+        self.rereadContestedTracks()
 
         return self.outputDir
 
-    def archiveTracks(self, skip_existing=False):
-        # If this CD has hidden audio data before the first track,
-        # rip it as track 0.
-        if self.toc.hasAudioTrack0():
-            self.ripAudioTrack0(skip_existing)
-
+    def rereadContestedTracks(self):
         for track in self.toc.tracks:
             if track.isDataTrack():
-                self.archiveDataTrack(track, skip_existing)
-            else:
-                self.ripAudioTrack(track, skip_existing)
+                continue
+            index = rip_merge.DisagreementIndex(self._getIndexPath(track))
+            if index.load():
+                self.rereadContestedSectors(track, index)
+
+    def rereadContestedSectors(self, track, index):
+        wav_path = self._getWavPath(track)
+        if not os.path.exists(wav_path):
+            notify.warn('Not re-reading contested sectors for track %d: '
+                        '%s does not exist' % (track.number, wav_path))
+            return
+
+        self.display.message('Re-reading %d contested samples in track %d' %
+                             (index.getNumSamples(), track.number))
+        log = self._openTrackLog(track)
+        output = self.display.newTrackOutput()
+        monitor = rip.Monitor(output, log)
+        reader = rip.ContestedSectorReader(self.device_name,
+                                           track.address.lba,
+                                           track.endAddress.lba, wav_path,
+                                           monitor, index)
+        reader.readOffset = self._getReadOffset()
+        reader.leadOutSector = track.session.leadout.lba
+        self._configureCacheDefeat(reader)
+        self._startScsiStats()
+        try:
+            reader.run()
+        finally:
+            self._saveScsiStats(track, log)
+        log.info('%d samples still contested', index.getNumSamples())
+
+        self._checkRipErrors(track, monitor)
+
+    def archiveTracks(self, skip_existing=False):
+        try:
+            # If this CD has hidden audio data before the first track,
+            # rip it as track 0.
+            if self.toc.hasAudioTrack0():
+                self.ripAudioTrack0(skip_existing)
+
+            for track in self.toc.tracks:
+                if track.isDataTrack():
+                    self.archiveDataTrack(track, skip_existing)
+                else:
+                    self.ripAudioTrack(track, skip_existing)
+        except:
+            # Save the original exception info
+            (ex_type, ex_value, ex_traceback) = sys.exc_info()
+
+            # Let any tracks that were already ripped finish encoding,
+            # so we don't leave the encoders running behind our back.
+            # The ripping error takes precedence over any encoding errors.
+            try:
+                self.waitForEncodeJobs()
+            except err.ArchiveError, ex:
+                notify.warn(str(ex))
+
+            raise ex_type, ex_value, ex_traceback
+
+        self.waitForEncodeJobs()
 
     def archiveDataTrack(self, track, skip_existing=False):
-        output_name = 'track%02d.bin' % (track.number,)
-        output_path = os.path.join(self.layout.getDataTrackDir(),
-                                   output_name)
+        output_path = self.layout.getDataTrackPath(track.number)
         if self._skip_existing(output_path, skip_existing):
             return
-        print 'Saving data track %d' % (track.number,)
+        self.display.message('Saving data track %d' % (track.number,))
         file_util.prepare_new(output_path)
-        cmd = ['readom', 'dev=' + self.device_name,
-               'sectors=%d-%d' % (track.address.lba, track.endAddress.lba),
-               'f=' + output_path]
+        log = self._openTrackLog(track)
+
+        output = self.display.newTrackOutput()
+        monitor = rip.Monitor(output, log)
+        reader = rip.DataTrackReader(self.device_name, track.address.lba,
+                                     track.endAddress.lba, output_path,
+                                     monitor)
+        self._startScsiStats()
         try:
-            subprocess.check_call(cmd)
+            reader.run()
         except:
+            log.error('Error reading data track: %s', traceback.format_exc())
+            self._saveScsiStats(track, log)
             self._output_failure(output_path)
+        self._saveScsiStats(track, log)
+
+        self._checkRipErrors(track, monitor)
 
     def ripAudioTrack(self, track, skip_existing=False):
+        # A checkpoint is left behind if an earlier rip of this track was
+        # interrupted.  The .wav file is incomplete in this case.
+        checkpoint = self._getCheckpoint(track)
+        partial = checkpoint.exists()
+        if partial and not self._usesCheckpoints():
+            # Only the native rippers can continue from a checkpoint.
+            # Start this track over.
+            self._discardPartialRip(track, checkpoint)
+            partial = False
+
+        if (self.encodeFlac and not self.keepWav and
+            self.encodePool is None and self.ripMode == rip.RIP_PARANOIA):
+            self.ripAudioTrackToFlac(track, skip_existing)
+            return
+
         # Prepare the output path
-        output_name = 'track%02d.wav' % (track.number,)
-        output_path = os.path.join(self.layout.getWavDir(), output_name)
-        if self._skip_existing(output_path, skip_existing):
+        output_path = self._getWavPath(track)
+        if partial:
+            if not skip_existing:
+                raise err.ArchiveError('%s already exists' % (output_path,))
+        else:
+            if self.encodeFlac:
+                # Check for the flac file too, so that we don't re-rip
+                # tracks that were already ripped and encoded on a previous
+                # run.
+                flac_path = self._getFlacPath(track)
+                if self._skip_existing(flac_path, skip_existing):
+                    return
+                if os.path.exists(output_path) and skip_existing:
+                    # The rip finished, but the encode did not
+                    self.encodeAudioTrack(track)
+                    return
+            if self._skip_existing(output_path, skip_existing):
+                return
+
+        self.display.message('Ripping audio track %d' % (track.number,))
+        file_util.prepare_new(output_path)
+        log = self._openTrackLog(track)
+
+        # Run the ripper
+        output = self.display.newTrackOutput()
+        monitor = rip.Monitor(output, log)
+        ripper = self._createRipper(track, output_path, monitor)
+        if self._usesCheckpoints():
+            ripper.checkpoint = checkpoint
+        self._startScsiStats()
+        try:
+            ripper.run()
+        except:
+            log.error('Error ripping audio track: %s', traceback.format_exc())
+            self._saveScsiStats(track, log)
+            if not checkpoint.exists():
+                self._output_failure(output_path)
+
+            # Keep the partial output, so that resume() can continue from the
+            # last checkpoint
+            (ex_type, ex_value, ex_traceback) = sys.exc_info()
+            self.display.message('Saved partial rip of track %d; use '
+                                 '--resume to continue' % (track.number,))
+            raise ex_type, ex_value, ex_traceback
+        self._saveScsiStats(track, log)
+
+        self._checkRipErrors(track, monitor)
+
+        if self.encodeFlac:
+            self.encodeAudioTrack(track)
+
+    def _usesCheckpoints(self):
+        return self.ripMode in (rip.RIP_BURST, rip.RIP_C2)
+
+    def _createRipper(self, track, output_path, monitor):
+        if self.ripMode == rip.RIP_BURST:
+            ripper = rip.NativeRipper(self.device_name, track.address.lba,
+                                      track.endAddress.lba, output_path,
+                                      monitor)
+        elif self.ripMode == rip.RIP_C2:
+            ripper = rip.C2Ripper(self.device_name, track.address.lba,
+                                  track.endAddress.lba, output_path, monitor)
+        elif self.ripMode == rip.RIP_TEST_AND_COPY:
+            ripper = rip.TestAndCopyRipper(self.device_name, track.number,
+                                           track.address.lba,
+                                           track.endAddress.lba, output_path,
+                                           monitor)
+            self._configureCacheDefeat(ripper)
+        else:
+            ripper = rip.Ripper(self.device_name, track.number, output_path,
+                                monitor)
+        ripper.readOffset = self._getReadOffset()
+        if self.ripMode != rip.RIP_PARANOIA:
+            ripper.leadOutSector = track.session.leadout.lba
+            ripper.speedController = self.speedController
+        return ripper
+
+    def _getReadOffset(self):
+        if self.driveProfile is None or self.driveProfile.readOffset is None:
+            return 0
+        return self.driveProfile.readOffset
+
+    def _configureCacheDefeat(self, ripper):
+        if self.driveProfile is None:
+            return
+        if not self.driveProfile.hasCache():
+            # Nothing to flush
+            ripper.cacheSectors = 0
             return
+        cache_sectors = self.driveProfile.getCacheSectors()
+        if cache_sectors is not None:
+            ripper.cacheSectors = cache_sectors
 
-        # Prepare the log path
-        log_name = 'track%02d.log' % (track.number,)
-        log_path = os.path.join(self.layout.getRipLogDir(), log_name)
+    def ripAudioTrackToFlac(self, track, skip_existing=False):
+        """
+        Rip an audio track, piping the audio data straight into the flac
+        encoder without writing a .wav file.
+        """
+        output_path = self._getFlacPath(track)
+        if self._skip_existing(output_path, skip_existing):
+            return
 
-        print 'Ripping audio track %d' % (track.number,)
+        self.display.message('Ripping audio track %d' % (track.number,))
         file_util.prepare_new(output_path)
-        file_util.prepare_new(log_path)
+        log = self._openTrackLog(track)
 
-        log = simplelog.FileLogger(log_path, simplelog.INFO)
-        log.info('Ripping audio track %d' % (track.number,))
+        # Write to a temporary path, so that a partially encoded file is
+        # never mistaken for a complete one when resuming.
+        tmp_path = flac.get_tmp_path(output_path)
+        encoder_cmd = flac.get_encode_cmd('-', tmp_path, quiet=True)
 
-        # Run the ripper
-        output = rip.CliOutput()
+        output = self.display.newTrackOutput()
         monitor = rip.Monitor(output, log)
-        ripper = rip.Ripper(self.device_name, track.number,
-                            output_path, monitor)
+        ripper = rip.EncodingRipper(self.device_name, track.number,
+                                    encoder_cmd, monitor)
+        ripper.readOffset = self._getReadOffset()
+        self._startScsiStats()
         try:
             ripper.run()
         except:
             log.error('Error ripping audio track: %s', traceback.format_exc())
-            self._output_failure(output_path)
+            if ripper.encoderOutput is not None:
+                log.error('Encoder output:\n%s', ripper.encoderOutput.stderr)
+            self._saveScsiStats(track, log)
+            self._output_failure(tmp_path)
+        self._saveScsiStats(track, log)
+        os.rename(tmp_path, output_path)
+
+        self._checkRipErrors(track, monitor)
+
+    def encodeAudioTrack(self, track):
+        """
+        Encode a ripped .wav file to flac.
+
+        If an encodePool has been set, the encode job is queued on the pool,
+        and this method returns immediately.  Call waitForEncodeJobs() to wait
+        for the queued jobs to finish.
+        """
+        if self.encodePool is None:
+            self.display.message('Encoding audio track %d' %
+                                 (track.number,))
+            self._encodeTrack(track)
+        else:
+            job = self.encodePool.submit(self._encodeTrack, track)
+            self.encodeJobs.append((track, job))
+
+    def waitForEncodeJobs(self):
+        """
+        Wait for all queued encode jobs to finish.
+
+        Raises an ArchiveError describing the failures if any of them failed.
+        """
+        errors = []
+        for (track, job) in self.encodeJobs:
+            try:
+                job.wait()
+            except err.ArchiveError, ex:
+                errors.append(str(ex))
+            except Exception, ex:
+                # Don't let an unexpected error from one job stop us from
+                # waiting on the rest of them
+                errors.append('error encoding track %d: %s\n%s' %
+                              (track.number, ex, traceback.format_exc()))
+        self.encodeJobs = []
+
+        if errors:
+            raise err.ArchiveError('\n'.join(errors))
+
+    def _encodeTrack(self, track):
+        # Note that this may run on one of the encodePool worker threads.
+        # It must not print anything, since it would interfere with the
+        # progress display for the track currently being ripped.
+        wav_path = self._getWavPath(track)
+        flac_path = self._getFlacPath(track)
+
+        out = StringIO.StringIO()
+        try:
+            file_util.prepare_new(flac_path)
+            flac.encode_file(wav_path, flac_path, out=out)
+            if not self.keepWav:
+                os.unlink(wav_path)
+        except (proc.CmdError, EnvironmentError), ex:
+            raise err.ArchiveError('error encoding track %d: %s\n%s' %
+                                   (track.number, ex, out.getvalue()))
+
+    def _getCheckpoint(self, track):
+        name = 'track%02d.checkpoint' % (track.number,)
+        path = os.path.join(self.layout.getCheckpointDir(), name)
+        return rip.RipCheckpoint(path, track.address.lba,
+                                 track.endAddress.lba, self._getReadOffset())
+
+    def _getIndexPath(self, track):
+        name = 'track%02d.idx' % (track.number,)
+        return os.path.join(self.layout.getDisagreementDir(), name)
+
+    def _discardPartialRip(self, track, checkpoint):
+        wav_path = self._getWavPath(track)
+        self.display.message('Discarding partial rip of track %d' %
+                             (track.number,))
+        if os.path.exists(wav_path):
+            os.unlink(wav_path)
+        checkpoint.remove()
+
+    def _getWavPath(self, track):
+        output_name = 'track%02d.wav' % (track.number,)
+        return os.path.join(self.layout.getWavDir(), output_name)
+
+    def _getFlacPath(self, track):
+        output_name = 'track%02d.flac' % (track.number,)
+        return os.path.join(self.layout.getFlacDir(), output_name)
 
+    def _openTrackLog(self, track):
+        log_name = 'track%02d.log' % (track.number,)
+        log_path = os.path.join(self.layout.getRipLogDir(), log_name)
+        file_util.prepare_new(log_path)
+
+        log = simplelog.FileLogger(log_path, simplelog.INFO)
+        if track.isDataTrack():
+            log.info('Reading data track %d' % (track.number,))
+        else:
+            log.info('Ripping audio track %d' % (track.number,))
+        return log
+
+    def _startScsiStats(self):
+        if self.scsiStats:
+            scsi_sg.enable_stats()
+
+    def _saveScsiStats(self, track, log):
+        stats = scsi_sg.get_stats()
+        if stats is None:
+            return
+        scsi_sg.disable_stats()
+        if not stats.opcodes:
+            # The track was read by cdparanoia, rather than by our own code
+            return
+
+        name = 'track%02d.scsi.json' % (track.number,)
+        path = os.path.join(self.layout.getRipLogDir(), name)
+        try:
+            stats.dump(path)
+        except EnvironmentError, ex:
+            log.warning('Unable to save SCSI statistics to %s: %s', path, ex)
+
+    def _checkRipErrors(self, track, monitor):
         # Abort if there were errors
         # Note that we don't remove the output file in this case.
         # We finished ripping to the end of the track, there were just errors
@@ -181,13 +552,17 @@ class Archiver(object):
         output_path = os.path.join(self.layout.getWavDir(), 'track00.wav')
         if self._skip_existing(output_path, skip_existing):
             return
-        print 'Ripping hidden audio track 0'
+        self.display.message('Ripping hidden audio track 0')
 
         file_util.prepare_new(output_path)
         # cdparanoia will rip audio data before track 1 by specifying
         # the track number as 0.  It starts ripping just after the pre-gap
         # (MSF 00:02:00, LBA 0), and continues up to the first track.
-        cmd = ['cdparanoia', '-d', self.device_name, '--', '0', output_path]
+        cmd = ['cdparanoia', '-d', self.device_name]
+        read_offset = self._getReadOffset()
+        if read_offset:
+            cmd += ['-O', str(read_offset)]
+        cmd += ['--', '0', output_path]
         try:
             subprocess.check_call(cmd)
         except:
@@ -198,7 +573,7 @@ class Archiver(object):
             if skip_existing:
                 return True
             else:
-                raise err.ArchiveError('%s already exists' % (output_path,))
+                raise err.ArchiveError('%s already exists' % (path,))
         return False
 
     def _output_failure(self, path):
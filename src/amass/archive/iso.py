@@ -0,0 +1,200 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2011, Adam Simpkins
+#
+"""
+A read-only view of the ISO image for the data tracks of a multisession CD.
+
+This presents the same data that bin2iso writes out, without having to create
+the image file: each data track appears at its LBA offset, and the header
+sectors (the System Area and the Volume Descriptor) are taken from the start
+of the last session.  Data is read from the track files on demand, and areas
+not covered by any track read as zeros.
+"""
+import bisect
+import os
+
+from .. import cdrom
+from .. import file_util
+from . import err
+
+# The header is the first 17 sectors.
+# (The first 16 are the System Area, and next is the Volume Descriptor.)
+NUM_HEADER_SECTORS = 17
+HEADER_SIZE = NUM_HEADER_SECTORS * cdrom.BYTES_PER_DATA_SECTOR
+
+
+class IsoExtent(object):
+    """
+    A range of the image that is backed by part of a track file.
+    """
+    def __init__(self, start, end, fd, file_offset):
+        self.start = start
+        self.end = end
+        self.fd = fd
+        self.fileOffset = file_offset
+
+
+class IsoImage(object):
+    """
+    IsoImage is a seekable, read-only file-like object for the merged ISO
+    image of several data tracks.
+
+    tracks is a list of (path, lba) tuples.  The header sectors are taken
+    from the track at header_track_path, or from the last track in the list
+    if header_track_path is None.
+    """
+    def __init__(self, tracks, header_track_path=None):
+        if header_track_path is None:
+            header_track_path = tracks[-1][0]
+        header_track_path = os.path.normpath(header_track_path)
+
+        self.fds = []
+        self.extents = []
+        self.length = 0
+        self.position = 0
+        try:
+            self.__addTracks(tracks, header_track_path)
+        except:
+            self.close()
+            raise
+
+    def __addTracks(self, tracks, header_track_path):
+        header = None
+        track_extents = []
+        for (path, lba) in tracks:
+            fd = os.open(path, os.O_RDONLY)
+            self.fds.append(fd)
+            length = os.fstat(fd).st_size
+
+            start = lba * cdrom.BYTES_PER_DATA_SECTOR
+            track_extents.append((path, IsoExtent(start, start + length,
+                                                  fd, 0)))
+            if os.path.normpath(path) == header_track_path:
+                header = IsoExtent(0, min(HEADER_SIZE, length), fd, 0)
+        if header is None:
+            raise err.ArchiveError('header track %r is not in the list of '
+                                   'supplied tracks' % (header_track_path,))
+
+        # The header overrides any track data at the start of the image.
+        # (Normally the first track starts at LBA 0, and its own header is
+        # replaced by the one from the last session.)
+        self.extents.append(header)
+        track_extents.sort(key=lambda t: t[1].start)
+        prev_path = None
+        prev_end = 0
+        for (path, extent) in track_extents:
+            if extent.start < prev_end and prev_path is not None:
+                raise err.ArchiveError('tracks %r and %r overlap' %
+                                       (prev_path, path))
+            if extent.start < header.end:
+                extent.fileOffset = header.end - extent.start
+                extent.start = header.end
+            if extent.start < extent.end:
+                self.extents.append(extent)
+            prev_path = path
+            prev_end = max(prev_end, extent.end)
+
+        self.starts = [extent.start for extent in self.extents]
+        self.length = max(extent.end for extent in self.extents)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ex_type, ex_value, ex_traceback):
+        self.close()
+
+    @property
+    def closed(self):
+        return self.fds is None
+
+    def close(self):
+        if self.fds is None:
+            return
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = None
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.length
+        elif whence != os.SEEK_SET:
+            raise ValueError('invalid whence value %r' % (whence,))
+        if offset < 0:
+            raise IOError('cannot seek to negative offset %d' % (offset,))
+        self.position = offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if self.fds is None:
+            raise ValueError('I/O operation on closed file')
+
+        end = self.length
+        if size >= 0:
+            end = min(self.position + size, end)
+        data = self.pread(self.position, end - self.position)
+        self.position += len(data)
+        return data
+
+    def pread(self, offset, length):
+        """
+        Read data from the specified offset, without changing the current
+        position.
+        """
+        end = min(offset + length, self.length)
+        if offset >= end:
+            return ''
+
+        pieces = []
+        pos = offset
+        idx = max(bisect.bisect_right(self.starts, pos) - 1, 0)
+        while pos < end:
+            if idx >= len(self.extents):
+                pieces.append('\0' * (end - pos))
+                break
+
+            extent = self.extents[idx]
+            if pos < extent.start:
+                # A gap between tracks
+                gap_end = min(extent.start, end)
+                pieces.append('\0' * (gap_end - pos))
+                pos = gap_end
+                continue
+            if pos >= extent.end:
+                idx += 1
+                continue
+
+            read_end = min(extent.end, end)
+            data = file_util.pread(extent.fd, read_end - pos,
+                                   extent.fileOffset + (pos - extent.start))
+            if len(data) < read_end - pos:
+                # The track file was truncated after we opened it
+                data += '\0' * (read_end - pos - len(data))
+            pieces.append(data)
+            pos = read_end
+            idx += 1
+
+        return ''.join(pieces)
+
+
+def open_iso_image(dir):
+    """
+    Open the ISO image for the data tracks in an AlbumDir.
+
+    The header is taken from the first track of the last session, which is
+    where the operating system looks for it when mounting the disc.
+    """
+    toc = dir.album.toc
+    tracks = [(dir.layout.getDataTrackPath(track.number), track.address.lba)
+              for track in toc.tracks if track.isDataTrack()]
+    if not tracks:
+        raise err.ArchiveError('%r does not contain any data tracks' %
+                               (dir.layout.path,))
+
+    header_track_num = toc.sessions[-1].firstTrack
+    header_track_path = dir.layout.getDataTrackPath(header_track_num)
+    return IsoImage(tracks, header_track_path)
@@ -2,12 +2,28 @@
 #
 # Copyright (c) 2009, Adam Simpkins
 #
+import collections
 import ctypes
+import mmap
+import struct
+import threading
+
+_U16BE = struct.Struct('>H')
+_U16LE = struct.Struct('<H')
+_U32BE = struct.Struct('>I')
+_U32LE = struct.Struct('<I')
+_U64BE = struct.Struct('>Q')
+_U64LE = struct.Struct('<Q')
 
 
 class CBuffer(object):
     """
-    A wrapper around a ctypes unsigned byte array.
+    A byte buffer that can be passed to C functions.
+
+    The data is stored in a bytearray or an mmap object (data).  buf is a
+    ctypes unsigned byte array that shares the same memory, so it can be
+    passed to C functions such as the SG_IO ioctl() without copying.  view()
+    returns a memoryview of part of the buffer, also without copying.
     """
     def __init__(self, length):
         """
@@ -15,23 +31,21 @@ class CBuffer(object):
 
         Accepts a single argument.  If this is an integer, it is treated as the
         buffer length.  If it is a string, the buffer will be initialized from
-        the string.
+        the string.  If it is a bytearray or an mmap object, the CBuffer uses
+        its memory directly, rather than making a copy.  (An anonymous mmap
+        is page-aligned, which allocate_aligned() relies on.)
         """
-        value = None
-        if isinstance(length, str):
-            value = length
-            length = len(value)
-
-        buftype = ctypes.c_ubyte * length
-        self.buf = buftype()
-        self.length = length
+        if isinstance(length, (bytearray, mmap.mmap)):
+            self.data = length
+        else:
+            self.data = bytearray(length)
+        self.length = len(self.data)
 
-        if value is not None:
-            for n in range(self.length):
-                self.buf[n] = ord(value[n])
+        buftype = ctypes.c_ubyte * self.length
+        self.buf = buftype.from_buffer(self.data)
 
     def __len__(self):
-        return len(self.buf)
+        return self.length
 
     def __getitem__(self, idx):
         """
@@ -49,13 +63,26 @@ class CBuffer(object):
         """
         if isinstance(value, str):
             value = ord(value)
+        if value < 0 or value > 0xff:
+            raise ValueError('byte must be in range(0, 256)')
         self.buf[idx] = value
 
     def __getslice__(self, start, end):
         """
-        Get a slice of the C buffer, as a python buffer.
+        Get a slice of the C buffer, as a python string.
+        """
+        return str(self.data[start:end])
+
+    def view(self, start=0, end=None):
+        """
+        Get a slice of the buffer as a memoryview, without copying it.
+
+        Note that the view shares memory with the buffer, so it will change
+        if the buffer is modified (e.g., by reading into it again).
         """
-        return ''.join([chr(x) for x in self.buf[start:end]])
+        if end is None:
+            end = self.length
+        return memoryview(self.buf)[start:end]
 
     def getByteSlice(self, start, end):
         """
@@ -67,60 +94,155 @@ class CBuffer(object):
         # We currently don't allow resizing via a slice set.
         # We could support it in the future if  we think the convenience
         # outweighs the downside of making it easier to accidentally do
-        # expensive operations.
+        # expensive operations.  (The memory can't be resized anyway,
+        # since buf refers to it.)
         if start >= self.length:
             raise ValueError('CBuffer does not allow resizing via slicing')
         if end > self.length:
             end = self.length
         if end - start != len(value):
-            print 'start: %r' % (start,)
-            print 'end: %r' % (end,)
-            raise ValueError('CBuffer does not allow resizing via slicing')
-
-        if isinstance(value, str):
-            for n in xrange(end - start):
-                self.buf[start + n] = ord(value[n])
-        else:
-            for n in xrange(end - start):
-                self.buf[start + n] = value[n]
+            raise ValueError('CBuffer does not allow resizing via slicing: '
+                             'cannot assign %d bytes to [%d:%d]' %
+                             (len(value), start, end))
+
+        if not isinstance(value, (str, bytearray)):
+            value = bytearray(value)
+        memoryview(self.buf)[start:end] = value
+
+    def __unpack(self, fmt, offset):
+        if offset < 0:
+            offset += self.length
+        if offset < 0 or offset + fmt.size > self.length:
+            raise IndexError('offset %d out of range for a %d byte value '
+                             'in a %d byte buffer' %
+                             (offset, fmt.size, self.length))
+        return fmt.unpack_from(self.data, offset)[0]
 
     def getU8(self, idx):
         return self.buf[idx]
 
     def getU16BE(self, offset):
-        return (self.buf[offset] << 8) | (self.buf[offset + 1])
+        return self.__unpack(_U16BE, offset)
 
     def getU16LE(self, offset):
-        return (self.buf[offset + 1] << 8) | (self.buf[offset])
+        return self.__unpack(_U16LE, offset)
 
     def getU32BE(self, offset):
-        return ((self.buf[offset] << 24) |
-                (self.buf[offset + 1] << 16) |
-                (self.buf[offset + 2] << 8) |
-                (self.buf[offset + 3]))
+        return self.__unpack(_U32BE, offset)
 
     def getU32LE(self, offset):
-        return ((self.buf[offset + 3] << 24) |
-                (self.buf[offset + 2] << 16) |
-                (self.buf[offset + 1] << 8) |
-                (self.buf[offset]))
+        return self.__unpack(_U32LE, offset)
 
     def getU64BE(self, offset):
-        return ((self.buf[offset] << 56) |
-                (self.buf[offset + 1] << 48) |
-                (self.buf[offset + 2] << 40) |
-                (self.buf[offset + 3] << 32) |
-                (self.buf[offset + 4] << 24) |
-                (self.buf[offset + 5] << 16) |
-                (self.buf[offset + 6] << 8) |
-                (self.buf[offset + 7]))
+        return self.__unpack(_U64BE, offset)
 
     def getU64LE(self, offset):
-        return ((self.buf[offset + 7] << 56) |
-                (self.buf[offset + 6] << 48) |
-                (self.buf[offset + 5] << 40) |
-                (self.buf[offset + 4] << 32) |
-                (self.buf[offset + 3] << 24) |
-                (self.buf[offset + 2] << 16) |
-                (self.buf[offset + 1] << 8) |
-                (self.buf[offset]))
+        return self.__unpack(_U64LE, offset)
+
+
+def allocate_aligned(length):
+    """
+    Allocate a CBuffer whose memory starts on a page boundary.
+
+    The memory comes from an anonymous mmap rather than the python heap.
+    Page-aligned buffers let the sg driver transfer data directly into them,
+    instead of going through its own bounce buffer.
+    """
+    return CBuffer(mmap.mmap(-1, length))
+
+
+class BufferPool(object):
+    """
+    A pool of reusable, page-aligned CBuffers.
+
+    Commands that are issued over and over again, such as the READ CD
+    commands in a rip loop, can get their buffers from the pool rather than
+    allocating a new one each time.  Buffers are reused only for requests of
+    exactly the same length, since SG_IO uses the size of the ctypes array as
+    the transfer length.  In practice each caller always asks for the same
+    few sizes.  The free buffers are limited to maxFreeBytes in total, so
+    callers that use many different sizes can't make the pool grow without
+    bound: when the limit is exceeded, buffers of the least recently
+    returned sizes are discarded first.
+
+    Use get() and put(), or use buffer() in a with statement:
+
+        with pool.buffer(length) as buf:
+            sg.read_cd(device, lba, num_sectors, buf)
+
+    Note that the data in a buffer returned by get() is whatever was left
+    in it by its previous user.
+    """
+    def __init__(self, max_free=8, max_free_bytes=8 * 1024 * 1024):
+        # The maximum number of free buffers to keep for each length
+        self.maxFree = max_free
+        # The maximum total size of all free buffers
+        self.maxFreeBytes = max_free_bytes
+        # Maps each length to its list of free buffers, least recently
+        # returned length first
+        self.free = collections.OrderedDict()
+        self.freeBytes = 0
+        self.lock = threading.Lock()
+
+        self.numAllocated = 0
+        self.numReused = 0
+
+    def get(self, length):
+        with self.lock:
+            free_list = self.free.get(length)
+            if free_list:
+                self.numReused += 1
+                buf = free_list.pop()
+                if not free_list:
+                    del self.free[length]
+                self.freeBytes -= length
+                return buf
+            self.numAllocated += 1
+        return allocate_aligned(length)
+
+    def put(self, buf):
+        length = len(buf)
+        if length > self.maxFreeBytes:
+            return
+        with self.lock:
+            # Re-insert the list, so that it becomes the most recently used
+            free_list = self.free.pop(length, [])
+            if len(free_list) < self.maxFree:
+                free_list.append(buf)
+                self.freeBytes += length
+            if free_list:
+                self.free[length] = free_list
+
+            while self.freeBytes > self.maxFreeBytes:
+                (old_length, old_list) = next(self.free.iteritems())
+                old_list.pop()
+                if not old_list:
+                    del self.free[old_length]
+                self.freeBytes -= old_length
+
+    def buffer(self, length):
+        return _PooledBuffer(self, length)
+
+    def clear(self):
+        with self.lock:
+            self.free = collections.OrderedDict()
+            self.freeBytes = 0
+
+
+class _PooledBuffer(object):
+    def __init__(self, pool, length):
+        self.pool = pool
+        self.length = length
+        self.buf = None
+
+    def __enter__(self):
+        self.buf = self.pool.get(self.length)
+        return self.buf
+
+    def __exit__(self, ex_type, ex_value, ex_traceback):
+        self.pool.put(self.buf)
+        self.buf = None
+
+
+# The pool used for SG_IO commands
+default_pool = BufferPool()
@@ -51,6 +51,21 @@ read_simple_toc = impl.read_simple_toc
 read_session_info = impl.read_session_info
 read_full_toc = impl.read_full_toc
 read_cd_text = impl.read_cd_text
+read_cd = impl.read_cd
+read_cd_mapped = impl.read_cd_mapped
+read_data = impl.read_data
+read_data_queued = impl.read_data_queued
+read_cd_c2 = impl.read_cd_c2
+read_q_subchannel = impl.read_q_subchannel
+read_mcn = impl.read_mcn
+read_isrc = impl.read_isrc
+inquiry = impl.inquiry
+mode_sense = impl.mode_sense
+set_cd_speed = impl.set_cd_speed
+MODE_PAGE_CAPABILITIES = impl.MODE_PAGE_CAPABILITIES
+MAX_SPEED = impl.MAX_SPEED
+Q_SUBCHANNEL_SIZE = impl.Q_SUBCHANNEL_SIZE
+C2_ERROR_SIZE = impl.C2_ERROR_SIZE
 
 
 #
@@ -73,3 +88,8 @@ def combine_adr_ctrl(adr, ctrl):
     assert adr <= 0xf
     assert ctrl <= 0xf
     return (adr << 4) | ctrl
+
+
+# Generic code built on top of the implementation-specific functions above
+from .qsub import *
+from .caps import *
@@ -0,0 +1,61 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2011, Adam Simpkins
+#
+"""
+Read the drive's CD capabilities from the capabilities mode page (2Ah).
+"""
+
+__all__ = ['DriveCapabilities', 'read_capabilities']
+
+from ... import cbuf
+from . import impl
+
+
+class DriveCapabilities(object):
+    """
+    The audio-related capabilities reported by a drive.
+
+    maxReadSpeed is in kB/s (176 kB/s is 1x for audio), and cacheSize is
+    the size of the drive's buffer in kB.  Either may be None if the drive
+    did not report it.
+    """
+    def __init__(self):
+        self.cddaSupported = False
+        self.accurateStream = False
+        self.c2Pointers = False
+        self.maxReadSpeed = None
+        self.cacheSize = None
+
+
+def parse_capabilities(page):
+    """
+    Parse the contents of the capabilities mode page.
+    """
+    page = cbuf.CBuffer(page)
+    caps = DriveCapabilities()
+
+    # Byte 5 contains the CD-DA related capability bits
+    caps.cddaSupported = bool(page.getU8(5) & 0x01)
+    caps.accurateStream = bool(page.getU8(5) & 0x02)
+    caps.c2Pointers = bool(page.getU8(5) & 0x10)
+
+    # Bytes 8-9 contain the maximum read speed.  This field is obsolete in
+    # newer versions of the MMC spec, but most drives still fill it in.
+    if len(page) >= 10:
+        caps.maxReadSpeed = page.getU16BE(8) or None
+    # Bytes 12-13 contain the buffer size
+    if len(page) >= 14:
+        caps.cacheSize = page.getU16BE(12)
+
+    return caps
+
+
+def read_capabilities(device):
+    """
+    Read the drive's capabilities.
+
+    Returns a DriveCapabilities object.
+    """
+    page = impl.mode_sense(device, impl.MODE_PAGE_CAPABILITIES)
+    return parse_capabilities(page)
@@ -0,0 +1,210 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2011, Adam Simpkins
+#
+"""
+Read track indices, pre-gaps, ISRCs and the MCN from the Q sub-channel.
+
+This provides the same information that icedax extracts from the disc, but
+much more quickly: rather than scanning every sector, index boundaries are
+located with a binary search over the Q sub-channel positions.
+"""
+
+__all__ = ['QPosition', 'SubchannelTrackInfo', 'read_q_position',
+           'read_subchannel_info']
+
+from ... import cbuf
+from .. import constants
+from .._address import Address
+from . import impl
+
+# When a sector's Q sub-channel does not contain position information,
+# look at up to this many following sectors to find one that does.
+# Position data is required in at least 9 out of every 10 sectors.
+MAX_POSITION_SEARCH = 10
+
+
+def _bcd_to_int(value):
+    return ((value >> 4) * 10) + (value & 0xf)
+
+
+class QPosition(object):
+    """
+    The position information from a Q sub-channel frame.
+    """
+    def __init__(self, lba, track_number, index):
+        self.lba = lba
+        self.trackNumber = track_number
+        self.index = index
+
+    @property
+    def key(self):
+        # (track number, index) always increases moving through the disc.
+        # The pre-gap of track N + 1 (index 0) comes after every index in
+        # track N, and before index 1 of track N + 1.
+        return (self.trackNumber, self.index)
+
+    def __repr__(self):
+        return 'QPosition(%r, %r, %r)' % (self.lba, self.trackNumber,
+                                          self.index)
+
+
+def _parse_q_position(q):
+    """
+    Parse formatted Q sub-channel data.
+
+    Returns a QPosition, or None if this Q frame does not contain mode 1
+    (position) data.
+    """
+    # Byte 0 contains the control field in the upper 4 bits,
+    # and the ADR field in the lower 4 bits.
+    adr = q.getU8(0) & 0xf
+    if adr != constants.ADR_POSITION:
+        return None
+
+    track_number = _bcd_to_int(q.getU8(1))
+    index = _bcd_to_int(q.getU8(2))
+    address = Address(_bcd_to_int(q.getU8(7)), _bcd_to_int(q.getU8(8)),
+                      _bcd_to_int(q.getU8(9)))
+    return QPosition(address.lba, track_number, index)
+
+
+def read_q_position(device, lba, end=None):
+    """
+    Read the Q sub-channel position at the specified sector.
+
+    If the Q sub-channel at lba does not contain position information, the
+    following sectors are examined until one that does is found (stopping
+    before end, if specified).  Returns a QPosition, or None if no position
+    information was found.
+    """
+    frame_size = constants.BYTES_PER_FRAME + impl.Q_SUBCHANNEL_SIZE
+    buf = cbuf.CBuffer(frame_size)
+
+    if end is None:
+        end = lba + MAX_POSITION_SEARCH
+    else:
+        end = min(end, lba + MAX_POSITION_SEARCH)
+
+    while lba < end:
+        impl.read_q_subchannel(device, lba, 1, buf)
+        q = cbuf.CBuffer(buf[constants.BYTES_PER_FRAME:frame_size])
+        pos = _parse_q_position(q)
+        if pos is not None:
+            return pos
+        lba += 1
+
+    return None
+
+
+class SubchannelTrackInfo(object):
+    """
+    Information about a single track read from the Q sub-channel.
+
+    indices is a list of the start of each index (starting with index 1),
+    as a sector offset from the start of the track.  nextPreGap is the offset
+    from the start of this track to the pre-gap (index 0) of the next track,
+    or -1 if the next track has no pre-gap.
+    """
+    def __init__(self, track):
+        self.track = track
+        self.isrc = None
+        self.indices = [0]
+        self.nextPreGap = -1
+
+
+class _IndexSearch(object):
+    def __init__(self, device, track):
+        self.device = device
+        self.track = track
+        self.start = track.address.lba
+        self.end = track.endAddress.lba
+
+        self.info = SubchannelTrackInfo(track)
+
+    def run(self):
+        first = read_q_position(self.device, self.start, self.end)
+        last = self.readLastPosition()
+        if first is None or last is None:
+            # No usable position information.  Just report a single index.
+            return self.info
+
+        boundaries = []
+        self.findBoundaries(first, last, boundaries)
+        for pos in boundaries:
+            offset = pos.lba - self.start
+            if pos.trackNumber == self.track.number:
+                if pos.index > 1:
+                    self.info.indices.append(offset)
+            elif pos.index == 0 and self.info.nextPreGap < 0:
+                self.info.nextPreGap = offset
+
+        return self.info
+
+    def readLastPosition(self):
+        # Search backwards from the end of the track, in case the last few
+        # sectors don't contain position data.
+        lba = self.end - 1
+        while lba >= max(self.start, self.end - MAX_POSITION_SEARCH):
+            pos = read_q_position(self.device, lba, lba + 1)
+            if pos is not None:
+                return pos
+            lba -= 1
+        return None
+
+    def findBoundaries(self, low, high, boundaries):
+        """
+        Find all of the points between the positions low and high where the
+        (track, index) key changes, and append them to boundaries.
+        """
+        if low.key == high.key:
+            # The key is monotonic, so nothing changes in between
+            return
+        if high.lba - low.lba <= 1:
+            boundaries.append(high)
+            return
+
+        mid_lba = (low.lba + high.lba) / 2
+        mid = read_q_position(self.device, mid_lba, high.lba)
+        if mid is None or mid.lba <= low.lba or mid.lba >= high.lba:
+            # We couldn't get a usable position strictly between low and
+            # high.  This only happens when the range is very small, so just
+            # scan it one sector at a time.
+            self.scanBoundaries(low, high, boundaries)
+            return
+
+        self.findBoundaries(low, mid, boundaries)
+        self.findBoundaries(mid, high, boundaries)
+
+    def scanBoundaries(self, low, high, boundaries):
+        prev = low
+        for lba in range(low.lba + 1, high.lba):
+            pos = read_q_position(self.device, lba, lba + 1)
+            if pos is None:
+                continue
+            if pos.key != prev.key:
+                boundaries.append(pos)
+            prev = pos
+        if high.key != prev.key:
+            boundaries.append(high)
+
+
+def read_subchannel_info(device, toc):
+    """
+    Read the MCN, and the ISRC and index information for every audio track
+    on the disc.
+
+    Returns a tuple of (mcn, track_info_list).  mcn is None if the disc has no
+    MCN.  track_info_list contains a SubchannelTrackInfo for each audio track.
+    """
+    mcn = impl.read_mcn(device)
+
+    track_info_list = []
+    for track in toc.tracks:
+        if track.isDataTrack():
+            continue
+        info = _IndexSearch(device, track).run()
+        info.isrc = impl.read_isrc(device, track.number)
+        track_info_list.append(info)
+
+    return (mcn, track_info_list)
@@ -16,10 +16,50 @@ import time
 from ... import cbuf
 from ... import scsi_sg as sg
 from .. import _err
+from .. import constants
 
 # Defined by the Mt. Fuji specification,
 # and the SCSI MMC specifications.
+CMD_INQUIRY = 0x12
+CMD_READ_10 = 0x28
+CMD_READ_SUB_CHANNEL = 0x42
 CMD_READ_TOC_PMA_ATIP = 0x43
+CMD_MODE_SENSE_10 = 0x5a
+CMD_SET_CD_SPEED = 0xbb
+CMD_READ_CD = 0xbe
+
+# Mode page containing the CD/DVD capabilities and mechanical status
+MODE_PAGE_CAPABILITIES = 0x2a
+
+# Speed value for SET CD SPEED that selects the drive's maximum speed
+MAX_SPEED = 0xffff
+
+# Expected sector types for READ CD
+SECTOR_TYPE_ANY = 0
+SECTOR_TYPE_CDDA = 1
+
+# Main channel selection bits for READ CD
+READ_CD_USER_DATA = 0x10
+# Error field selection for READ CD: return the C2 error pointer bits
+READ_CD_C2_ERRORS = 0x02
+
+# Size of the C2 error pointer data returned by READ CD.
+# There is one bit for each byte of audio data.
+C2_ERROR_SIZE = 294
+
+# Sub-channel selection values for READ CD
+SUBCHANNEL_NONE = 0
+SUBCHANNEL_RAW = 1
+SUBCHANNEL_Q = 2
+SUBCHANNEL_RW = 4
+
+# Size of the formatted Q sub-channel data returned by READ CD
+Q_SUBCHANNEL_SIZE = 16
+
+# Sub-channel data formats for READ SUB-CHANNEL
+SUBCHANNEL_FORMAT_POSITION = 1
+SUBCHANNEL_FORMAT_MCN = 2
+SUBCHANNEL_FORMAT_ISRC = 3
 
 # Linux CD constants, defined in linux/cdrom.h
 CDROMEJECT = 0x5309
@@ -39,6 +79,9 @@ class Device(object):
     def __init__(self, name, timeout=DEFAULT_READY_TIMEOUT, wait_ready=True):
         self.name = name
         self.fd = -1 # so self.fd exists in __del__ if open() fails
+        # The data lengths returned by read_toc() for the current disc,
+        # keyed by (format, number, want_msf)
+        self.tocLengths = {}
 
         # Open with O_NONBLOCK.  Otherwise the open will fail if the drive
         # is not ready or doesn't have a disc.  Using O_NONBLOCK allows us to
@@ -79,6 +122,9 @@ class Device(object):
         return fcntl.ioctl(self.fd, CDROM_DRIVE_STATUS, slot_number)
 
     def wait_until_ready(self, timeout=DEFAULT_READY_TIMEOUT, close_tray=True):
+        # The disc may have been changed since we last checked
+        self.tocLengths = {}
+
         ret = self.get_drive_status()
         if ret == CDS_NO_INFO:
             # If the drive doesn't support querying the status,
@@ -113,11 +159,22 @@ class Device(object):
         raise _err.DriveNotReadyError(self)
 
     def eject(self):
+        self.tocLengths = {}
         return fcntl.ioctl(self.fd, CDROMEJECT)
 
     def close_tray(self):
+        self.tocLengths = {}
         return fcntl.ioctl(self.fd, CDROMCLOSETRAY)
 
+    def set_speed(self, read_speed=MAX_SPEED):
+        """
+        Set the drive's read speed, in kB/s.
+
+        The drive rounds the speed to one it supports.  Use MAX_SPEED to
+        let the drive read as fast as it can.
+        """
+        set_cd_speed(self, read_speed)
+
 
 def ReadTocPmaAtipCmd(format, number, output_length, want_msf=False):
     cmd = cbuf.CBuffer(12)
@@ -137,24 +194,305 @@ def ReadTocPmaAtipCmd(format, number, output_length, want_msf=False):
     return cmd.buf
 
 
+def ReadCdCmd(lba, num_sectors, sector_type=SECTOR_TYPE_CDDA,
+              flags=READ_CD_USER_DATA, subchannel=0):
+    cmd = cbuf.CBuffer(12)
+    cmd[0] = CMD_READ_CD
+    cmd[1] = (sector_type & 0x7) << 2
+    cmd[2] = (lba >> 24) & 0xff
+    cmd[3] = (lba >> 16) & 0xff
+    cmd[4] = (lba >> 8) & 0xff
+    cmd[5] = lba & 0xff
+    if num_sectors < 0 or num_sectors > 0xffffff:
+        raise ValueError('invalid number of sectors for READ CD: %s' %
+                         (num_sectors,))
+    cmd[6] = (num_sectors >> 16) & 0xff
+    cmd[7] = (num_sectors >> 8) & 0xff
+    cmd[8] = num_sectors & 0xff
+    cmd[9] = flags
+    cmd[10] = subchannel
+    return cmd.buf
+
+
+def read_cd(device, lba, num_sectors, output, sector_type=SECTOR_TYPE_CDDA,
+            flags=READ_CD_USER_DATA, subchannel=0, timeout=30000):
+    """
+    Read sectors from the disc with a READ CD command.
+
+    The data is read into output, which must be a cbuf.CBuffer large enough
+    to hold num_sectors sectors in the requested format.  (For plain audio
+    data, this is cdrom.BYTES_PER_FRAME bytes per sector.)
+    """
+    if isinstance(device, (str, unicode)):
+        device = Device(device)
+
+    cmd = ReadCdCmd(lba, num_sectors, sector_type=sector_type, flags=flags,
+                    subchannel=subchannel)
+    sg.sg_cmd(device.fd, sg.SG_DXFER_FROM_DEV, cmd=cmd, dxfer=output.buf,
+              timeout=timeout)
+
+
+def read_cd_mapped(reserved, lba, num_sectors,
+                   sector_type=SECTOR_TYPE_CDDA, flags=READ_CD_USER_DATA,
+                   subchannel=0, sector_size=constants.BYTES_PER_FRAME,
+                   timeout=30000):
+    """
+    Read sectors from the disc with a READ CD command, transferring the data
+    through the sg reserved buffer of reserved, a scsi_sg.ReservedBuffer.
+
+    sector_size is the number of bytes returned for each sector in the
+    requested format.  Returns a memoryview of the data in the reserved
+    buffer, which is only valid until the next command.
+    """
+    cmd = ReadCdCmd(lba, num_sectors, sector_type=sector_type, flags=flags,
+                    subchannel=subchannel)
+    length = reserved.sgCmd(sg.SG_DXFER_FROM_DEV, cmd=cmd,
+                            length=num_sectors * sector_size, timeout=timeout)
+    return reserved.view(0, length)
+
+
+def Read10Cmd(lba, num_sectors):
+    cmd = cbuf.CBuffer(10)
+    cmd[0] = CMD_READ_10
+    cmd[2] = (lba >> 24) & 0xff
+    cmd[3] = (lba >> 16) & 0xff
+    cmd[4] = (lba >> 8) & 0xff
+    cmd[5] = lba & 0xff
+    if num_sectors < 0 or num_sectors > 0xffff:
+        raise ValueError('invalid number of sectors for READ(10): %s' %
+                         (num_sectors,))
+    cmd[7] = (num_sectors >> 8) & 0xff
+    cmd[8] = num_sectors & 0xff
+    return cmd.buf
+
+
+def read_data(device, lba, num_sectors, output, timeout=30000):
+    """
+    Read user data from data sectors with a READ(10) command.
+
+    output must be a cbuf.CBuffer large enough to hold num_sectors sectors of
+    cdrom.BYTES_PER_DATA_SECTOR bytes each.
+    """
+    if isinstance(device, (str, unicode)):
+        device = Device(device)
+
+    cmd = Read10Cmd(lba, num_sectors)
+    sg.sg_cmd(device.fd, sg.SG_DXFER_FROM_DEV, cmd=cmd, dxfer=output.buf,
+              timeout=timeout)
+
+
+def read_data_queued(queue, lba, end, batch_sectors, timeout=30000):
+    """
+    Read the user data from sectors lba through end (exclusive) with READ(10)
+    commands, keeping several commands outstanding on queue, a
+    scsi_sg.CommandQueue.
+
+    This is a generator that yields an (lba, count, output, error) tuple for
+    each batch of sectors, in order.  output is a cbuf.CBuffer containing the
+    data; it is only valid until the next batch is requested.  error is None
+    if the batch was read successfully, or the exception from the command
+    otherwise.
+    """
+    def commands():
+        for batch_lba in xrange(lba, end, batch_sectors):
+            count = min(batch_sectors, end - batch_lba)
+            output = cbuf.default_pool.get(count *
+                                            constants.BYTES_PER_DATA_SECTOR)
+            yield (sg.SG_DXFER_FROM_DEV, Read10Cmd(batch_lba, count),
+                   output.buf, (batch_lba, count, output))
+
+    for command in queue.run(commands(), timeout=timeout):
+        (batch_lba, count, output) = command.context
+        yield (batch_lba, count, output, command.error)
+        cbuf.default_pool.put(output)
+
+
+def SetCdSpeedCmd(read_speed, write_speed=MAX_SPEED):
+    cmd = cbuf.CBuffer(12)
+    cmd[0] = CMD_SET_CD_SPEED
+    if read_speed < 0 or read_speed > MAX_SPEED:
+        raise ValueError('invalid read speed: %s' % (read_speed,))
+    cmd[2] = (read_speed >> 8) & 0xff
+    cmd[3] = read_speed & 0xff
+    cmd[4] = (write_speed >> 8) & 0xff
+    cmd[5] = write_speed & 0xff
+    return cmd.buf
+
+
+def set_cd_speed(device, read_speed=MAX_SPEED):
+    if isinstance(device, (str, unicode)):
+        device = Device(device)
+
+    cmd = SetCdSpeedCmd(read_speed)
+    sg.sg_cmd(device.fd, sg.SG_DXFER_NONE, cmd=cmd, dxfer=None)
+
+
+def read_q_subchannel(device, lba, num_sectors, output):
+    """
+    Read the formatted Q sub-channel data for the specified sectors.
+
+    output must be a cbuf.CBuffer large enough to hold
+    (cdrom.BYTES_PER_FRAME + Q_SUBCHANNEL_SIZE) bytes per sector.  The Q data
+    for each sector follows that sector's audio data.  (Many drives refuse to
+    return sub-channel data without the main channel data, so we always ask
+    for both.)
+    """
+    read_cd(device, lba, num_sectors, output, sector_type=SECTOR_TYPE_ANY,
+            flags=READ_CD_USER_DATA, subchannel=SUBCHANNEL_Q)
+
+
+def read_cd_c2(device, lba, num_sectors, output):
+    """
+    Read audio data along with the C2 error pointers for each sector.
+
+    output must be a cbuf.CBuffer large enough to hold
+    (cdrom.BYTES_PER_FRAME + C2_ERROR_SIZE) bytes per sector.  The C2 error
+    bits for each sector follow that sector's audio data.  A set bit
+    indicates that the corresponding byte of audio data could not be
+    corrected by the drive's error correction, and is probably wrong.
+    """
+    read_cd(device, lba, num_sectors, output, sector_type=SECTOR_TYPE_CDDA,
+            flags=READ_CD_USER_DATA | READ_CD_C2_ERRORS)
+
+
+def ReadSubChannelCmd(format, track_number, output_length):
+    cmd = cbuf.CBuffer(10)
+    cmd[0] = CMD_READ_SUB_CHANNEL
+    # Ask for the Q sub-channel data
+    cmd[2] = 0x40
+    cmd[3] = format
+    cmd[6] = track_number
+    if output_length < 0 or output_length > 0xffff:
+        raise ValueError('invalid output_length for READ SUB-CHANNEL: %s' %
+                         (output_length,))
+    cmd[7] = (output_length >> 8) & 0xff
+    cmd[8] = (output_length & 0xff)
+    return cmd.buf
+
+
+def read_sub_channel(device, format, track_number=0):
+    if isinstance(device, (str, unicode)):
+        device = Device(device)
+
+    output = cbuf.CBuffer(24)
+    cmd = ReadSubChannelCmd(format, track_number, len(output))
+    sg.sg_cmd(device.fd, sg.SG_DXFER_FROM_DEV, cmd=cmd, dxfer=output.buf)
+    return output[0:len(output)]
+
+
+def read_mcn(device):
+    """
+    Read the media catalog number from the disc.
+
+    Returns the MCN as a string, or None if the disc does not have an MCN.
+    """
+    buf = cbuf.CBuffer(read_sub_channel(device, SUBCHANNEL_FORMAT_MCN))
+    # The MCVal bit indicates if the MCN is valid
+    if not (buf.getU8(8) & 0x80):
+        return None
+    return buf[9:22]
+
+
+def read_isrc(device, track_number):
+    """
+    Read the ISRC code for the specified track.
+
+    Returns the 12-character ISRC as a string, or None if the track does not
+    have an ISRC.
+    """
+    buf = cbuf.CBuffer(read_sub_channel(device, SUBCHANNEL_FORMAT_ISRC,
+                                        track_number))
+    # The TCVal bit indicates if the ISRC is valid
+    if not (buf.getU8(8) & 0x80):
+        return None
+    return buf[9:21]
+
+
+def InquiryCmd(output_length):
+    cmd = cbuf.CBuffer(6)
+    cmd[0] = CMD_INQUIRY
+    if output_length < 0 or output_length > 0xff:
+        raise ValueError('invalid output length for INQUIRY: %s' %
+                         (output_length,))
+    cmd[4] = output_length
+    return cmd.buf
+
+
+def inquiry(device):
+    """
+    Identify the drive.
+
+    Returns a tuple of (vendor, model, revision).
+    """
+    if isinstance(device, (str, unicode)):
+        device = Device(device)
+
+    output = cbuf.CBuffer(36)
+    cmd = InquiryCmd(len(output))
+    sg.sg_cmd(device.fd, sg.SG_DXFER_FROM_DEV, cmd=cmd, dxfer=output.buf)
+    return (output[8:16].strip(), output[16:32].strip(),
+            output[32:36].strip())
+
+
+def ModeSense10Cmd(page, output_length):
+    cmd = cbuf.CBuffer(10)
+    cmd[0] = CMD_MODE_SENSE_10
+    # Set DBD, since we don't care about block descriptors
+    cmd[1] = 0x08
+    # Request the current values
+    cmd[2] = page & 0x3f
+    if output_length < 0 or output_length > 0xffff:
+        raise ValueError('invalid output length for MODE SENSE: %s' %
+                         (output_length,))
+    cmd[7] = (output_length >> 8) & 0xff
+    cmd[8] = output_length & 0xff
+    return cmd.buf
+
+
+def mode_sense(device, page, output_length=256):
+    """
+    Read a mode page.
+
+    Returns the page data as a string, without the mode parameter header.
+    """
+    if isinstance(device, (str, unicode)):
+        device = Device(device)
+
+    output = cbuf.CBuffer(output_length)
+    cmd = ModeSense10Cmd(page, len(output))
+    sg.sg_cmd(device.fd, sg.SG_DXFER_FROM_DEV, cmd=cmd, dxfer=output.buf)
+
+    # Skip over the 8-byte header, and any block descriptors
+    # (Some drives return block descriptors even though we set DBD.)
+    data_len = min(output.getU16BE(0) + 2, len(output))
+    block_desc_len = output.getU16BE(6)
+    return output[8 + block_desc_len:data_len]
+
+
 def read_toc(device, format, number, want_msf=False, output_len_hint=1024):
     if isinstance(device, (str, unicode)):
         device = Device(device)
 
-    output_len = output_len_hint
+    # Start with the length returned the last time this command was issued
+    # for the current disc, so normally the command only has to be run once.
+    key = (format, number, want_msf)
+    output_len = device.tocLengths.get(key, output_len_hint)
     for n in range(2):
-        output = cbuf.CBuffer(output_len)
-        cmd = ReadTocPmaAtipCmd(format=format, number=number,
-                                output_length=len(output), want_msf=want_msf)
-        sg.sg_cmd(device.fd, sg.SG_DXFER_FROM_DEV, cmd=cmd, dxfer=output.buf)
-
-        data_len = output.getU16BE(0)
-        if data_len + 2 > len(output):
-            # Re-run the command with a larger output length
-            output_len = data_len + 2
-            continue
-
-        return output[0:data_len + 2]
+        with cbuf.default_pool.buffer(output_len) as output:
+            cmd = ReadTocPmaAtipCmd(format=format, number=number,
+                                    output_length=len(output),
+                                    want_msf=want_msf)
+            sg.sg_cmd(device.fd, sg.SG_DXFER_FROM_DEV, cmd=cmd,
+                      dxfer=output.buf)
+
+            data_len = output.getU16BE(0)
+            if data_len + 2 > len(output):
+                # Re-run the command with a larger output length
+                output_len = data_len + 2
+                continue
+
+            device.tocLengths[key] = data_len + 2
+            return output[0:data_len + 2]
 
     # If we reach here, the data length was too small even on the second
     # time around the loop.  This shouldn't happen.
@@ -15,6 +15,18 @@ MSF_OFFSET = FRAMES_PER_SECOND * 2
 # (Divide by 2 to get number of stereo samples)
 SAMPLES_PER_FRAME = 1176
 
+# Number of bytes of audio data per frame
+BYTES_PER_FRAME = SAMPLES_PER_FRAME * 2
+
+# Number of bytes of user data in a mode 1 (or mode 2 form 1) data sector
+BYTES_PER_DATA_SECTOR = 2048
+
+# Number of bytes in one stereo sample (2 channels of 16 bits each)
+BYTES_PER_STEREO_SAMPLE = 4
+
+# Data rate of a 1x CD drive, in kB/s, as used by MMC speed fields
+KB_PER_SECOND_1X = 176
+
 # The leadout info is stored in the TOC as track number 0xAA
 TRACK_LEADOUT = 0xAA
 
@@ -8,6 +8,8 @@ import shutil
 import subprocess
 import tempfile
 
+from . import constants
+
 
 class TempDir(object):
     def __init__(self, suffix='', prefix='tmp', dir=None):
@@ -143,6 +145,72 @@ def write_info_files(device, dir):
         raise Exception('icedax returned %s:\n%s' % (err,))
 
 
+def format_isrc(isrc):
+    """
+    Format a 12-character ISRC the way icedax does (CC-OOO-YY-NNNNN).
+    """
+    return '%s-%s-%s-%s' % (isrc[0:2], isrc[2:5], isrc[5:7], isrc[7:12])
+
+
+def format_info_string(info, mcn, cddb_id, cdindex_id):
+    """
+    Format an audio_XX.inf file in the same format that icedax uses.
+
+    info is a cdrom.binary.SubchannelTrackInfo object, and mcn is the media
+    catalog number (or None).  Information that icedax extracts from CD-TEXT
+    is left empty, since we store the raw CD-TEXT data separately.
+    """
+    track = info.track
+    if info.isrc is None:
+        isrc = ''
+    else:
+        isrc = format_isrc(info.isrc)
+    if track.ctrl & constants.CTRL_COPY_ALLOWED:
+        copy_permitted = 'yes'
+    else:
+        copy_permitted = 'once (copyright protected)'
+    if track.ctrl & constants.CTRL_PREEMPHASIS:
+        preemphasis = 'yes'
+    else:
+        preemphasis = 'no'
+    if track.ctrl & constants.CTRL_4CHANNELS:
+        channels = 4
+    else:
+        channels = 2
+
+    lines = [
+        '#created by amass',
+        '#',
+        "CDINDEX_DISCID=\t'%s'" % (cdindex_id,),
+        'CDDB_DISCID=\t0x%08x' % (cddb_id,),
+        'MCN=\t\t%s' % (mcn or '',),
+        'ISRC=\t\t%-15s' % (isrc,),
+        '#',
+        "Albumperformer=\t''",
+        "Performer=\t''",
+        "Albumtitle=\t''",
+        "Tracktitle=\t''",
+        'Tracknumber=\t%d' % (track.number,),
+        'Trackstart=\t%d' % (track.address.lba,),
+        '# track length in sectors (1/75 seconds each), rest samples',
+        'Tracklength=\t%d, 0' % (track.endAddress.lba - track.address.lba,),
+        'Pre-emphasis=\t%s' % (preemphasis,),
+        'Channels=\t%d' % (channels,),
+        'Copy_permitted=\t%s' % (copy_permitted,),
+        'Endianess=\tlittle',
+        '# index list',
+        'Index=\t\t%s ' % (' '.join([str(i) for i in info.indices]),),
+        'Index0=\t\t%d ' % (info.nextPreGap,),
+    ]
+    return '\n'.join(lines) + '\n'
+
+
+def write_info_file(path, info, mcn, cddb_id, cdindex_id):
+    f = open(path, 'w')
+    f.write(format_info_string(info, mcn, cddb_id, cdindex_id))
+    f.close()
+
+
 def parse_info_dir(path):
     tracks = []
 
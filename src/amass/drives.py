@@ -0,0 +1,175 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2011, Adam Simpkins
+#
+"""
+A persistent database of drive profiles.
+
+A profile records what we know about a particular drive model: its read
+offset, and the capabilities it reported when it was probed.  Profiles are
+keyed by the vendor, model, and firmware revision reported by INQUIRY, since
+drives with different firmware can behave differently.
+"""
+import errno
+import json
+import os
+
+from . import cdrom
+from . import file_util
+
+DEFAULT_DB_PATH = os.path.join('~', '.amass', 'drives.json')
+
+
+def get_drive_key(vendor, model, revision):
+    return '%s|%s|%s' % (vendor, model, revision)
+
+
+class DriveProfile(object):
+    """
+    Information about a single drive model.
+
+    readOffset is the read offset correction, in stereo samples, or None if
+    it is not known.  cacheSize is in kB, and maxReadSpeed in kB/s.
+    """
+    FIELDS = ['vendor', 'model', 'revision', 'readOffset', 'c2Pointers',
+              'accurateStream', 'cacheSize', 'maxReadSpeed']
+
+    def __init__(self, vendor, model, revision):
+        self.vendor = vendor
+        self.model = model
+        self.revision = revision
+
+        self.readOffset = None
+        self.c2Pointers = False
+        self.accurateStream = False
+        self.cacheSize = None
+        self.maxReadSpeed = None
+
+    @property
+    def key(self):
+        return get_drive_key(self.vendor, self.model, self.revision)
+
+    def hasCache(self):
+        # Assume the drive has a cache unless it told us otherwise
+        return self.cacheSize != 0
+
+    def getCacheSectors(self):
+        """
+        Get the number of audio sectors that must be read to flush the
+        drive's cache, or None if the cache size is not known.
+        """
+        if self.cacheSize is None:
+            return None
+        cache_bytes = self.cacheSize * 1024
+        return ((cache_bytes + cdrom.BYTES_PER_FRAME - 1) /
+                cdrom.BYTES_PER_FRAME)
+
+    def toDict(self):
+        return dict((name, getattr(self, name)) for name in self.FIELDS)
+
+    @classmethod
+    def fromDict(cls, values):
+        profile = cls(values['vendor'], values['model'], values['revision'])
+        for name in cls.FIELDS:
+            if name in values:
+                setattr(profile, name, values[name])
+        return profile
+
+    def __str__(self):
+        lines = ['%s %s (firmware %s)' % (self.vendor, self.model,
+                                          self.revision)]
+        if self.readOffset is None:
+            lines.append('  Read offset:      unknown')
+        else:
+            lines.append('  Read offset:      %+d' % (self.readOffset,))
+        lines.append('  C2 pointers:      %s' %
+                     ('yes' if self.c2Pointers else 'no',))
+        lines.append('  Accurate stream:  %s' %
+                     ('yes' if self.accurateStream else 'no',))
+        if self.cacheSize is None:
+            lines.append('  Cache size:       unknown')
+        else:
+            lines.append('  Cache size:       %d kB' % (self.cacheSize,))
+        if self.maxReadSpeed is None:
+            lines.append('  Max read speed:   unknown')
+        else:
+            lines.append('  Max read speed:   %d kB/s (%dx)' %
+                         (self.maxReadSpeed,
+                          self.maxReadSpeed / cdrom.KB_PER_SECOND_1X))
+        return '\n'.join(lines)
+
+
+class ProfileStore(object):
+    """
+    ProfileStore loads and saves drive profiles in a JSON file.
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = DEFAULT_DB_PATH
+        self.path = os.path.expanduser(path)
+        self.profiles = {}
+        self.load()
+
+    def load(self):
+        try:
+            f = open(self.path, 'r')
+        except IOError, ex:
+            if ex.errno == errno.ENOENT:
+                return
+            raise
+
+        with f:
+            data = json.load(f)
+        for values in data['drives']:
+            profile = DriveProfile.fromDict(values)
+            self.profiles[profile.key] = profile
+
+    def save(self):
+        data = {'drives': [self.profiles[key].toDict()
+                           for key in sorted(self.profiles)]}
+
+        # Write to a temporary file and rename it into place, so we never
+        # leave a truncated database behind.
+        file_util.prepare_new(self.path)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.write('\n')
+        os.rename(tmp_path, self.path)
+
+    def get(self, vendor, model, revision):
+        return self.profiles.get(get_drive_key(vendor, model, revision))
+
+    def add(self, profile):
+        self.profiles[profile.key] = profile
+
+
+def probe_drive(device_name):
+    """
+    Probe the drive, and return a new DriveProfile describing it.
+
+    The read offset cannot be determined from the drive itself, and is left
+    unset.
+    """
+    with cdrom.binary.Device(device_name, wait_ready=False) as device:
+        (vendor, model, revision) = cdrom.binary.inquiry(device)
+        caps = cdrom.binary.read_capabilities(device)
+
+    profile = DriveProfile(vendor, model, revision)
+    profile.c2Pointers = caps.c2Pointers
+    profile.accurateStream = caps.accurateStream
+    profile.cacheSize = caps.cacheSize
+    profile.maxReadSpeed = caps.maxReadSpeed
+    return profile
+
+
+def find_profile(device_name, store=None):
+    """
+    Look up the profile for the drive, or return None if it has not been
+    probed yet.
+    """
+    if store is None:
+        store = ProfileStore()
+    with cdrom.binary.Device(device_name, wait_ready=False) as device:
+        (vendor, model, revision) = cdrom.binary.inquiry(device)
+    return store.get(vendor, model, revision)
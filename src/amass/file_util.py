@@ -2,6 +2,8 @@
 #
 # Copyright (c) 2010, Adam Simpkins
 #
+import ctypes
+import ctypes.util
 import errno
 import os
 
@@ -44,6 +46,217 @@ def prepare_new(path):
             raise
 
 
+# lseek() whence values for finding holes in sparse files (Linux 3.1+).
+# These aren't defined in the os module.
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+# Errors from copy_file_range() and sendfile() indicating that they don't
+# support this pair of files, rather than that something went wrong
+_COPY_UNSUPPORTED_ERRORS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                            errno.EOPNOTSUPP)
+
+
+def _load_libc_function(name, argtypes, restype):
+    libc_name = ctypes.util.find_library('c')
+    if libc_name is None:
+        return None
+    try:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        fn = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    fn.argtypes = argtypes
+    fn.restype = restype
+    return fn
+
+_posix_fallocate = _load_libc_function(
+        'posix_fallocate64', [ctypes.c_int, ctypes.c_int64, ctypes.c_int64],
+        ctypes.c_int)
+_copy_file_range = _load_libc_function(
+        'copy_file_range',
+        [ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_int,
+         ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t, ctypes.c_uint],
+        ctypes.c_ssize_t)
+_pread = _load_libc_function(
+        'pread64',
+        [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int64],
+        ctypes.c_ssize_t)
+_sendfile = _load_libc_function(
+        'sendfile64',
+        [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+         ctypes.c_size_t],
+        ctypes.c_ssize_t)
+
+
+def preallocate(fd, length):
+    """
+    Allocate disk space for the first length bytes of the file open as fd.
+
+    Allocating the space up front avoids fragmenting large output files, and
+    means we find out that the disk is full before doing any work, rather
+    than partway through.  If the platform or filesystem doesn't support
+    preallocation, the file is simply extended to the requested length.
+    """
+    if _posix_fallocate is not None:
+        # posix_fallocate() returns the error number rather than setting errno
+        rc = _posix_fallocate(fd, 0, length)
+        if rc == 0:
+            return
+        if rc not in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+            raise OSError(rc, os.strerror(rc))
+
+    if os.fstat(fd).st_size < length:
+        os.ftruncate(fd, length)
+
+
+def pread(fd, length, offset):
+    """
+    Read up to length bytes from fd, starting at the specified offset.
+
+    Unlike os.read(), this doesn't use or change the file position, so
+    several readers can share the same file descriptor.  Returns less data
+    than requested only at the end of the file.
+    """
+    if _pread is None:
+        # Fall back to seeking.  This isn't safe if the file descriptor is
+        # shared with other threads.
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, length)
+
+    buf = ctypes.create_string_buffer(length)
+    done = 0
+    while done < length:
+        rc = _pread(fd, ctypes.addressof(buf) + done, length - done,
+                    offset + done)
+        if rc < 0:
+            error = ctypes.get_errno()
+            if error == errno.EINTR:
+                continue
+            raise OSError(error, os.strerror(error))
+        if rc == 0:
+            break
+        done += rc
+    return buf.raw[:done]
+
+
+def find_data_ranges(fd, start, end):
+    """
+    Find the parts of a file that contain data, skipping over any holes.
+
+    Returns a list of (start, end) tuples for the data between start and end.
+    If the filesystem can't report holes, the entire range is returned.
+    Note that this changes the file position.
+    """
+    ranges = []
+    pos = start
+    while pos < end:
+        try:
+            data_start = os.lseek(fd, pos, SEEK_DATA)
+        except OSError, ex:
+            if ex.errno == errno.ENXIO:
+                # There is no more data before the end of the file
+                break
+            if ex.errno == errno.EINVAL:
+                # SEEK_DATA isn't supported.  Assume it is all data.
+                ranges.append((pos, end))
+                break
+            raise
+        if data_start >= end:
+            break
+        data_end = min(os.lseek(fd, data_start, SEEK_HOLE), end)
+        ranges.append((data_start, data_end))
+        pos = data_end
+
+    return ranges
+
+
+def copy_data(in_fd, in_offset, out_fd, out_offset, length):
+    """
+    Copy length bytes from in_fd to out_fd.
+
+    Where possible, the data is copied inside the kernel with
+    copy_file_range() (which may even share the underlying blocks), or
+    failing that with sendfile(), rather than being read into python
+    buffers.  Note that this changes the file positions of both files.
+    """
+    copied = 0
+    for copy_fn in (_copy_with_copy_file_range, _copy_with_sendfile,
+                    _copy_with_read_write):
+        copied += copy_fn(in_fd, in_offset + copied, out_fd,
+                          out_offset + copied, length - copied)
+        if copied >= length:
+            return
+
+
+def _check_copy_result(rc, copied, length):
+    """
+    Check the return value from copy_file_range() or sendfile().
+
+    Returns True if the copy should continue, or False if the call isn't
+    supported and a different copy method needs to be used.
+    """
+    if rc < 0:
+        error = ctypes.get_errno()
+        if error == errno.EINTR:
+            return True
+        if error in _COPY_UNSUPPORTED_ERRORS and copied == 0:
+            return False
+        raise OSError(error, os.strerror(error))
+    if rc == 0:
+        raise IOError('unexpected end of file: copied %d of %d bytes' %
+                      (copied, length))
+    return True
+
+
+def _copy_with_copy_file_range(in_fd, in_offset, out_fd, out_offset,
+                               length):
+    if _copy_file_range is None:
+        return 0
+
+    in_pos = ctypes.c_int64(in_offset)
+    out_pos = ctypes.c_int64(out_offset)
+    while in_pos.value - in_offset < length:
+        copied = in_pos.value - in_offset
+        rc = _copy_file_range(in_fd, ctypes.byref(in_pos), out_fd,
+                              ctypes.byref(out_pos), length - copied, 0)
+        if not _check_copy_result(rc, copied, length):
+            break
+    return in_pos.value - in_offset
+
+
+def _copy_with_sendfile(in_fd, in_offset, out_fd, out_offset, length):
+    if _sendfile is None:
+        return 0
+
+    # sendfile() writes at the output file's current position
+    os.lseek(out_fd, out_offset, os.SEEK_SET)
+    in_pos = ctypes.c_int64(in_offset)
+    while in_pos.value - in_offset < length:
+        copied = in_pos.value - in_offset
+        rc = _sendfile(out_fd, in_fd, ctypes.byref(in_pos), length - copied)
+        if not _check_copy_result(rc, copied, length):
+            break
+    return in_pos.value - in_offset
+
+
+def _copy_with_read_write(in_fd, in_offset, out_fd, out_offset, length,
+                          buf_size=1024 * 1024):
+    os.lseek(in_fd, in_offset, os.SEEK_SET)
+    os.lseek(out_fd, out_offset, os.SEEK_SET)
+    copied = 0
+    while copied < length:
+        data = os.read(in_fd, min(buf_size, length - copied))
+        if not data:
+            raise IOError('unexpected end of file: copied %d of %d bytes' %
+                          (copied, length))
+        written = 0
+        while written < len(data):
+            written += os.write(out_fd, buffer(data, written))
+        copied += len(data)
+    return copied
+
+
 def find_files_by_suffix(dir, suffix):
     files = []
     for entry in os.listdir(dir):
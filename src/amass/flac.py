@@ -2,7 +2,12 @@
 #
 # Copyright (c) 2011, Adam Simpkins
 #
+import os
 import subprocess
+import sys
+
+from . import proc
+from . import tasks
 
 
 def get_vorbis_name(field):
@@ -48,7 +53,19 @@ def update_comments(comments, name, value):
                                   (value.__class__.__name__,))
 
 
-def tag_file(path, metadata):
+def tag_file(path, metadata, out=None):
+    subprocess.check_call(get_tag_cmd(path, metadata, out))
+
+
+def get_tag_cmd(path, metadata, out=None):
+    """
+    Get the metaflac command to tag path with the specified metadata.
+
+    The tags are printed to out (which defaults to sys.stdout).
+    """
+    if out is None:
+        out = sys.stdout
+
     # Compute the metadata contents
     comments = []
 
@@ -59,7 +76,7 @@ def tag_file(path, metadata):
 
         vorbis_name = get_vorbis_name(field)
         if vorbis_name is None:
-            print '  <ignored> %s: %s' % (field.name, field.value)
+            print >> out, '  <ignored> %s: %s' % (field.name, field.value)
             continue
 
         update_comments(comments, vorbis_name, field.value)
@@ -71,7 +88,86 @@ def tag_file(path, metadata):
     # ReplayGain tags.
     cmd = ['metaflac', '--remove-all-tags']
     for (name, value) in comments:
-        print '  %s=%s' % (name, value)
+        print >> out, '  %s=%s' % (name, value)
         cmd.append('--set-tag=%s=%s' % (name, value))
     cmd.append(path)
-    subprocess.check_call(cmd)
+    return cmd
+
+
+def get_encode_cmd(wav_path, flac_path, quiet=False):
+    """
+    Get the command to encode wav_path to flac_path.
+
+    wav_path may be '-' to encode WAV data read from stdin.  If quiet is True,
+    flac will only print error messages, and not its normal progress output.
+    """
+    flac_options = ['-V']
+    if quiet:
+        flac_options.append('--silent')
+    return ['flac'] + flac_options + ['-o', flac_path, wav_path]
+
+
+def get_tmp_path(flac_path):
+    """
+    Get the temporary path to use while writing flac_path.
+    """
+    (dir, name) = os.path.split(flac_path)
+    return os.path.join(dir, '.%s.tmp' % (name,))
+
+
+def encode_file(wav_path, flac_path, metadata=None, out=None):
+    """
+    Encode a .wav file to flac, and tag it if metadata is not None.
+
+    The output is written to a temporary file, and only renamed to flac_path
+    once encoding and tagging have both succeeded.  If an error occurs the
+    temporary file is removed, so a failed encode never leaves a
+    partially-written flac file behind.
+
+    Output from the encoder is captured and written to out (which defaults to
+    sys.stdout), so that several encodes may be run in parallel without
+    interleaving their output.
+    """
+    return tasks.run(lambda scheduler: encode_file_task(scheduler, wav_path,
+                                                        flac_path, metadata,
+                                                        out))
+
+
+def encode_file_task(scheduler, wav_path, flac_path, metadata=None,
+                     out=None):
+    """
+    A task that does the same thing as encode_file(), on a tasks.Scheduler.
+    """
+    if out is None:
+        out = sys.stdout
+
+    tmp_path = get_tmp_path(flac_path)
+    try:
+        output = proc.ProcOutputBuffer()
+        child = scheduler.spawn(get_encode_cmd(wav_path, tmp_path), output)
+        try:
+            yield child.wait()
+        except proc.CmdFailedError:
+            out.write(output.stderr)
+            raise
+
+        if metadata is not None:
+            output = proc.ProcOutputBuffer()
+            cmd = get_tag_cmd(tmp_path, metadata, out)
+            child = scheduler.spawn(cmd, output)
+            try:
+                yield child.wait()
+            finally:
+                out.write(output.stdout)
+                out.write(output.stderr)
+        os.rename(tmp_path, flac_path)
+    except:
+        # Save the original exception info
+        (ex_type, ex_value, ex_traceback) = sys.exc_info()
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            # We're already in the middle of handling an exception,
+            # so just ignore the error trying to remove the output file.
+            pass
+        raise ex_type, ex_value, ex_traceback
@@ -5,6 +5,7 @@
 """
 Functions for notifying the user of various types of messages.
 """
+import sys
 
 
 def warn(msg):
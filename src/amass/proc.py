@@ -1,5 +1,7 @@
 #!/usr/bin/python -tt
 
+import ctypes
+import errno
 import fcntl
 import os
 import pipes
@@ -14,6 +16,14 @@ import sys
 PIPE = subprocess.PIPE
 STDOUT = subprocess.STDOUT
 
+# The pidfd_open() system call number.  This is the same on all of the
+# architectures we care about.
+_SYS_PIDFD_OPEN = 434
+
+_libc = None
+# Set to False once we find that the kernel doesn't support pidfd_open()
+_pidfd_supported = sys.platform.startswith('linux')
+
 
 class CmdError(Exception):
     def __init__(self, cmd):
@@ -120,6 +130,38 @@ def check_status(cmd, status, expected_rc=(0,), expected_sig=()):
             raise CmdTerminatedError(cmd, signum, expected_sig)
 
 
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    return _libc
+
+
+def open_pidfd(pid):
+    """
+    Open a pidfd for a child process.
+
+    The returned file descriptor becomes readable when the process exits,
+    so it can be waited on with select() or epoll along with other file
+    descriptors.  It does not reap the process.
+
+    Returns None if pidfds are not supported by the kernel, or if the pidfd
+    cannot be opened.
+    """
+    global _pidfd_supported
+    if not _pidfd_supported:
+        return None
+
+    fd = _get_libc().syscall(_SYS_PIDFD_OPEN, pid, 0)
+    if fd >= 0:
+        return fd
+    if ctypes.get_errno() in (errno.ENOSYS, errno.EPERM):
+        # ENOSYS: the kernel is older than 5.3.
+        # EPERM: a seccomp filter is rejecting the call.
+        _pidfd_supported = False
+    return None
+
+
 class Proc(subprocess.Popen):
     """
     Proc is a wrapper around subprocess.Popen.
@@ -131,11 +173,14 @@ class Proc(subprocess.Popen):
       the process exits).
     - Support for reliably killing the process.
     - Support to performing a wait with a timeout.
+    - A file descriptor that can be used to wait for the process to exit
+      together with other file descriptors.
     """
     def __init__(self, args, executable=None, stdin=None,
                  stdout=None, stderr=None, preexec_fn=None, close_fds=False,
                  shell=False, cwd=None, env=None):
         self.args = args
+        self.exitFd = None
 
         # If stdin is a string, open that file to use as the child's stdin
         close_stdin = False
@@ -185,6 +230,25 @@ class Proc(subprocess.Popen):
             self.stderr.close()
             self.stderr = None
 
+    def getExitFd(self):
+        """
+        Get a file descriptor that becomes readable when the process exits.
+
+        The descriptor is owned by the Proc, and is closed once the process
+        has been reaped by wait() or poll().  Returns None if the process has
+        already been reaped, or if pidfds are not supported.
+        """
+        if self.returncode is not None:
+            return None
+        if self.exitFd is None:
+            self.exitFd = open_pidfd(self.pid)
+        return self.exitFd
+
+    def closeExitFd(self):
+        if self.exitFd is not None:
+            os.close(self.exitFd)
+            self.exitFd = None
+
     def read(self, timeout=None, bufsize=4096):
         """
         Read from the process' stdout and stderr.
@@ -275,6 +339,12 @@ class Proc(subprocess.Popen):
         os.kill(self.pid, signal.SIGKILL)
         return self.wait(timeout=sigkill_timeout)
 
+    def poll(self):
+        status = subprocess.Popen.poll(self)
+        if status is not None:
+            self.closeExitFd()
+        return status
+
     def wait(self, timeout=None, poll_interval=0.1):
         """
         Wait for the process to exit.
@@ -284,32 +354,48 @@ class Proc(subprocess.Popen):
         Returns None if the timeout expired before the process exited.
 
         If timeout is None, or is less than 0, this function will wait forever
-        for the process to exit.  Otherwise, 
+        for the process to exit.  Otherwise, it waits on the process' pidfd,
+        so it returns as soon as the process exits.  If pidfds aren't
+        supported it falls back to checking for the process every
+        poll_interval seconds.
         """
         # If the process has already been successfully waited on,
         # return the stored return code.
         if self.returncode is not None:
+            self.closeExitFd()
             return self.returncode
 
         # If the timeout is infinite, use the standard subprocess wait()
         if timeout is None or timeout < 0:
-            return subprocess.Popen.wait(self)
+            status = subprocess.Popen.wait(self)
+            self.closeExitFd()
+            return status
 
-        time_left = timeout
+        exit_fd = self.getExitFd()
+        end_time = time.time() + timeout
         while True:
             # Call waitpid
             pid, status = os.waitpid(self.pid, os.WNOHANG)
             if pid != 0:
                 # Excellent.  The child exited.
                 self._handle_exitstatus(status)
+                self.closeExitFd()
                 return self.returncode
 
             # If we have no time left, exit
+            time_left = end_time - time.time()
             if time_left <= 0:
                 return None
 
-            time.sleep(poll_interval)
-            time_left -= poll_interval
+            if exit_fd is None:
+                time.sleep(min(poll_interval, time_left))
+                continue
+
+            try:
+                select.select([exit_fd], [], [], time_left)
+            except select.error, ex:
+                if ex.args[0] != errno.EINTR:
+                    raise
 
 
 class ProcRunner(object):
@@ -355,13 +441,7 @@ class ProcRunner(object):
                 self.stderrData(cmd_err)
 
     def getProcess(self, process):
-        if isinstance(process, Proc):
-            return process
-        elif isinstance(process, list):
-            return Proc(process, stdin='/dev/null', stdout=PIPE, stderr=PIPE)
-        else:
-            raise TypeError('unexpected process argument of type %s' %
-                            type(process).__name__)
+        return get_proc(process)
 
     def stdoutData(self, data):
         self.monitor.stdoutData(data)
@@ -377,6 +457,334 @@ class ProcRunner(object):
                      self.expectedStatus, self.expectedSignals)
 
 
+def get_proc(process):
+    """
+    Get a Proc object for a process argument to one of the runners.
+
+    process may be a Proc, or a command argument list to start with its
+    stdout and stderr connected to pipes.
+    """
+    if isinstance(process, Proc):
+        return process
+    elif isinstance(process, list):
+        return Proc(process, stdin='/dev/null', stdout=PIPE, stderr=PIPE)
+    else:
+        raise TypeError('unexpected process argument of type %s' %
+                        type(process).__name__)
+
+
+class ManagedProc(object):
+    """
+    A process being supervised by a MultiProcRunner.
+    """
+    def __init__(self, process, monitor, timeout, expected_rc, expected_sig):
+        self.process = process
+        self.monitor = monitor
+        self.timeout = timeout
+        self.expectedStatus = expected_rc
+        self.expectedSignals = expected_sig
+
+        # The exit status, once the process has exited and been reaped
+        self.status = None
+        # The sys.exc_info() tuple for the first error, if the process failed
+        # or one of its monitor callbacks raised an exception
+        self.error = None
+        self.deadline = None
+        # Maps 'stdout' or 'stderr' to the size of the next read on that pipe
+        self.readSizes = {}
+        # The process' exit fd, once it is registered with the epoll object
+        self.exitFd = None
+        # Set if we have to poll to find out when the process exits
+        self.pollExit = False
+
+    def isRunning(self):
+        return self.status is None
+
+    def resetDeadline(self, now):
+        if self.timeout is None:
+            self.deadline = None
+        else:
+            self.deadline = now + self.timeout
+
+
+class MultiProcRunner(object):
+    """
+    A MultiProcRunner supervises any number of Proc objects from a single
+    thread.
+
+    Like ProcRunner, it invokes a monitor callback whenever a process prints
+    data to stdout or stderr, but it waits on the pipes of all of the
+    processes at once, using epoll.  Each process has its own monitor,
+    timeout, and expected exit status.
+
+    The read size for each pipe adapts to how much data the process is
+    producing: it doubles (up to MAX_READ_SIZE) each time a read fills the
+    buffer, and shrinks again when the process slows down.
+
+    Once a process has closed its stdout and stderr, its exit fd (see
+    Proc.getExitFd()) is added to the epoll set, so it is reaped as soon as
+    it exits.  Only if pidfds aren't supported do we fall back to polling
+    for it every EXIT_POLL_INTERVAL seconds.
+
+    If a process exits with an unexpected status, or one of its monitor
+    callbacks raises an exception, the error is saved in the ManagedProc.
+    run() raises the first error once all of the processes have finished.
+    If stopOnError is True, the error is raised immediately instead, and the
+    other processes are killed.
+    """
+    MIN_READ_SIZE = 4096
+    MAX_READ_SIZE = 256 * 1024
+    # How often to check whether processes that have closed their pipes have
+    # exited yet, when they don't have an exit fd
+    EXIT_POLL_INTERVAL = 0.1
+
+    def __init__(self):
+        self.killOnError = True
+        self.stopOnError = False
+        self.procs = []
+        # Maps file descriptor --> (ManagedProc, 'stdout' or 'stderr')
+        # Exit fds are mapped to (ManagedProc, None)
+        self.fds = {}
+        self.epoll = None
+
+    def add(self, process, monitor, timeout=None, expected_rc=(0,),
+            expected_sig=()):
+        """
+        Add a process to supervise.
+
+        If no data is received from the process for timeout seconds, the
+        monitor's timeoutExpired() method is called.
+
+        Returns a ManagedProc object.
+        """
+        entry = ManagedProc(get_proc(process), monitor, timeout,
+                            expected_rc, expected_sig)
+        self.procs.append(entry)
+        if self.epoll is not None:
+            self.__register(entry, time.time())
+        return entry
+
+    def run(self):
+        """
+        Run until all of the processes have exited.
+        """
+        self.epoll = select.epoll()
+        try:
+            now = time.time()
+            for entry in self.procs:
+                self.__register(entry, now)
+            while True:
+                self.beforePoll()
+                running = [entry for entry in self.procs if entry.isRunning()]
+                if not running:
+                    break
+                self.__poll(running)
+        except:
+            (ex_type, ex_value, ex_traceback) = sys.exc_info()
+            if self.killOnError:
+                for entry in self.procs:
+                    if entry.isRunning():
+                        self.__kill(entry)
+            raise ex_type, ex_value, ex_traceback
+        finally:
+            for entry in self.procs:
+                self.__closePipes(entry)
+                self.__unwatchExit(entry)
+            self.epoll.close()
+            self.epoll = None
+
+        for entry in self.procs:
+            if entry.error is not None:
+                raise entry.error[0], entry.error[1], entry.error[2]
+
+    def kill(self, entry):
+        """
+        Kill one of the processes, and stop reading from it.
+        """
+        if not entry.isRunning():
+            return
+        self.__closePipes(entry)
+        self.__kill(entry)
+
+    def beforePoll(self):
+        """
+        Called by run() each time before it waits for more events.
+
+        Subclasses may override this to do their own work on the run() loop.
+        They may add new processes to the runner from here.
+        """
+        pass
+
+    def processExited(self, entry):
+        """
+        Called once a process has exited and been reaped.
+
+        Subclasses may override this to be notified of process exits.
+        """
+        pass
+
+    def __register(self, entry, now):
+        entry.resetDeadline(now)
+        for name in ('stdout', 'stderr'):
+            pipe = getattr(entry.process, name)
+            if pipe is None or getattr(entry.process, name + 'EOF'):
+                continue
+            fd = pipe.fileno()
+            self.fds[fd] = (entry, name)
+            entry.readSizes[name] = self.MIN_READ_SIZE
+            self.epoll.register(fd, select.EPOLLIN)
+        if not entry.readSizes:
+            self.__watchExit(entry)
+
+    def __watchExit(self, entry):
+        fd = entry.process.getExitFd()
+        if fd is None:
+            entry.pollExit = True
+            return
+        entry.exitFd = fd
+        self.fds[fd] = (entry, None)
+        self.epoll.register(fd, select.EPOLLIN)
+
+    def __unwatchExit(self, entry):
+        # This must be called before the process is reaped, since the Proc
+        # closes its exit fd at that point.
+        entry.pollExit = False
+        fd = entry.exitFd
+        if fd is None:
+            return
+        entry.exitFd = None
+        self.epoll.unregister(fd)
+        del self.fds[fd]
+
+    def __poll(self, running):
+        now = time.time()
+        poll_timeout = -1
+        for entry in running:
+            if entry.pollExit:
+                timeout = self.EXIT_POLL_INTERVAL
+            elif entry.deadline is not None:
+                timeout = max(entry.deadline - now, 0)
+            else:
+                continue
+            if poll_timeout < 0 or timeout < poll_timeout:
+                poll_timeout = timeout
+
+        try:
+            events = self.epoll.poll(poll_timeout)
+        except IOError, ex:
+            if ex.errno != errno.EINTR:
+                raise
+            events = []
+
+        now = time.time()
+        for (fd, event_mask) in events:
+            if fd not in self.fds:
+                continue
+            (entry, name) = self.fds[fd]
+            if name is None:
+                self.__checkExit(entry)
+            else:
+                self.__readPipe(entry, name, fd, now)
+
+        for entry in running:
+            if not entry.isRunning():
+                continue
+            if entry.pollExit:
+                self.__checkExit(entry)
+            elif entry.deadline is not None and now >= entry.deadline:
+                entry.resetDeadline(now)
+                self.__dispatch(entry, entry.monitor.timeoutExpired)
+
+    def __readPipe(self, entry, name, fd, now):
+        size = entry.readSizes[name]
+        try:
+            data = os.read(fd, size)
+        except OSError, ex:
+            if ex.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+
+        if not data:
+            self.__closePipe(entry, name)
+            return
+
+        if len(data) == size:
+            entry.readSizes[name] = min(size * 2, self.MAX_READ_SIZE)
+        elif len(data) < size / 4:
+            entry.readSizes[name] = max(size / 2, self.MIN_READ_SIZE)
+        entry.resetDeadline(now)
+
+        if name == 'stdout':
+            self.__dispatch(entry, entry.monitor.stdoutData, data)
+        else:
+            self.__dispatch(entry, entry.monitor.stderrData, data)
+
+    def __closePipe(self, entry, name):
+        pipe = getattr(entry.process, name)
+        fd = pipe.fileno()
+        self.epoll.unregister(fd)
+        del self.fds[fd]
+        del entry.readSizes[name]
+        # Close the pipe now, so it gets closed even if the Proc doesn't get
+        # garbage collected for a while
+        pipe.close()
+        setattr(entry.process, name, None)
+        setattr(entry.process, name + 'EOF', True)
+
+        if not entry.readSizes and entry.isRunning():
+            self.__watchExit(entry)
+
+    def __closePipes(self, entry):
+        for name in entry.readSizes.keys():
+            self.__closePipe(entry, name)
+
+    def __checkExit(self, entry):
+        if entry.exitFd is None:
+            if entry.process.poll() is None:
+                return
+            entry.pollExit = False
+        else:
+            # The exit fd is readable, so the process has exited.
+            self.__unwatchExit(entry)
+            entry.process.wait()
+        entry.status = entry.process.returncode
+        if entry.error is None:
+            try:
+                check_status(entry.process, entry.status,
+                             entry.expectedStatus, entry.expectedSignals)
+            except CmdFailedError:
+                self.__failed(entry)
+        self.processExited(entry)
+
+    def __dispatch(self, entry, callback, *args):
+        try:
+            callback(*args)
+        except:
+            self.__failed(entry)
+
+    def __failed(self, entry):
+        """
+        Record the exception currently being handled as the error for entry.
+        """
+        error = sys.exc_info()
+        if entry.error is None:
+            entry.error = error
+        if self.stopOnError:
+            raise error[0], error[1], error[2]
+
+        # Stop reading from the process.  If killOnError is False, it is left
+        # running, and we just wait for it to exit.
+        self.__closePipes(entry)
+        if self.killOnError and entry.isRunning():
+            self.__kill(entry)
+
+    def __kill(self, entry):
+        self.__unwatchExit(entry)
+        entry.process.kill()
+        entry.status = entry.process.returncode
+        self.processExited(entry)
+
+
 class ProcLineMonitor(object):
     """
     ProcLineMonitor is a monitor that can be used with ProcRunner.
@@ -421,3 +829,23 @@ class ProcLineMonitor(object):
         return_fragment = lines.pop()
 
         return (return_fragment, lines)
+
+
+class ProcOutputBuffer(object):
+    """
+    ProcOutputBuffer is a monitor that can be used with ProcRunner.
+
+    It simply accumulates all of the data printed by the process.
+    """
+    def __init__(self):
+        self.stdout = ''
+        self.stderr = ''
+
+    def stdoutData(self, data):
+        self.stdout += data
+
+    def stderrData(self, data):
+        self.stderr += data
+
+    def timeoutExpired(self):
+        pass
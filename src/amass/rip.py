@@ -2,14 +2,40 @@
 #
 # Copyright (c) 2010, Adam Simpkins
 #
+import ctypes
+import errno
+import fcntl
+import os
 import re
+import struct
 import subprocess
 import sys
+import termios
+import threading
 import time
+import zlib
 
+from . import cbuf
 from . import cdrom
+from . import file_util
 from . import proc
+from . import rip_merge
+from . import scsi_sg
 from . import simplelog
+from . import tasks
+from . import wav
+
+# Rip modes
+# cdparanoia, with full verification of all data
+RIP_PARANOIA = 'paranoia'
+# Read each sector once at full speed with READ CD, without verification
+RIP_BURST = 'burst'
+# Read each track twice at full speed, comparing CRCs of the two passes.
+# Fall back to cdparanoia only if they differ.
+RIP_TEST_AND_COPY = 'test-and-copy'
+# Read at full speed with C2 error pointers, and only re-read the sectors the
+# drive flags as containing errors.
+RIP_C2 = 'c2'
 
 
 class Ripper(object):
@@ -22,6 +48,9 @@ class Ripper(object):
         self.startSector = None
         self.endSector = None
 
+        # The drive's read offset correction, in stereo samples
+        self.readOffset = 0
+
         self.statusRe = re.compile(r'^##: (?P<functionNumber>-?\d+) '
                                    r'\[(?P<functionName>.*)\] @ '
                                    r'(?P<offset>\d+)$')
@@ -29,17 +58,37 @@ class Ripper(object):
                                         r'sector\s+(?P<sector>\d+)')
         self.endSectorRe = re.compile(r'^\s+to sector\s+(?P<sector>\d+)')
 
+    def getCommand(self):
+        return (['cdparanoia', '-e', '-d', self.device] +
+                self.getReadOptions() +
+                ['--', str(self.trackNumber), self.outputPath])
+
+    def getReadOptions(self):
+        if self.readOffset:
+            return ['-O', str(self.readOffset)]
+        return []
+
     def run(self):
         monitor = proc.ProcLineMonitor(self)
         runner = proc.ProcRunner()
 
-        cmd = ['cdparanoia', '-e', '-d', self.device, '--',
-               str(self.trackNumber), self.outputPath]
-        process = proc.Proc(cmd, stdout=subprocess.PIPE,
+        process = proc.Proc(self.getCommand(), stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE)
         runner.run(process, monitor)
         self.monitor.ripComplete()
 
+    def runTask(self, scheduler):
+        """
+        A task that does the same thing as run(), on a tasks.Scheduler.
+
+        This allows several rips to be supervised from a single thread.
+        """
+        process = proc.Proc(self.getCommand(), stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+        child = scheduler.spawn(process, proc.ProcLineMonitor(self))
+        yield child.wait()
+        self.monitor.ripComplete()
+
     def stdoutLine(self, line):
         # We don't really care about lines printed to stdout.
         # (In general, cdparanoia doesn't print much here when stdout is
@@ -82,6 +131,1120 @@ class Ripper(object):
         self.monitor.ripUpdate(function, offset)
 
 
+class EncodingRipper(Ripper):
+    """
+    An EncodingRipper rips a track and pipes the audio data straight into an
+    encoder process, rather than writing a .wav file to disk.
+
+    The encoder command must read WAV data from stdin.  Its stdout and
+    stderr are collected while the rip runs, and are available in the
+    encoderOutput attribute afterwards.
+    """
+    def __init__(self, device, track_number, encoder_cmd, monitor):
+        Ripper.__init__(self, device, track_number, '-', monitor)
+        self.encoderCmd = encoder_cmd
+        self.encoderOutput = None
+
+    def getCommand(self):
+        # Force WAV output, even though we are writing to stdout
+        return (['cdparanoia', '-e', '-w', '-d', self.device] +
+                self.getReadOptions() +
+                ['--', str(self.trackNumber), self.outputPath])
+
+    def startProcesses(self):
+        """
+        Start cdparanoia and the encoder.
+
+        Returns a tuple of (cdparanoia, encoder) Proc objects.
+        """
+        # Use close_fds, so that no other child process keeps a copy of the
+        # encoder's stdin open.  Otherwise the encoder might not see EOF
+        # when cdparanoia exits.
+        encoder = proc.Proc(self.encoderCmd, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            close_fds=True)
+        try:
+            process = proc.Proc(self.getCommand(), stdout=encoder.stdin,
+                                stderr=subprocess.PIPE, close_fds=True)
+            # Close our copy of the encoder's stdin.
+            # cdparanoia now holds the only copy.
+            encoder.stdin.close()
+            encoder.stdin = None
+        except:
+            encoder.kill()
+            raise
+        return (process, encoder)
+
+    def run(self):
+        (process, encoder) = self.startProcesses()
+
+        # Watch both processes at once.  Once cdparanoia exits the encoder
+        # sees EOF on stdin, and the runner waits for it to finish writing
+        # the output file.  If either one fails, the other is killed.
+        self.encoderOutput = proc.ProcOutputBuffer()
+        runner = proc.MultiProcRunner()
+        runner.stopOnError = True
+        runner.add(process, proc.ProcLineMonitor(self))
+        runner.add(encoder, self.encoderOutput)
+        runner.run()
+        self.monitor.ripComplete()
+
+    def runTask(self, scheduler):
+        (process, encoder) = self.startProcesses()
+        self.encoderOutput = proc.ProcOutputBuffer()
+        rip = scheduler.spawn(process, proc.ProcLineMonitor(self))
+        encode = scheduler.spawn(encoder, self.encoderOutput)
+        # If either process fails, gather() fails right away, and the other
+        # process is killed when this task finishes.
+        yield tasks.gather([rip.wait(), encode.wait()])
+        self.monitor.ripComplete()
+
+
+class RipCheckpoint(object):
+    """
+    A RipCheckpoint records how much of a track NativeRipper has saved, so
+    that an interrupted rip can be continued later instead of starting over.
+
+    nextSector is the first sector that has not been saved yet.  Every sector
+    before it was read without uncorrected errors, and has been synced to
+    disk.  crc is the CRC32 of the audio data up to nextSector.  readOffset
+    is the read offset correction that the data was ripped with.
+    """
+    def __init__(self, path, start, end, read_offset=0):
+        self.path = path
+        self.startSector = start
+        self.endSector = end
+        self.readOffset = read_offset
+        self.nextSector = start
+        self.crc = 0
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        """
+        Load the checkpoint from disk.
+
+        Returns False if there is no checkpoint, or if it is for a different
+        sector range or read offset.
+        """
+        try:
+            f = open(self.path, 'r')
+        except IOError, ex:
+            if ex.errno == errno.ENOENT:
+                return False
+            raise
+
+        values = {}
+        with f:
+            for line in f:
+                (name, value) = line.strip().split('=', 1)
+                values[name] = int(value)
+
+        if (values['start'] != self.startSector or
+            values['end'] != self.endSector or
+            values.get('offset', 0) != self.readOffset):
+            return False
+        self.nextSector = values['next']
+        self.crc = values['crc']
+        return True
+
+    def save(self):
+        # Write the new checkpoint to a temporary file first, so that the old
+        # checkpoint is still intact if we crash while writing.
+        file_util.prepare_new(self.path)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('start=%d\n' % (self.startSector,))
+            f.write('end=%d\n' % (self.endSector,))
+            f.write('offset=%d\n' % (self.readOffset,))
+            f.write('next=%d\n' % (self.nextSector,))
+            f.write('crc=%d\n' % (self.crc,))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except OSError, ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+
+class NativeRipper(object):
+    """
+    NativeRipper reads audio data directly from the drive with READ CD
+    commands, rather than running cdparanoia.
+
+    This is a "burst" mode reader: sectors are read in large batches at full
+    drive speed, and nothing is verified.  It is much faster than
+    cdparanoia, but should only be used for clean discs.  Sectors that the
+    drive fails to read are retried individually, and then reported to the
+    monitor as skips and written out as silence.
+
+    start and end are LBA sector addresses.  end is exclusive.
+    """
+    DEFAULT_BATCH_SECTORS = 32
+    # The amount of data to read to flush the drive's read cache.
+    # Most drives have a cache of 2MB or less.
+    DEFAULT_CACHE_SECTORS = 1024
+    # Save a checkpoint after every 30 seconds of audio
+    DEFAULT_CHECKPOINT_SECTORS = 30 * cdrom.FRAMES_PER_SECOND
+
+    def __init__(self, device, start, end, output_path, monitor):
+        """
+        If output_path is None, the data is read but not saved anywhere.
+        (This is still useful to compute the CRC of the track.)
+        """
+        self.device = device
+        self.startSector = start
+        self.endSector = end
+        self.outputPath = output_path
+        self.monitor = monitor
+
+        self.batchSectors = self.DEFAULT_BATCH_SECTORS
+        self.retries = 3
+
+        # If defeatCache is True, read cacheSectors of data from elsewhere on
+        # the disc before starting, so that none of the track data will be
+        # returned from the drive's cache.
+        self.defeatCache = False
+        self.cacheSectors = self.DEFAULT_CACHE_SECTORS
+
+        # The CRC32 of the audio data read
+        self.crc = 0
+
+        # If checkpoint is set to a RipCheckpoint, progress is saved to it
+        # every checkpointSectors sectors while ripping.  If it already
+        # contains progress from an earlier, interrupted rip, ripping
+        # continues from that point, appending to the existing output file.
+        # The checkpoint is removed once the rip completes.
+        self.checkpoint = None
+        self.checkpointSectors = self.DEFAULT_CHECKPOINT_SECTORS
+
+        # Set once a sector could not be read.  Checkpoints never advance past
+        # an uncorrected error, so a resumed rip retries the bad sectors.
+        self.hadSkip = False
+
+        # The drive's read offset correction, in stereo samples.  The data
+        # for each sector is taken from this many samples later on the disc.
+        self.readOffset = 0
+        # The LBA of the lead-out of the track's session.  With a positive
+        # read offset, reads past this address are filled with silence if
+        # the drive can't do them.  Reads before it (into the next track) are
+        # retried and reported like any other sector.  If this is None,
+        # the lead-out is assumed to be unknown, and no reads are filled in.
+        self.leadOutSector = None
+
+        # An optional SpeedController to adjust the read speed while ripping
+        self.speedController = None
+
+        # If mappedIo is True and the drive's sg device node can be opened,
+        # sectors are read into the sg reserved buffer mapped into memory,
+        # and the CRC and the output file are computed and written straight
+        # from there.
+        self.mappedIo = True
+        self.reservedBuffer = None
+
+    def run(self):
+        with cdrom.binary.Device(self.device) as device:
+            if self.defeatCache:
+                self.flushCache(device)
+
+            # cdparanoia reports the end sector inclusively.
+            # Report it the same way.
+            self.monitor.ripStart(self.startSector, self.endSector - 1)
+            self.openReservedBuffer()
+            try:
+                if self.outputPath is None:
+                    self.readRange(device, self.startSector, self.endSector,
+                                   None)
+                else:
+                    (start, writer) = self.openWriter()
+                    with writer:
+                        self.readRange(device, start, self.endSector, writer)
+            finally:
+                self.closeReservedBuffer()
+            self.monitor.ripUpdate('finished',
+                                   self.endSector * cdrom.SAMPLES_PER_FRAME)
+
+        if self.checkpoint is not None:
+            self.checkpoint.remove()
+        self.monitor.ripComplete()
+
+    def openWriter(self):
+        """
+        Open the output file.
+
+        Returns a tuple of (start, writer), where start is the sector to start
+        reading from.  This is the start of the track, unless the checkpoint
+        indicates that part of the track was saved by an earlier rip.
+        """
+        if (self.checkpoint is not None and self.checkpoint.load() and
+            self.checkpoint.nextSector > self.startSector):
+            start = self.checkpoint.nextSector
+            length = (start - self.startSector) * cdrom.BYTES_PER_FRAME
+            try:
+                writer = wav.WavWriter(self.outputPath, resume_length=length)
+            except IOError, ex:
+                self.monitor.log.warning('Unable to resume from checkpoint: '
+                                         '%s', ex)
+            else:
+                self.crc = self.checkpoint.crc
+                self.monitor.log.info('Resuming rip from sector %d', start)
+                self.monitor.output.log('Resuming from sector %d' % (start,))
+                self.monitor.ripUpdate('wrote',
+                                       start * cdrom.SAMPLES_PER_FRAME)
+                return (start, writer)
+
+        if self.checkpoint is not None:
+            self.checkpoint.nextSector = self.startSector
+            self.checkpoint.crc = 0
+        return (self.startSector, wav.WavWriter(self.outputPath))
+
+    def readRange(self, device, start, end, writer):
+        if self.speedController is not None:
+            self.speedController.start(device, self.monitor, start)
+
+        # Leave room for one extra sector, for the read offset
+        buf_len = (self.batchSectors + 1) * cdrom.BYTES_PER_FRAME
+        with cbuf.default_pool.buffer(buf_len) as buf:
+            lba = start
+            while lba < end:
+                count = min(self.batchSectors, end - lba)
+                data = self.readSectors(device, lba, count, buf)
+                self.crc = zlib.crc32(data, self.crc)
+                if writer is not None:
+                    writer.write(data)
+                lba += count
+                self.monitor.ripUpdate('wrote', lba * cdrom.SAMPLES_PER_FRAME)
+                if self.speedController is not None:
+                    self.speedController.update(device, lba)
+
+                if (self.checkpoint is not None and writer is not None and
+                    not self.hadSkip and
+                    lba - self.checkpoint.nextSector >=
+                    self.checkpointSectors):
+                    self.saveCheckpoint(lba, writer)
+        self.crc &= 0xffffffff
+
+    def openReservedBuffer(self):
+        if not self.mappedIo:
+            return
+        sg_path = scsi_sg.find_sg_device(self.device)
+        if sg_path is None:
+            return
+
+        # Leave room for one extra sector, for the read offset
+        size = (self.batchSectors + 1) * cdrom.BYTES_PER_FRAME
+        try:
+            fd = os.open(sg_path, os.O_RDWR)
+        except OSError, ex:
+            self.monitor.log.info('cannot open %s, not using mapped I/O: %s',
+                                  sg_path, ex)
+            return
+        try:
+            self.reservedBuffer = scsi_sg.ReservedBuffer(fd, size)
+        except EnvironmentError, ex:
+            os.close(fd)
+            self.monitor.log.info('cannot map the sg reserved buffer for %s: '
+                                  '%s', sg_path, ex)
+            return
+        if self.reservedBuffer.size < size:
+            self.monitor.log.info('the sg reserved buffer for %s is only %d '
+                                  'bytes; not using mapped I/O',
+                                  sg_path, self.reservedBuffer.size)
+            self.closeReservedBuffer()
+
+    def closeReservedBuffer(self):
+        if self.reservedBuffer is None:
+            return
+        fd = self.reservedBuffer.fd
+        self.reservedBuffer.close()
+        self.reservedBuffer = None
+        os.close(fd)
+
+    def saveCheckpoint(self, lba, writer):
+        # The data must be on disk before the checkpoint claims it is.
+        writer.sync()
+        self.checkpoint.nextSector = lba
+        self.checkpoint.crc = self.crc & 0xffffffff
+        self.checkpoint.save()
+
+    def flushCache(self, device):
+        # Read data from just before the track if there is room,
+        # or from just after it otherwise.
+        if self.startSector >= self.cacheSectors:
+            lba = self.startSector - self.cacheSectors
+        else:
+            lba = self.endSector
+        end = lba + self.cacheSectors
+
+        buf_len = self.batchSectors * cdrom.BYTES_PER_FRAME
+        with cbuf.default_pool.buffer(buf_len) as buf:
+            while lba < end:
+                count = min(self.batchSectors, end - lba)
+                try:
+                    cdrom.binary.read_cd(device, lba, count, buf)
+                except scsi_sg.CheckConditionError:
+                    # We may have run off the end of the disc.
+                    # The data itself doesn't matter, so just stop here.
+                    break
+                lba += count
+
+    def readSectors(self, device, lba, count, buf):
+        """
+        Read count sectors of audio data starting at lba, with the read offset
+        correction applied.
+
+        When the sectors can be read through the reserved buffer, a read-only
+        buffer object referring to the data there is returned, rather than a
+        string.  It is only valid until the next read.
+        """
+        if self.readOffset == 0 and self.reservedBuffer is None:
+            return self.readRawSectors(device, lba, count, buf)
+
+        # Shifting the data by the read offset means we need part of one
+        # extra sector.
+        shift = self.readOffset * cdrom.BYTES_PER_STEREO_SAMPLE
+        (sector_shift, byte_shift) = divmod(shift, cdrom.BYTES_PER_FRAME)
+        raw_start = lba + sector_shift
+        raw_end = raw_start + count
+        if byte_shift:
+            raw_end += 1
+
+        if (self.reservedBuffer is not None and raw_start >= 0 and
+            raw_end <= self.endSector):
+            data = self.readMappedSectors(raw_start, raw_end - raw_start,
+                                          byte_shift, count)
+            if data is not None:
+                return data
+
+        data = []
+        if raw_start < 0:
+            # The drive can't read the lead-in.  Use silence instead.
+            num_zero = min(raw_end, 0) - raw_start
+            data.append('\0' * (num_zero * cdrom.BYTES_PER_FRAME))
+            raw_start += num_zero
+        read_end = min(raw_end, max(self.endSector, raw_start))
+        if raw_start < read_end:
+            data.append(self.readRawSectors(device, raw_start,
+                                            read_end - raw_start, buf))
+        for overread_lba in range(read_end, raw_end):
+            data.append(self.readOverreadSector(device, overread_lba, buf))
+
+        data = ''.join(data)
+        return data[byte_shift:byte_shift + count * cdrom.BYTES_PER_FRAME]
+
+    def readMappedSectors(self, lba, count, byte_shift, num_sectors):
+        """
+        Read count sectors into the reserved buffer, and return num_sectors of
+        data starting byte_shift bytes in.
+
+        Returns None if the drive reports a read error, so the caller can fall
+        back to reading the sectors individually.
+        """
+        self.monitor.ripUpdate('read', lba * cdrom.SAMPLES_PER_FRAME)
+        try:
+            cdrom.binary.read_cd_mapped(self.reservedBuffer, lba, count)
+        except scsi_sg.CheckConditionError, ex:
+            if not is_read_error(ex):
+                raise
+            return None
+        return self.reservedBuffer.getBuffer(byte_shift, byte_shift +
+                                             num_sectors *
+                                             cdrom.BYTES_PER_FRAME)
+
+    def readOverreadSector(self, device, lba, buf):
+        # Read a sector past the end of the track, which is only needed
+        # because of the read offset.
+        if self.leadOutSector is None or lba < self.leadOutSector:
+            # This is the start of the next track, and its data is as
+            # important as the rest of this track's.
+            return self.readRawSectors(device, lba, 1, buf)
+
+        # Most drives can't read into the lead-out; use silence if this
+        # fails.
+        try:
+            cdrom.binary.read_cd(device, lba, 1, buf)
+        except scsi_sg.CheckConditionError, ex:
+            if not (is_read_error(ex) or is_out_of_range_error(ex)):
+                raise
+            return '\0' * cdrom.BYTES_PER_FRAME
+        return ctypes.string_at(buf.buf, cdrom.BYTES_PER_FRAME)
+
+    def readRawSectors(self, device, lba, count, buf):
+        self.monitor.ripUpdate('read', lba * cdrom.SAMPLES_PER_FRAME)
+        try:
+            cdrom.binary.read_cd(device, lba, count, buf)
+        except scsi_sg.CheckConditionError, ex:
+            if not is_read_error(ex):
+                raise
+            # Read the sectors one at a time, so that only the ones the
+            # drive really can't read are lost.
+            data = [self.readSingleSector(device, lba + n, buf)
+                    for n in range(count)]
+            return ''.join(data)
+
+        return ctypes.string_at(buf.buf, count * cdrom.BYTES_PER_FRAME)
+
+    def readSingleSector(self, device, lba, buf):
+        offset = lba * cdrom.SAMPLES_PER_FRAME
+        for attempt in range(self.retries + 1):
+            try:
+                cdrom.binary.read_cd(device, lba, 1, buf)
+                return ctypes.string_at(buf.buf, cdrom.BYTES_PER_FRAME)
+            except scsi_sg.CheckConditionError, ex:
+                if not is_read_error(ex):
+                    raise
+                self.monitor.ripUpdate('transport error', offset)
+
+        # Give up, and fill this sector with silence
+        self.hadSkip = True
+        self.monitor.ripUpdate('skip', offset)
+        return '\0' * cdrom.BYTES_PER_FRAME
+
+
+class C2Ripper(NativeRipper):
+    """
+    C2Ripper reads audio data with C2 error pointers enabled.
+
+    Sectors without any C2 errors are trusted as-is.  Sectors the drive
+    flags are re-read, and each flagged sample is decided by a vote among
+    the copies where that sample was not flagged.  A sample is considered
+    corrected once minAgree copies agree on its value.  If some samples are
+    still unresolved after maxCopies reads, the most common value is used,
+    and the sector is reported to the monitor as an uncorrected error.
+
+    This requires a drive that supports C2 error pointers.
+    """
+    DEFAULT_MAX_COPIES = 8
+
+    def __init__(self, device, start, end, output_path, monitor):
+        NativeRipper.__init__(self, device, start, end, output_path, monitor)
+        self.minAgree = 2
+        self.maxCopies = self.DEFAULT_MAX_COPIES
+
+        # The C2 data is checked by readRawSectors(),
+        # so every read has to go through it.
+        self.mappedIo = False
+        self.c2Buf = None
+        self.sectorSize = cdrom.BYTES_PER_FRAME + cdrom.binary.C2_ERROR_SIZE
+        self.noErrors = '\0' * cdrom.binary.C2_ERROR_SIZE
+
+    def readRawSectors(self, device, lba, count, buf):
+        self.monitor.ripUpdate('read', lba * cdrom.SAMPLES_PER_FRAME)
+        if self.c2Buf is None:
+            self.c2Buf = cbuf.allocate_aligned((self.batchSectors + 1) *
+                                               self.sectorSize)
+
+        try:
+            cdrom.binary.read_cd_c2(device, lba, count, self.c2Buf)
+        except scsi_sg.CheckConditionError, ex:
+            if not is_read_error(ex):
+                raise
+            # Deal with each sector individually
+            return ''.join([self.resolveSector(device, lba + n, None)
+                            for n in range(count)])
+
+        raw = ctypes.string_at(self.c2Buf.buf, count * self.sectorSize)
+        data = []
+        for n in range(count):
+            sector_start = n * self.sectorSize
+            audio_end = sector_start + cdrom.BYTES_PER_FRAME
+            audio = raw[sector_start:audio_end]
+            errors = raw[audio_end:sector_start + self.sectorSize]
+            if errors != self.noErrors:
+                audio = self.resolveSector(device, lba + n, (audio, errors))
+            data.append(audio)
+        return ''.join(data)
+
+    def readCopy(self, device, lba):
+        """
+        Read a single sector.
+
+        Returns a tuple of (audio, errors), or None if the read failed.
+        """
+        try:
+            cdrom.binary.read_cd_c2(device, lba, 1, self.c2Buf)
+        except scsi_sg.CheckConditionError, ex:
+            if not is_read_error(ex):
+                raise
+            self.monitor.ripUpdate('transport error',
+                                   lba * cdrom.SAMPLES_PER_FRAME)
+            return None
+        raw = ctypes.string_at(self.c2Buf.buf, self.sectorSize)
+        return (raw[:cdrom.BYTES_PER_FRAME], raw[cdrom.BYTES_PER_FRAME:])
+
+    def resolveSector(self, device, lba, first_copy):
+        """
+        Re-read a sector that had C2 errors (or that failed to read at all),
+        and vote on the value of each sample that was flagged.
+        """
+        offset = lba * cdrom.SAMPLES_PER_FRAME
+        copies = []
+        if first_copy is not None:
+            copies.append(first_copy)
+
+        attempts = len(copies)
+        while attempts < self.maxCopies:
+            copy = self.readCopy(device, lba)
+            attempts += 1
+            if copy is None:
+                continue
+            if not copies and copy[1] == self.noErrors:
+                # The batch read failed, but this sector reads cleanly
+                # on its own.
+                return copy[0]
+            copies.append(copy)
+            (audio, resolved) = vote_samples(copies, self.minAgree)
+            if resolved:
+                self.monitor.ripUpdate('correction', offset)
+                return audio
+
+        if not copies:
+            self.hadSkip = True
+            self.monitor.ripUpdate('skip', offset)
+            return '\0' * cdrom.BYTES_PER_FRAME
+
+        (audio, resolved) = vote_samples(copies, self.minAgree)
+        if resolved:
+            self.monitor.ripUpdate('correction', offset)
+        else:
+            self.hadSkip = True
+            self.monitor.ripUpdate('skip', offset)
+        return audio
+
+
+def get_c2_sample_errors(errors, sample):
+    """
+    Returns True if the C2 error bits indicate an error in any byte of the
+    specified stereo sample.
+    """
+    # Each stereo sample is 4 bytes, so its error bits are one nibble of the
+    # C2 data.  The bits for the first byte of the sector are in the most
+    # significant bit of the first C2 byte.
+    bits = ord(errors[sample >> 1])
+    if sample & 1:
+        return bool(bits & 0x0f)
+    return bool(bits & 0xf0)
+
+
+def vote_samples(copies, min_agree):
+    """
+    Combine several copies of a sector's audio data by voting on each sample.
+
+    copies is a list of (audio, errors) tuples, where errors contains the C2
+    error pointer bits for the audio data.  Samples that no copy flagged are
+    taken from the first copy.  For each flagged sample, the copies that did
+    not flag that sample vote on its value.
+
+    Returns a tuple of (audio, resolved).  resolved is False if at least one
+    sample did not get min_agree matching votes from unflagged copies.
+    """
+    first_audio = copies[0][0]
+    size = cdrom.BYTES_PER_STEREO_SAMPLE
+
+    # Find the samples that any copy flagged.  Most C2 bytes are 0, so
+    # check a whole byte (2 samples) at a time.
+    suspect = set()
+    for (audio, errors) in copies:
+        if errors == '\0' * len(errors):
+            continue
+        for idx in range(len(errors)):
+            if errors[idx] != '\0':
+                suspect.add(idx * 2)
+                suspect.add(idx * 2 + 1)
+
+    samples = None
+    resolved = True
+    for sample in sorted(suspect):
+        start = sample * size
+        end = start + size
+
+        votes = {}
+        all_votes = {}
+        for (audio, errors) in copies:
+            value = audio[start:end]
+            all_votes[value] = all_votes.get(value, 0) + 1
+            if not get_c2_sample_errors(errors, sample):
+                votes[value] = votes.get(value, 0) + 1
+
+        if votes:
+            (count, value) = max((n, v) for (v, n) in votes.iteritems())
+        else:
+            count = 0
+        if count < min_agree:
+            resolved = False
+            # Fall back to the most common value, flagged or not
+            (count, value) = max((n, v) for (v, n) in all_votes.iteritems())
+
+        if value != first_audio[start:end]:
+            if samples is None:
+                samples = [first_audio[i:i + size]
+                           for i in range(0, len(first_audio), size)]
+            samples[sample] = value
+
+    if samples is None:
+        return (first_audio, resolved)
+    return (''.join(samples), resolved)
+
+
+class SpeedController(object):
+    """
+    SpeedController adjusts the drive's read speed while ripping, based on
+    how many problems the rip Monitor reports.
+
+    Progress is divided into windows of windowSectors sectors.  If a window
+    has any uncorrected errors, or at least maxWarnings warnings, the speed
+    is stepped down.  After stepUpWindows clean windows in a row, it is
+    stepped back up.  Damaged discs usually rip faster overall at lower
+    speeds, since the drive needs fewer retries, while clean discs can
+    be read at full speed.
+
+    The same controller should be used for every track on a disc, so that
+    the speed chosen for one track carries over to the next.  Every speed
+    change is logged to the monitor's log.
+    """
+    # Speeds to step through, as multiples of 1x
+    DEFAULT_SPEEDS = [4, 8, 12, 16, 24, 32, 40, 48]
+
+    def __init__(self, max_speed=None):
+        """
+        max_speed is the drive's maximum read speed in kB/s, if known.
+        """
+        # The available speeds in kB/s, slowest first.  The fastest is
+        # always cdrom.binary.MAX_SPEED, which lets the drive pick.
+        self.speeds = [n * cdrom.KB_PER_SECOND_1X
+                       for n in self.DEFAULT_SPEEDS]
+        if max_speed is not None:
+            self.speeds = [speed for speed in self.speeds
+                           if speed < max_speed]
+        self.speeds.append(cdrom.binary.MAX_SPEED)
+        self.speedIndex = len(self.speeds) - 1
+
+        self.windowSectors = 10 * cdrom.FRAMES_PER_SECOND
+        self.maxWarnings = 4
+        self.stepUpWindows = 3
+
+        self.enabled = True
+        self.monitor = None
+        self.windowStart = None
+        self.windowWarnings = 0
+        self.windowErrors = 0
+        self.cleanWindows = 0
+
+    def getSpeed(self):
+        return self.speeds[self.speedIndex]
+
+    def getSpeedString(self, speed=None):
+        if speed is None:
+            speed = self.getSpeed()
+        if speed == cdrom.binary.MAX_SPEED:
+            return 'max'
+        return '%dx' % (speed / cdrom.KB_PER_SECOND_1X,)
+
+    def start(self, device, monitor, lba):
+        """
+        Start controlling the speed for a new rip.
+        """
+        self.monitor = monitor
+        if not self.enabled:
+            # Setting the speed failed on an earlier track, so leave the
+            # drive at whatever speed it picks.
+            return
+        self.startWindow(lba)
+        self.applySpeed(device)
+        monitor.log.info('Read speed: %s', self.getSpeedString())
+
+    def startWindow(self, lba):
+        self.windowStart = lba
+        self.windowWarnings = self.monitor.numWarnings
+        self.windowErrors = len(self.monitor.errors)
+
+    def update(self, device, lba):
+        """
+        Called after each read, with the sector the rip has now reached.
+        """
+        if not self.enabled or lba - self.windowStart < self.windowSectors:
+            return
+
+        warnings = self.monitor.numWarnings - self.windowWarnings
+        errors = len(self.monitor.errors) - self.windowErrors
+        if warnings < 0 or errors < 0:
+            # The monitor's counts were reset.  Start a new window.
+            self.startWindow(lba)
+            return
+
+        if errors > 0 or warnings >= self.maxWarnings:
+            self.cleanWindows = 0
+            if self.speedIndex > 0:
+                self.changeSpeed(device, self.speedIndex - 1, lba,
+                                 warnings, errors)
+        elif warnings == 0:
+            self.cleanWindows += 1
+            if (self.cleanWindows >= self.stepUpWindows and
+                self.speedIndex < len(self.speeds) - 1):
+                self.cleanWindows = 0
+                self.changeSpeed(device, self.speedIndex + 1, lba,
+                                 warnings, errors)
+
+        self.startWindow(lba)
+
+    def changeSpeed(self, device, index, lba, warnings, errors):
+        old_speed = self.getSpeedString()
+        self.speedIndex = index
+        self.monitor.log.info('Read speed changed from %s to %s at sector %d '
+                              '(%d warnings, %d errors in the last %d '
+                              'sectors)', old_speed, self.getSpeedString(),
+                              lba, warnings, errors, lba - self.windowStart)
+        self.monitor.output.log('Read speed %s' % (self.getSpeedString(),))
+        self.applySpeed(device)
+
+    def applySpeed(self, device):
+        try:
+            device.set_speed(self.getSpeed())
+        except scsi_sg.CheckConditionError, ex:
+            # Not all drives support SET CD SPEED.  Just leave the drive at
+            # whatever speed it picks.
+            self.monitor.log.warning('Unable to set read speed; disabling '
+                                     'speed control: %s', ex)
+            self.enabled = False
+
+
+class TestAndCopyRipper(object):
+    """
+    TestAndCopyRipper reads a track twice with a NativeRipper at full drive
+    speed, computing the CRC of both passes.
+
+    If the CRCs match, the data from the second pass is kept.  Only if they
+    differ (or if either pass reported uncorrected errors) is the track
+    ripped again with cdparanoia's full verification.  Both CRCs are recorded
+    in the monitor's log.
+    """
+    def __init__(self, device, track_number, start, end, output_path,
+                 monitor):
+        self.device = device
+        self.trackNumber = track_number
+        self.startSector = start
+        self.endSector = end
+        self.outputPath = output_path
+        self.monitor = monitor
+
+        self.cacheSectors = NativeRipper.DEFAULT_CACHE_SECTORS
+        self.readOffset = 0
+        self.leadOutSector = None
+        self.speedController = None
+        self.testCrc = None
+        self.copyCrc = None
+        self.usedParanoia = False
+
+    def run(self):
+        test = NativeRipper(self.device, self.startSector, self.endSector,
+                            None, self.monitor)
+        test.readOffset = self.readOffset
+        test.leadOutSector = self.leadOutSector
+        test.speedController = self.speedController
+        test.run()
+        self.testCrc = test.crc
+        self.monitor.log.info('Test CRC: %08X', self.testCrc)
+
+        copy = NativeRipper(self.device, self.startSector, self.endSector,
+                            self.outputPath, self.monitor)
+        copy.readOffset = self.readOffset
+        copy.leadOutSector = self.leadOutSector
+        copy.speedController = self.speedController
+        if self.cacheSectors > 0:
+            copy.defeatCache = True
+            copy.cacheSectors = self.cacheSectors
+        copy.run()
+        self.copyCrc = copy.crc
+        self.monitor.log.info('Copy CRC: %08X', self.copyCrc)
+
+        if self.testCrc == self.copyCrc and not self.monitor.errors:
+            self.monitor.output.log('Test and copy CRCs match: %08X' %
+                                    (self.copyCrc,))
+            return
+
+        self.monitor.output.log('Test CRC %08X does not match copy CRC %08X; '
+                                're-ripping with cdparanoia' %
+                                (self.testCrc, self.copyCrc))
+        self.monitor.log.warning('CRC mismatch; re-ripping with cdparanoia')
+        self.usedParanoia = True
+
+        # Only errors from the cdparanoia pass count now
+        self.monitor.resetErrors()
+        ripper = Ripper(self.device, self.trackNumber, self.outputPath,
+                        self.monitor)
+        ripper.readOffset = self.readOffset
+        ripper.run()
+
+
+class ContestedSectorReader(NativeRipper):
+    """
+    ContestedSectorReader re-reads the sectors of a merged track where the
+    merge inputs disagreed, as recorded in a rip_merge.DisagreementIndex.
+
+    Each contested sector is read copies more times (flushing the drive's
+    cache in between), and each of its samples is voted on again, using the
+    merged data plus the new reads.  Ties keep the merged data.  The merged
+    .wav file is updated in place, and the index is updated to list only the
+    samples that are still contested, or removed if there are none left.
+    """
+    DEFAULT_COPIES = 3
+
+    def __init__(self, device, start, end, output_path, monitor, index):
+        NativeRipper.__init__(self, device, start, end, output_path, monitor)
+        self.index = index
+        self.copies = self.DEFAULT_COPIES
+        self.defeatCache = True
+
+    def run(self):
+        batches = self.getBatches()
+        remaining = rip_merge.DisagreementIndex(self.index.path)
+        with cdrom.binary.Device(self.device) as device:
+            self.monitor.ripStart(self.startSector, self.endSector - 1)
+            # Read every contested sector once per pass, rather than reading
+            # each sector several times in a row, so that the drive's cache
+            # only has to be flushed once per pass.
+            reads = []
+            buf_len = (self.batchSectors + 1) * cdrom.BYTES_PER_FRAME
+            with cbuf.default_pool.buffer(buf_len) as buf:
+                for n in range(self.copies):
+                    if self.defeatCache and n > 0:
+                        self.flushCache(device)
+                    reads.append([self.readSectors(device, lba, count, buf)
+                                  for (lba, count) in batches])
+
+        with open(self.outputPath, 'r+b') as f:
+            for (n, (lba, count)) in enumerate(batches):
+                offset = (wav.HEADER_SIZE +
+                          (lba - self.startSector) * cdrom.BYTES_PER_FRAME)
+                f.seek(offset)
+                merged = f.read(count * cdrom.BYTES_PER_FRAME)
+                copies = [merged] + [copy[n] for copy in reads]
+                data = rip_merge.merge_samples(offset, copies, remaining,
+                                               cdrom.BYTES_PER_STEREO_SAMPLE)
+                if data != merged:
+                    f.seek(offset)
+                    f.write(data)
+                self.monitor.ripUpdate('wrote',
+                                       (lba + count) * cdrom.SAMPLES_PER_FRAME)
+
+        # Samples where the new reads all agreed are resolved, even if the
+        # old merged data disagreed with them.
+        self.index.ranges = [r for r in remaining.ranges
+                             if r.tie or r.bestCount < self.copies]
+        if self.index.ranges:
+            self.index.save()
+        else:
+            self.index.remove()
+        self.monitor.ripComplete()
+
+    def getBatches(self):
+        """
+        Get the contested sectors as a list of (lba, count) batches.
+        """
+        batches = []
+        sector_ranges = self.index.getSectorRanges(cdrom.BYTES_PER_FRAME,
+                                                   wav.HEADER_SIZE)
+        for (start, end) in sector_ranges:
+            lba = self.startSector + start
+            end_lba = min(self.startSector + end, self.endSector)
+            while lba < end_lba:
+                count = min(self.batchSectors, end_lba - lba)
+                batches.append((lba, count))
+                lba += count
+        return batches
+
+
+class DataTrackReader(object):
+    """
+    DataTrackReader copies the user data from a data track to a file, using
+    READ(10) commands.
+
+    Sectors are read in large batches.  If a batch fails, it is split in half
+    and each half is retried, down to single sectors.  Sectors that still
+    can't be read are reported to the monitor as skips and filled with zeros,
+    so the rest of the data stays at the correct offsets in the file.
+
+    Progress and errors are reported to the monitor using sample offsets, the
+    same way as for audio tracks, so the normal rip output can display them.
+    start and end are LBA sector addresses.  end is exclusive.
+
+    When the drive's sg device node can be opened, queueDepth READ commands
+    are kept outstanding at once, so the drive never sits idle waiting for
+    the next command.  Set queueDepth to 0 to issue one command at a time.
+    """
+    DEFAULT_BATCH_SECTORS = 64
+
+    def __init__(self, device, start, end, output_path, monitor):
+        self.device = device
+        self.startSector = start
+        self.endSector = end
+        self.outputPath = output_path
+        self.monitor = monitor
+
+        self.batchSectors = self.DEFAULT_BATCH_SECTORS
+        self.retries = 3
+        self.queueDepth = scsi_sg.DEFAULT_QUEUE_DEPTH
+
+    def run(self):
+        num_sectors = self.endSector - self.startSector
+        num_bytes = num_sectors * cdrom.BYTES_PER_DATA_SECTOR
+
+        fd = os.open(self.outputPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0666)
+        try:
+            file_util.preallocate(fd, num_bytes)
+            with cdrom.binary.Device(self.device) as device:
+                self.monitor.ripStart(self.startSector, self.endSector - 1)
+                start_time = time.time()
+
+                sg_fd = self.openQueueDevice()
+                if sg_fd is None:
+                    self.readAll(device, fd)
+                else:
+                    try:
+                        self.readAllQueued(device, fd, sg_fd)
+                    finally:
+                        os.close(sg_fd)
+
+                elapsed = time.time() - start_time
+                self.monitor.ripUpdate('finished', self.endSector *
+                                       cdrom.SAMPLES_PER_FRAME)
+        finally:
+            os.close(fd)
+
+        megabytes = num_bytes / (1024.0 * 1024.0)
+        rate = megabytes / max(elapsed, 0.001)
+        self.monitor.log.info('Read %d sectors (%.1f MB) in %.1f seconds: '
+                              '%.2f MB/s', num_sectors, megabytes, elapsed,
+                              rate)
+        self.monitor.output.log('Read %.1f MB at %.2f MB/s' %
+                                (megabytes, rate))
+        self.monitor.ripComplete()
+
+    def openQueueDevice(self):
+        if self.queueDepth <= 0:
+            return None
+        sg_path = scsi_sg.find_sg_device(self.device)
+        if sg_path is None:
+            return None
+        try:
+            return os.open(sg_path, os.O_RDWR)
+        except OSError, ex:
+            self.monitor.log.info('cannot open %s, reading one command at a '
+                                  'time: %s', sg_path, ex)
+            return None
+
+    def readAll(self, device, fd):
+        buf_len = self.batchSectors * cdrom.BYTES_PER_DATA_SECTOR
+        with cbuf.default_pool.buffer(buf_len) as buf:
+            lba = self.startSector
+            while lba < self.endSector:
+                count = min(self.batchSectors, self.endSector - lba)
+                self.readSectors(device, fd, lba, count, buf)
+                lba += count
+
+    def readAllQueued(self, device, fd, sg_fd):
+        queue = scsi_sg.CommandQueue(sg_fd, self.queueDepth)
+        reads = cdrom.binary.read_data_queued(queue, self.startSector,
+                                              self.endSector,
+                                              self.batchSectors)
+        try:
+            for (lba, count, buf, error) in reads:
+                offset = lba * cdrom.SAMPLES_PER_FRAME
+                if error is None:
+                    self.monitor.ripUpdate('read', offset)
+                    num_bytes = count * cdrom.BYTES_PER_DATA_SECTOR
+                    self.writeData(fd, lba, ctypes.string_at(buf.buf,
+                                                             num_bytes))
+                    self.monitor.ripUpdate('wrote', (lba + count) *
+                                           cdrom.SAMPLES_PER_FRAME)
+                    continue
+
+                if (not isinstance(error, scsi_sg.CheckConditionError) or
+                    not is_read_error(error)):
+                    raise error
+                # Re-read this batch one command at a time,
+                # so it can be split up around the bad sectors.
+                self.readSectors(device, fd, lba, count, buf)
+        finally:
+            reads.close()
+
+    def readSectors(self, device, fd, lba, count, buf):
+        offset = lba * cdrom.SAMPLES_PER_FRAME
+        self.monitor.ripUpdate('read', offset)
+        try:
+            cdrom.binary.read_data(device, lba, count, buf)
+        except scsi_sg.CheckConditionError, ex:
+            if not is_read_error(ex):
+                raise
+            if count > 1:
+                # Split the range in half, so that only the sectors the drive
+                # really can't read are lost.
+                half = count / 2
+                self.readSectors(device, fd, lba, half, buf)
+                self.readSectors(device, fd, lba + half, count - half, buf)
+                return
+            data = self.readSingleSector(device, lba, buf)
+        else:
+            data = ctypes.string_at(buf.buf,
+                                    count * cdrom.BYTES_PER_DATA_SECTOR)
+
+        self.writeData(fd, lba, data)
+        self.monitor.ripUpdate('wrote', (lba + count) *
+                               cdrom.SAMPLES_PER_FRAME)
+
+    def readSingleSector(self, device, lba, buf):
+        offset = lba * cdrom.SAMPLES_PER_FRAME
+        self.monitor.ripUpdate('transport error', offset)
+        for attempt in range(self.retries):
+            try:
+                cdrom.binary.read_data(device, lba, 1, buf)
+                return ctypes.string_at(buf.buf, cdrom.BYTES_PER_DATA_SECTOR)
+            except scsi_sg.CheckConditionError, ex:
+                if not is_read_error(ex):
+                    raise
+                self.monitor.ripUpdate('transport error', offset)
+
+        # Give up, and leave this sector zero-filled
+        self.monitor.ripUpdate('skip', offset)
+        return '\0' * cdrom.BYTES_PER_DATA_SECTOR
+
+    def writeData(self, fd, lba, data):
+        pos = (lba - self.startSector) * cdrom.BYTES_PER_DATA_SECTOR
+        os.lseek(fd, pos, os.SEEK_SET)
+        while data:
+            written = os.write(fd, data)
+            data = data[written:]
+
+
+def is_read_error(ex):
+    """
+    Returns True if a CheckConditionError from a READ command indicates a
+    problem reading the disc (as opposed to a problem with the command
+    itself, or the drive not being ready), and so is worth retrying.
+    """
+    if not isinstance(ex, scsi_sg.StdCheckConditionError):
+        return True
+    return ex.senseKey in (scsi_sg.SENSE_RECOVERED_ERROR,
+                           scsi_sg.SENSE_MEDIUM_ERROR,
+                           scsi_sg.SENSE_HARDWARE_ERROR,
+                           scsi_sg.SENSE_ABORTED_COMMAND)
+
+
+def is_out_of_range_error(ex):
+    """
+    Returns True if a CheckConditionError from a READ command indicates that
+    the drive refused to read the address, as most drives do for addresses
+    in the lead-out.
+    """
+    return (isinstance(ex, scsi_sg.StdCheckConditionError) and
+            ex.senseKey == scsi_sg.SENSE_ILLEGAL_REQUEST)
+
 
 class Monitor(object):
     def __init__(self, output, log=None):
@@ -148,6 +1311,8 @@ class Monitor(object):
     def ripStart(self, start, end):
         self.startSample = start * cdrom.constants.SAMPLES_PER_FRAME
         self.endSample = end * cdrom.constants.SAMPLES_PER_FRAME
+        self.readOffset = None
+        self.writeOffset = None
 
         self.log.info('Ripping from sector %d to %d (sample %d to %d)',
                       start, end, self.startSample, self.endSample)
@@ -179,6 +1344,17 @@ class Monitor(object):
             # Don't update again until minUpdateInterval has passed
             self.nextUpdateTime = self.now + self.minUpdateInterval
 
+    def resetErrors(self):
+        """
+        Forget about all errors and warnings seen so far.
+
+        This is used when a track is about to be ripped again from scratch.
+        """
+        self.printSuppressedWarnings()
+        self.errors = []
+        self.warningTypes = set()
+        self.numWarnings = 0
+
     def ripComplete(self):
         self.printSuppressedWarnings()
         self.log.info('Rip complete: %d errors, %d warnings',
@@ -258,6 +1434,22 @@ class Monitor(object):
         self.output.log('uncorrected %s @ %d' % (function, offset))
 
 
+def get_terminal_width(default=80):
+    """
+    Get the width of the terminal that stdout is connected to.
+
+    Returns default if stdout is not a terminal.
+    """
+    try:
+        data = fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, '\0' * 4)
+        (rows, columns) = struct.unpack('hh', data)
+    except (AttributeError, EnvironmentError, ValueError):
+        columns = 0
+    if columns <= 0:
+        return default
+    return columns
+
+
 class CliOutput(object):
     STATUS_NORMAL = ' '
     STATUS_WARNING = '*'
@@ -266,8 +1458,8 @@ class CliOutput(object):
 
     SPINNER_CHARS = r'/-\|'
 
-    def __init__(self):
-        self.progressWidth = 60
+    def __init__(self, width=60):
+        self.progressWidth = width
         self.progressBar = [self.STATUS_NORMAL] * self.progressWidth
         self.spinner_index = 0
 
@@ -276,13 +1468,15 @@ class CliOutput(object):
         self.end = end
         self.currentOffset = start
 
-    def redisplay(self):
+    def getStatusString(self):
         buf = self.progressBar[:]
         buf[self.getIndex(self.currentOffset)] = self.STATUS_READ_HEAD
 
         spinner = self.SPINNER_CHARS[self.spinner_index]
+        return '%s [%s]' % (spinner, ''.join(buf),)
 
-        sys.stdout.write('%s [%s]\r' % (spinner, ''.join(buf),))
+    def redisplay(self):
+        sys.stdout.write(self.getStatusString() + '\r')
         sys.stdout.flush()
 
     def updateProgress(self, offset):
@@ -323,6 +1517,114 @@ class CliOutput(object):
         sys.stdout.write('\n')
 
 
+class CliDisplay(object):
+    """
+    CliDisplay is used by the Archiver to print messages and to create the
+    progress output for each track it rips.
+
+    This is the normal display for a single drive.  See MultiCliDisplay for
+    showing several drives at once.
+    """
+    def message(self, msg):
+        print msg
+
+    def newTrackOutput(self):
+        return CliOutput()
+
+
+class MultiCliDisplay(object):
+    """
+    MultiCliDisplay shows the progress of rips on several drives at once.
+
+    All of the drives share a single status line.  Messages are printed above
+    it, prefixed with the name of the drive they came from.  Use getDrive() to
+    get the display object to give to each drive's Archiver.
+
+    The status line is fit to total_width columns, which defaults to the
+    width of the terminal.  (The last column is left empty, since some
+    terminals wrap as soon as it is written.)
+    """
+    def __init__(self, devices, total_width=None):
+        # Several threads will be writing to the display
+        self.lock = threading.RLock()
+        if total_width is None:
+            total_width = get_terminal_width() - 1
+        self.totalWidth = total_width
+        # Each drive's field is separated from the next by a space
+        field_width = (total_width - (len(devices) - 1)) / len(devices)
+        self.drives = [DriveCliDisplay(self, os.path.basename(device),
+                                       field_width)
+                       for device in devices]
+
+    def getDrive(self, index):
+        return self.drives[index]
+
+    def redisplay(self):
+        with self.lock:
+            status = ' '.join([d.getStatusString() for d in self.drives])
+            sys.stdout.write(status + '\r')
+            sys.stdout.flush()
+
+    def log(self, message):
+        with self.lock:
+            sys.stdout.write('%-*s\n' % (self.totalWidth, message))
+            self.redisplay()
+
+
+class DriveCliDisplay(object):
+    """
+    The display for a single drive in a MultiCliDisplay.
+
+    fieldWidth is the number of columns available for the drive's status.
+    The progress bar gets whatever is left after the drive name, the spinner
+    and the brackets, and the status is truncated if even that doesn't fit.
+    """
+    def __init__(self, parent, name, field_width):
+        self.parent = parent
+        self.name = name
+        self.fieldWidth = field_width
+        # '<name>:<spinner> [<progress>]'
+        self.width = max(1, field_width - len(name) - 5)
+        self.output = None
+
+    def message(self, msg):
+        self.parent.log('%s: %s' % (self.name, msg))
+
+    def newTrackOutput(self):
+        return DriveCliOutput(self, self.width)
+
+    def getStatusString(self):
+        if self.output is None:
+            status = '  [%s]' % (' ' * self.width,)
+        else:
+            status = self.output.getStatusString()
+        return ('%s:%s' % (self.name, status))[:self.fieldWidth]
+
+
+class DriveCliOutput(CliOutput):
+    """
+    The progress output for a track being ripped on one drive
+    of a MultiCliDisplay.
+    """
+    def __init__(self, drive, width):
+        CliOutput.__init__(self, width)
+        self.drive = drive
+
+    def initialize(self, start, end):
+        CliOutput.initialize(self, start, end)
+        # Start showing our progress in place of the previous track's
+        self.drive.output = self
+
+    def redisplay(self):
+        self.drive.parent.redisplay()
+
+    def log(self, message):
+        self.drive.message(message)
+
+    def finished(self):
+        self.drive.parent.redisplay()
+
+
 def rip_track(device, track_number, output_path, log=None):
     output = CliOutput()
     monitor = Monitor(output, log)
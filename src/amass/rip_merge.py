@@ -0,0 +1,808 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2011, Adam Simpkins
+#
+"""
+Merge several rips of the same audio data, choosing the most popular value
+for each sample.
+
+Rips made on different drives (or with different read offset settings) may be
+shifted by some number of samples, and rips that suffered from jitter may
+slip by a few samples partway through.  Before voting, each input is aligned
+against the first input (the reference), by searching it for exact copies of
+probe windows taken from the reference.  Later, whenever a block of an input
+differs from the reference, the block is searched for nearby in that input,
+and the input is re-aligned from that point on if it is found at a different
+offset.
+
+All of the inputs are memory-mapped.  Large windows are compared directly
+against each other (which runs at memcmp() speed, without copying any data),
+and only windows that differ are split up further, down to individual 4-byte
+stereo samples.  The output is written in large contiguous chunks.
+
+The inputs are split into chunks, which are aligned and merged independently
+of each other, so they can be processed on a pool of worker processes.  The
+workers only send back the samples where the merged output differs from the
+reference; the parent process copies everything else straight from the
+reference.
+
+If the inputs are .wav files, only the audio data after the header is
+aligned and merged.  The reference's header is copied to the output
+unchanged; otherwise the headers of shifted inputs could outvote it.
+
+The ranges where the inputs disagreed can be saved in a DisagreementIndex.
+This allows the contested ranges to be re-examined later (with more rips, or
+by re-reading the sectors from the disc) without voting over all of the data
+again.
+"""
+import errno
+import itertools
+import mmap
+import multiprocessing
+import os
+import struct
+
+from . import file_util
+from . import wav
+
+# CD audio is 16-bit stereo, so each sample is 4 bytes.
+# (This is defined here rather than using amass.cdrom, so that merging
+# doesn't require a usable CD-ROM driver.)
+SAMPLE_SIZE = 4
+
+DEFAULT_WINDOW_SIZE = 1024 * 1024
+# Windows that differ are checked in blocks of this size, and blocks that
+# differ are bisected down to the individual samples.
+DEFAULT_BLOCK_SIZE = 4096
+# The amount of data merged as a single independent unit of work
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+
+# The maximum initial offset between the inputs.  Drive read offsets are all
+# well within this range.
+DEFAULT_MAX_OFFSET = 5 * 2352
+# How far to search for a block that has slipped due to jitter, relative to
+# the input's current offset.
+DEFAULT_MAX_JITTER = 2352
+# The amount of data at the end of a differing block to check for signs
+# of a slip, before searching for the block elsewhere
+JITTER_CHECK_SIZE = 64
+# The maximum number of probe windows to try when finding the initial offsets
+DEFAULT_NUM_PROBES = 16
+
+# The disagreement index file starts with a header containing a magic
+# string and the format version, followed by one record per range.
+INDEX_MAGIC = 'AMDI'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('<4sH')
+# offset, length, best count, total votes, flags
+INDEX_RECORD = struct.Struct('<QIBBB')
+INDEX_FLAG_TIE = 0x01
+
+
+class MergeError(Exception):
+    pass
+
+
+class TieError(MergeError):
+    def __init__(self, offset, counts):
+        MergeError.__init__(self, 'tie at offset %d: %s' %
+                            (offset, format_counts(counts)))
+        self.offset = offset
+        self.counts = counts
+
+    def __reduce__(self):
+        # Allow TieErrors raised in worker processes to be sent back
+        return (TieError, (self.offset, self.counts))
+
+
+def format_counts(counts):
+    return ', '.join('%r x%d' % (value, count)
+                     for (value, count) in sorted(counts.iteritems()))
+
+
+class MergeInput(object):
+    """
+    A memory-mapped input file.
+
+    offset is the position of this input's data relative to the reference
+    input, in bytes: the data at position N in the reference corresponds to
+    position N + offset in this input.  dataStart is the size of the file
+    header (if any); the header is never treated as part of the data.
+    """
+    def __init__(self, path, data_start=0):
+        self.path = path
+        self.offset = 0
+        self.dataStart = data_start
+        self.file = open(path, 'rb')
+        self.length = os.fstat(self.file.fileno()).st_size
+        if self.length > 0:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        else:
+            # mmap() can't map empty files
+            self.map = ''
+
+    def covers(self, start, end):
+        """
+        Returns True if this input has data for the entire range from start
+        to end (in reference positions).
+        """
+        return (start + self.offset >= self.dataStart and
+                end + self.offset <= self.length)
+
+    def overlaps(self, start, end):
+        """
+        Returns True if this input has data for any part of the range from
+        start to end (in reference positions).
+        """
+        return (end + self.offset > self.dataStart and
+                start + self.offset < self.length)
+
+    def view(self, start, end):
+        """
+        Return a read-only view of the data for the specified range
+        (in reference positions), without copying it.
+        """
+        return buffer(self.map, start + self.offset, end - start)
+
+    def close(self):
+        if not isinstance(self.map, str):
+            self.map.close()
+        self.file.close()
+
+
+def get_data_start(path):
+    """
+    Get the offset of the audio data in a merge input: the size of the
+    header for .wav files, and 0 for raw audio data.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(12)
+    if header[:4] == 'RIFF' and header[8:] == 'WAVE':
+        return wav.HEADER_SIZE
+    return 0
+
+
+def vote(values):
+    """
+    Choose the most common value from a list.
+
+    Returns a tuple of (value, counts), where counts is a dictionary mapping
+    each value to the number of times it appeared.  Returns None for the
+    value if the most common values are tied.
+    """
+    counts = {}
+    for value in values:
+        counts[value] = counts.get(value, 0) + 1
+
+    best_count = max(counts.itervalues())
+    best = [value for (value, count) in counts.iteritems()
+            if count == best_count]
+    if len(best) != 1:
+        return (None, counts)
+    return (best[0], counts)
+
+
+def is_constant(data, sample_size=SAMPLE_SIZE):
+    """
+    Returns True if data consists of a single sample value repeated over and
+    over (e.g., silence).  Such data can't be used to find alignment offsets.
+    """
+    return data == data[:sample_size] * (len(data) / sample_size)
+
+
+def merge_samples(offset, copies, index=None, sample_size=SAMPLE_SIZE):
+    """
+    Vote on each sample of several equal-length copies of the same data.
+
+    Ties are resolved in favor of the first copy.  If index is specified, the
+    samples where the copies disagreed are added to it.  offset is the
+    position of the data, and is only used for the index.
+
+    Returns the merged data.
+    """
+    first = copies[0]
+    if all(copy == first for copy in copies[1:]):
+        return first
+
+    merged = []
+    for pos in xrange(0, len(first), sample_size):
+        samples = [copy[pos:pos + sample_size] for copy in copies]
+        (value, counts) = vote(samples)
+        if len(counts) > 1 and index is not None:
+            index.addSample(offset + pos, counts, value, sample_size)
+        if value is None:
+            value = samples[0]
+        merged.append(value)
+    return ''.join(merged)
+
+
+class Disagreement(object):
+    """
+    A range of samples where the inputs disagreed.
+
+    bestCount is the number of votes the chosen value received, out of
+    totalVotes.  tie is True if no single value received the most votes.
+    """
+    def __init__(self, offset, length, best_count, total_votes, tie=False):
+        self.offset = offset
+        self.length = length
+        self.bestCount = best_count
+        self.totalVotes = total_votes
+        self.tie = tie
+
+    @property
+    def end(self):
+        return self.offset + self.length
+
+    def __repr__(self):
+        return 'Disagreement(%r, %r, %r, %r, %r)' % \
+                (self.offset, self.length, self.bestCount, self.totalVotes,
+                 self.tie)
+
+
+class DisagreementIndex(object):
+    """
+    DisagreementIndex records the ranges where merge inputs disagreed, in a
+    compact binary file.
+
+    Offsets are byte offsets into the merged output.  Adjacent samples with
+    the same vote counts are stored as a single range.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.ranges = []
+
+    def load(self):
+        """
+        Load the index from disk.
+
+        Returns False if the index file does not exist.
+        """
+        try:
+            f = open(self.path, 'rb')
+        except IOError, ex:
+            if ex.errno == errno.ENOENT:
+                return False
+            raise
+
+        with f:
+            data = f.read()
+
+        if len(data) < INDEX_HEADER.size:
+            raise MergeError('%s is truncated' % (self.path,))
+        (magic, version) = INDEX_HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC:
+            raise MergeError('%s is not a disagreement index' % (self.path,))
+        if version != INDEX_VERSION:
+            raise MergeError('%s has unsupported version %d' %
+                             (self.path, version))
+
+        self.ranges = []
+        for pos in xrange(INDEX_HEADER.size, len(data), INDEX_RECORD.size):
+            if pos + INDEX_RECORD.size > len(data):
+                raise MergeError('%s is truncated' % (self.path,))
+            (offset, length, best_count, total_votes, flags) = \
+                    INDEX_RECORD.unpack_from(data, pos)
+            self.ranges.append(Disagreement(offset, length, best_count,
+                                            total_votes,
+                                            bool(flags & INDEX_FLAG_TIE)))
+        return True
+
+    def save(self):
+        # Write to a temporary file and rename it into place, so we never
+        # leave a truncated index behind.
+        file_util.prepare_new(self.path)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION))
+            for r in self.ranges:
+                flags = 0
+                if r.tie:
+                    flags |= INDEX_FLAG_TIE
+                f.write(INDEX_RECORD.pack(r.offset, r.length, r.bestCount,
+                                          r.totalVotes, flags))
+        os.rename(tmp_path, self.path)
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except OSError, ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+    def addSample(self, offset, counts, value, sample_size=SAMPLE_SIZE):
+        """
+        Add a disagreement for one sample.  Samples must be added in order.
+        """
+        total_votes = sum(counts.itervalues())
+        best_count = max(counts.itervalues())
+        tie = value is None
+        if self.ranges:
+            last = self.ranges[-1]
+            if (last.end == offset and last.bestCount == best_count and
+                last.totalVotes == total_votes and last.tie == tie):
+                last.length += sample_size
+                return
+        self.ranges.append(Disagreement(offset, sample_size, best_count,
+                                        total_votes, tie))
+
+    def getNumSamples(self, sample_size=SAMPLE_SIZE):
+        return sum(r.length for r in self.ranges) / sample_size
+
+    def getNumTies(self, sample_size=SAMPLE_SIZE):
+        return sum(r.length for r in self.ranges if r.tie) / sample_size
+
+    def getSectorRanges(self, sector_size, data_start=0):
+        """
+        Get the sectors that contain disagreements.
+
+        data_start is the offset of the first sector in the merged output
+        (e.g., the size of the WAV header).  Returns a list of
+        (start, end) sector number tuples.  end is exclusive.
+        """
+        sector_ranges = []
+        for r in self.ranges:
+            start = max(r.offset - data_start, 0) / sector_size
+            end = ((r.end - data_start + sector_size - 1) / sector_size)
+            if end <= start:
+                continue
+            if sector_ranges and sector_ranges[-1][1] >= start:
+                last_start = sector_ranges[-1][0]
+                sector_ranges[-1] = (last_start,
+                                     max(end, sector_ranges[-1][1]))
+            else:
+                sector_ranges.append((start, end))
+        return sector_ranges
+
+
+class ChunkResult(object):
+    """
+    The results of merging one chunk.
+
+    patches is a list of (offset, data) tuples, for each sample where the
+    merged data differs from the reference input.  differences is a list of
+    (offset, counts, value) tuples for each sample where the inputs
+    disagreed; value is None if the vote was tied.  offsets is a list of
+    (path, position, offset) tuples, recording the alignment of the inputs.
+    """
+    def __init__(self, start, end, ranges):
+        self.start = start
+        self.end = end
+        self.ranges = ranges
+        self.patches = []
+        self.differences = []
+        self.offsets = []
+
+
+class ChunkMerger(object):
+    """
+    ChunkMerger merges one chunk of the inputs.
+
+    Each chunk aligns the inputs itself, so chunks don't depend on each
+    other.  If ranges is specified, only those ranges within the chunk are
+    merged.  settings is a dictionary of Merger settings.
+    """
+    def __init__(self, paths, settings, start, end, ranges=None):
+        self.paths = paths
+        self.start = start
+        self.end = end
+        if ranges is None:
+            ranges = [(start, end)]
+            self.allRanges = True
+        else:
+            self.allRanges = False
+
+        self.windowSize = settings['windowSize']
+        self.blockSize = settings['blockSize']
+        self.sampleSize = settings['sampleSize']
+        self.maxOffset = settings['maxOffset']
+        self.maxJitter = settings['maxJitter']
+        self.numProbes = settings['numProbes']
+        self.allowTies = settings['allowTies']
+        self.dataStart = settings['dataStart']
+
+        self.inputs = None
+        self.result = ChunkResult(start, end, ranges)
+
+    def run(self):
+        self.inputs = [MergeInput(path, self.dataStart)
+                       for path in self.paths]
+        try:
+            if self.maxOffset > 0:
+                self.align()
+            for (start, end) in self.result.ranges:
+                if self.allRanges:
+                    for window_start in xrange(start, end, self.windowSize):
+                        self.mergeWindow(window_start,
+                                         min(window_start + self.windowSize,
+                                             end))
+                else:
+                    self.mergeBlocks(start, end)
+        finally:
+            for inp in self.inputs:
+                inp.close()
+            self.inputs = None
+        return self.result
+
+    def align(self):
+        """
+        Find the offset of each input relative to the reference, at the start
+        of this chunk.
+        """
+        ref = self.inputs[0]
+        for inp in self.inputs[1:]:
+            # Use the first probe that can be found in the input.  The
+            # probes are large enough that an exact match won't happen by
+            # chance.  Probes near the start are preferred: if the input
+            # slips partway through, it gets re-aligned when the merge
+            # reaches that point.
+            offset = None
+            for probe_start in self.getProbePositions():
+                probe = ref.map[probe_start:probe_start + self.blockSize]
+                if is_constant(probe, self.sampleSize):
+                    continue
+                offset = self.findOffset(inp, probe, probe_start, 0,
+                                         self.maxOffset)
+                if offset is not None:
+                    break
+
+            if offset is None:
+                if inp.length != ref.length:
+                    raise MergeError('unable to align %s with %s' %
+                                     (inp.path, ref.path))
+                # There was no usable probe data, (the reference is silent,
+                # or too short) or every probe had an error.  If the
+                # lengths match, assume the inputs are already aligned.
+                offset = 0
+
+            inp.offset = offset
+            self.result.offsets.append((inp.path, self.start, offset))
+
+    def getProbePositions(self):
+        length = self.inputs[0].length
+        # Leave room at either end of the reference, so that the probes
+        # can be found in the other inputs even if they are offset in
+        # either direction.
+        first = max(self.start,
+                    min(self.dataStart + self.maxOffset, length))
+        last = min(self.end, length - self.maxOffset) - self.blockSize
+        last = max(last, first)
+        step = max((last - first) / max(self.numProbes - 1, 1), 1)
+        step -= step % self.sampleSize
+        return xrange(first, last + 1, max(step, self.sampleSize))
+
+    def findOffset(self, inp, data, position, center, max_distance):
+        """
+        Search for data in an input, around the specified reference
+        position.
+
+        Returns the offset (closest to center) at which data appears in the
+        input, or None if it wasn't found within max_distance of center.
+        Only whole-sample offsets are considered.
+        """
+        low = max(position + center - max_distance, inp.dataStart)
+        high = min(position + center + max_distance + len(data), inp.length)
+        best = None
+        pos = inp.map.find(data, low, high)
+        while pos >= 0:
+            offset = pos - position
+            if offset % self.sampleSize == 0:
+                if best is None or abs(offset - center) < abs(best - center):
+                    best = offset
+            pos = inp.map.find(data, pos + 1, high)
+        return best
+
+    def mergeWindow(self, start, end):
+        if self.checkIdentical(start, end):
+            return
+        for block_start in xrange(start, end, self.blockSize):
+            block_end = min(block_start + self.blockSize, end)
+            if self.maxJitter > 0:
+                self.realign(block_start, block_end)
+            self.mergeRange(block_start, block_end)
+
+    def mergeBlocks(self, start, end):
+        for block_start in xrange(start, end, self.blockSize):
+            self.mergeRange(block_start, min(block_start + self.blockSize,
+                                             end))
+
+    def realign(self, start, end):
+        """
+        Check for inputs that have slipped relative to the reference in the
+        specified block, and update their offsets.
+        """
+        ref = self.inputs[0]
+        block = ref.view(start, end)
+        if is_constant(str(block), self.sampleSize):
+            return
+
+        # If an input slipped in this block, its data won't match at the
+        # end of the block.  Checking this first avoids searching for every
+        # block that just contains a read error.  (If the slip is right at
+        # the end of the block, it will be found in the next block.)
+        tail_start = max(end - JITTER_CHECK_SIZE, start)
+        tail = ref.view(tail_start, end)
+        for inp in self.inputs[1:]:
+            if not inp.covers(start, end) or inp.view(tail_start, end) == tail:
+                continue
+            offset = self.findOffset(inp, block, start, inp.offset,
+                                     self.maxJitter)
+            if offset is None or offset == inp.offset:
+                # Probably just a read error in one of the inputs
+                continue
+            inp.offset = offset
+            self.result.offsets.append((inp.path, start, offset))
+
+    def checkIdentical(self, start, end):
+        """
+        Returns True if all inputs are identical in the specified range.
+        """
+        first = self.inputs[0].view(start, end)
+        for inp in self.inputs[1:]:
+            if not inp.covers(start, end):
+                if inp.overlaps(start, end):
+                    # Split the range up until we reach the end of this
+                    # input's data
+                    return False
+                continue
+            if inp.view(start, end) != first:
+                return False
+        return True
+
+    def mergeRange(self, start, end):
+        if self.checkIdentical(start, end):
+            return
+
+        length = end - start
+        if length > self.sampleSize:
+            # Split in half (on a sample boundary), and check each half.
+            # Errors are usually scattered, so this narrows down on the
+            # differing samples with only a few comparisons each.
+            half = (length / 2) - ((length / 2) % self.sampleSize)
+            self.mergeRange(start, start + half)
+            self.mergeRange(start + half, end)
+            return
+
+        samples = [str(inp.view(start, end)) for inp in self.inputs
+                   if inp.covers(start, end)]
+        value = self.chooseSample(start, samples)
+        if value != samples[0]:
+            self.result.patches.append((start, value))
+
+    def chooseSample(self, offset, samples):
+        (value, counts) = vote(samples)
+        if len(counts) == 1:
+            # Only some inputs had data here, but they all agree
+            return value
+        self.result.differences.append((offset, counts, value))
+        if value is None:
+            if not self.allowTies:
+                raise TieError(offset, counts)
+            # Keep the reference's value
+            return samples[0]
+        return value
+
+
+def merge_chunk(args):
+    """
+    Merge a single chunk.  This is run in the worker processes.
+    """
+    (paths, settings, start, end, ranges) = args
+    return ChunkMerger(paths, settings, start, end, ranges).run()
+
+
+class Merger(object):
+    """
+    Merger merges several input files into one output file.
+
+    onDifference, if set, is called as onDifference(offset, counts, value)
+    for each sample where the inputs disagree.  value is None for ties.
+    Ties raise a TieError, unless allowTies is True, in which case the
+    reference's value is used.
+
+    onOffset, if set, is called as onOffset(path, position, offset) whenever
+    an input's offset relative to the reference is determined: once for each
+    input before merging starts (with a position of 0), and again each time
+    the input's alignment changes.  position and offset are in bytes.
+
+    Setting maxOffset to 0 disables alignment.  The inputs must then all be
+    the same length.
+
+    dataStart is the size of the header at the start of each input, which
+    is copied from the reference without being aligned or voted on.  If it
+    is None, it is detected from the reference: .wav files have a
+    wav.HEADER_SIZE header, and anything else is treated as raw audio.
+
+    If numJobs is greater than 1, chunks are merged on a pool of that many
+    worker processes.  If index is set to a DisagreementIndex, the ranges
+    where the inputs disagreed are added to it.
+    """
+    def __init__(self, paths, output):
+        self.paths = paths
+        self.output = output
+
+        self.windowSize = DEFAULT_WINDOW_SIZE
+        self.blockSize = DEFAULT_BLOCK_SIZE
+        self.chunkSize = DEFAULT_CHUNK_SIZE
+        self.sampleSize = SAMPLE_SIZE
+        self.maxOffset = DEFAULT_MAX_OFFSET
+        self.maxJitter = DEFAULT_MAX_JITTER
+        self.numProbes = DEFAULT_NUM_PROBES
+        self.allowTies = False
+        self.dataStart = None
+        self.numJobs = 1
+        self.index = None
+        self.onDifference = None
+        self.onOffset = None
+        self.onProgress = None
+
+        self.reference = None
+        self.inputOffsets = {}
+        self.pending = []
+        self.pendingLength = 0
+        self.numDifferences = 0
+
+    def run(self):
+        """
+        Merge all of the input data, writing it to the output file.
+        """
+        length = self.checkInputs()
+        tasks = [(start, min(start + self.chunkSize, length), None)
+                 for start in xrange(self.dataStart, length, self.chunkSize)]
+        self.mergeChunks(tasks, length, False)
+
+    def update(self, ranges):
+        """
+        Re-merge only the specified ranges, overwriting them in the output
+        file.  The output must be a seekable file containing the results of
+        an earlier merge.
+
+        ranges is a list of (start, end) byte offsets, such as the ranges
+        from a DisagreementIndex.  The ranges must be sample aligned.
+        """
+        length = self.checkInputs()
+        chunks = {}
+        for (start, end) in ranges:
+            start = max(start, self.dataStart)
+            end = min(end, length)
+            while start < end:
+                chunk_start = (start -
+                               (start - self.dataStart) % self.chunkSize)
+                part_end = min(end, chunk_start + self.chunkSize)
+                chunks.setdefault(chunk_start, []).append((start, part_end))
+                start = part_end
+
+        tasks = [(chunk_start, min(chunk_start + self.chunkSize, length),
+                  chunks[chunk_start])
+                 for chunk_start in sorted(chunks)]
+        self.mergeChunks(tasks, length, True)
+
+    def checkInputs(self):
+        # The output is the same length as the reference input.
+        # Other inputs may be longer or shorter, depending on their
+        # offset.  Inputs that don't cover part of the reference are
+        # just left out of the vote there.
+        if self.dataStart is None:
+            self.dataStart = get_data_start(self.paths[0])
+        lengths = [os.stat(path).st_size for path in self.paths]
+        if self.maxOffset <= 0:
+            for (path, length) in zip(self.paths[1:], lengths[1:]):
+                if length != lengths[0]:
+                    raise MergeError('%s is %d bytes long, but %s is %d '
+                                     'bytes long' %
+                                     (path, length, self.paths[0],
+                                      lengths[0]))
+        return lengths[0]
+
+    def getSettings(self):
+        return {
+            'windowSize': self.windowSize,
+            'blockSize': self.blockSize,
+            'sampleSize': self.sampleSize,
+            'maxOffset': self.maxOffset,
+            'maxJitter': self.maxJitter,
+            'numProbes': self.numProbes,
+            'allowTies': self.allowTies,
+            'dataStart': self.dataStart,
+        }
+
+    def mergeChunks(self, tasks, length, seek):
+        settings = self.getSettings()
+        args = [(self.paths, settings, start, end, ranges)
+                for (start, end, ranges) in tasks]
+
+        self.reference = MergeInput(self.paths[0])
+        pool = None
+        try:
+            if not seek:
+                self.write(self.reference.view(0, self.dataStart))
+            if self.numJobs > 1 and len(args) > 1:
+                pool = multiprocessing.Pool(min(self.numJobs, len(args)))
+                results = pool.imap(merge_chunk, args)
+            else:
+                results = itertools.imap(merge_chunk, args)
+
+            # Results are returned in order, so the output is written
+            # sequentially even though chunks finish out of order.
+            for result in results:
+                self.processResult(result, seek)
+                if self.onProgress is not None:
+                    self.onProgress(result.end, length)
+            self.flush()
+
+            if pool is not None:
+                pool.close()
+                pool.join()
+                pool = None
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            self.reference.close()
+            self.reference = None
+
+    def processResult(self, result, seek):
+        for (path, position, offset) in result.offsets:
+            if self.inputOffsets.get(path) == offset:
+                continue
+            self.inputOffsets[path] = offset
+            if self.onOffset is not None:
+                self.onOffset(path, position, offset)
+
+        for (offset, counts, value) in result.differences:
+            self.numDifferences += 1
+            if self.index is not None:
+                self.index.addSample(offset, counts, value, self.sampleSize)
+            if self.onDifference is not None:
+                self.onDifference(offset, counts, value)
+
+        # Copy everything else straight from the reference
+        patches = iter(result.patches)
+        patch = next(patches, None)
+        for (start, end) in result.ranges:
+            if seek:
+                self.flush()
+                self.output.seek(start)
+            pos = start
+            while patch is not None and patch[0] < end:
+                (patch_offset, data) = patch
+                if patch_offset > pos:
+                    self.write(self.reference.view(pos, patch_offset))
+                self.write(data)
+                pos = patch_offset + len(data)
+                patch = next(patches, None)
+            if pos < end:
+                self.write(self.reference.view(pos, end))
+
+    def write(self, data):
+        if len(data) >= self.windowSize:
+            # Write large pieces directly, without copying them
+            self.flush()
+            self.output.write(data)
+            return
+
+        # Batch up small pieces, so the output is written in large
+        # contiguous chunks.
+        self.pending.append(str(data))
+        self.pendingLength += len(data)
+        if self.pendingLength >= self.windowSize:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.output.write(''.join(self.pending))
+        self.pending = []
+        self.pendingLength = 0
+
+
+def merge_files(paths, output, num_jobs=1):
+    """
+    Merge the input files, writing the result to the output file object.
+
+    Returns the number of samples where the inputs disagreed.
+    """
+    merger = Merger(paths, output)
+    merger.numJobs = num_jobs
+    merger.run()
+    return merger.numDifferences
@@ -2,9 +2,17 @@
 #
 # Copyright (c) 2009, Adam Simpkins
 #
+import array
 import ctypes
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
 
 from . import cbuf
+from . import scsi_stats
 
 # Constants from scsi/sg.h
 SG_DXFER_NONE = -1
@@ -14,6 +22,17 @@ SG_DXFER_TO_FROM_DEV = -3
 SG_DXFER_UNKNOWN = -5
 
 SG_IO = 0x2285
+SG_GET_RESERVED_SIZE = 0x2272
+SG_SET_RESERVED_SIZE = 0x2275
+SG_SET_FORCE_PACK_ID = 0x227b
+
+# Flags for sg_io_hdr_t.flags
+SG_FLAG_DIRECT_IO = 0x1
+SG_FLAG_MMAP_IO = 0x4
+
+# The number of commands CommandQueue keeps outstanding by default.
+# (The sg driver allows up to 16 per file descriptor.)
+DEFAULT_QUEUE_DEPTH = 4
 
 
 STATUS_SUCCESS = 0x0
@@ -296,18 +315,23 @@ _libc = None
 def _get_libc():
     global _libc
     if _libc is None:
-        _libc = ctypes.cdll.LoadLibrary('libc.so.6')
+        _libc = ctypes.CDLL('libc.so.6', use_errno=True)
     return _libc
 
 
+def _check_errno(ret, name):
+    if ret < 0:
+        errnum = ctypes.get_errno()
+        raise OSError(errnum, '%s: %s' % (name, os.strerror(errnum)))
+    return ret
+
+
 def call_sg_io(fd, sg_io_hdr):
     libc = _get_libc()
-    libc.ioctl(fd, SG_IO, ctypes.pointer(sg_io_hdr))
+    _check_errno(libc.ioctl(fd, SG_IO, ctypes.pointer(sg_io_hdr)), 'SG_IO')
 
 
-def sg_cmd(fd, direction, cmd, dxfer, sense_len=0xff, timeout=5000):
-    # Set up the sg_io_hdr_t
-    sg_io_hdr = SgIoHdr()
+def _init_sg_io_hdr(sg_io_hdr, direction, cmd, dxfer, sense, timeout):
     sg_io_hdr.interface_id = ord('S')
     sg_io_hdr.dxfer_direction = direction
 
@@ -317,30 +341,379 @@ def sg_cmd(fd, direction, cmd, dxfer, sense_len=0xff, timeout=5000):
     sg_io_hdr.cmd_len = cmd_len
     sg_io_hdr.cmdp = ctypes.cast(ctypes.pointer(cmd), ctypes.c_void_p)
 
-    sg_io_hdr.dxfer_len = ctypes.sizeof(dxfer)
-    sg_io_hdr.dxferp = ctypes.cast(ctypes.pointer(dxfer), ctypes.c_void_p)
+    if dxfer is None:
+        # A command with no data transfer, such as SG_DXFER_NONE
+        sg_io_hdr.dxfer_len = 0
+    else:
+        sg_io_hdr.dxfer_len = ctypes.sizeof(dxfer)
+        sg_io_hdr.dxferp = ctypes.cast(ctypes.pointer(dxfer),
+                                       ctypes.c_void_p)
 
-    if sense_len <= 0:
+    if sense is None:
         sg_io_hdr.mx_sb_len = 0
-        sense = None
-    elif sense_len <= 0xff:
-        sg_io_hdr.mx_sb_len = sense_len
-        sense = cbuf.CBuffer(sense_len)
+    else:
+        sg_io_hdr.mx_sb_len = len(sense)
         sg_io_hdr.sbp = ctypes.cast(ctypes.pointer(sense.buf), ctypes.c_void_p)
+
+    sg_io_hdr.timeout = timeout
+
+
+def _get_sense_buffer(sense_len):
+    if sense_len <= 0:
+        return None
+    elif sense_len <= 0xff:
+        return cbuf.default_pool.get(sense_len)
     else:
         raise ValueError('sense length too large: %d > 0xff' % (sense_len,))
 
-    sg_io_hdr.timeout = timeout
 
-    # Make the actual SG_IO call
-    call_sg_io(fd, sg_io_hdr)
+_stats = threading.local()
+
 
+def enable_stats(stats=None):
+    """
+    Record statistics about each command issued by the current thread.
+
+    stats is the scsi_stats.CommandStats object to record the commands in.
+    If it is None, a new one is created.  Returns the CommandStats object.
+    """
+    if stats is None:
+        stats = scsi_stats.CommandStats()
+    _stats.stats = stats
+    return stats
+
+
+def disable_stats():
+    _stats.stats = None
+
+
+def get_stats():
+    """
+    Get the CommandStats object for the current thread, or None if
+    statistics are not enabled.
+    """
+    return getattr(_stats, 'stats', None)
+
+
+def _record_stats(stats, sg_io_hdr, cmd, sense, start_time):
+    sense_key = None
+    if (sg_io_hdr.status == STATUS_CHECK_CONDITION and
+        sg_io_hdr.sb_len_wr >= 3):
+        sense_key = sense.getU8(2) & 0x0f
+    stats.record(cmd[0], sg_io_hdr.dxfer_len - sg_io_hdr.resid,
+                 sg_io_hdr.duration, time.time() - start_time,
+                 sg_io_hdr.status, sense_key)
+
+
+def _check_status(sg_io_hdr, sense):
     # Raise an exception if the status is not STATUS_SUCCESS
     if sg_io_hdr.status == STATUS_CHECK_CONDITION:
         # sg_io_hdr.sb_len_wr contains the length of data written to the
         # sense buffer.  Create a new CBuffer that only contains the valid
-        # sense data.
+        # sense data.  (The sense buffer itself goes back to the pool.)
         valid_sense = cbuf.CBuffer(sense[0:sg_io_hdr.sb_len_wr])
         raise_check_condition_err(valid_sense)
     elif sg_io_hdr.status != STATUS_SUCCESS:
         raise ScsiError(sg_io_hdr.status)
+
+
+def sg_cmd(fd, direction, cmd, dxfer, sense_len=0xff, timeout=5000):
+    sense = _get_sense_buffer(sense_len)
+    try:
+        # Set up the sg_io_hdr_t
+        sg_io_hdr = SgIoHdr()
+        _init_sg_io_hdr(sg_io_hdr, direction, cmd, dxfer, sense, timeout)
+
+        # Make the actual SG_IO call
+        stats = get_stats()
+        if stats is None:
+            call_sg_io(fd, sg_io_hdr)
+        else:
+            start_time = time.time()
+            call_sg_io(fd, sg_io_hdr)
+            _record_stats(stats, sg_io_hdr, cmd, sense, start_time)
+        _check_status(sg_io_hdr, sense)
+    finally:
+        if sense is not None:
+            cbuf.default_pool.put(sense)
+
+
+def find_sg_device(path):
+    """
+    Find the sg device node for a SCSI device, such as /dev/sr0.
+
+    The asynchronous interface used by CommandQueue is only available
+    through the sg device nodes, not the normal block devices.
+
+    Returns the path to the sg device, or None if it can't be found.
+    """
+    path = os.path.realpath(path)
+    name = os.path.basename(path)
+    if name.startswith('sg'):
+        return path
+
+    sysfs_dir = os.path.join('/sys/class/block', name, 'device',
+                             'scsi_generic')
+    try:
+        entries = os.listdir(sysfs_dir)
+    except OSError:
+        return None
+    for entry in entries:
+        sg_path = os.path.join('/dev', entry)
+        if os.path.exists(sg_path):
+            return sg_path
+    return None
+
+
+class ReservedBuffer(object):
+    """
+    The sg driver's reserved buffer for a file descriptor, mapped into our
+    address space.
+
+    Commands issued with sgCmd() use SG_FLAG_MMAP_IO: the drive's data is
+    transferred into the reserved buffer, and can be accessed through the
+    mapping without the driver copying it to a separate user buffer.  The
+    data is overwritten by the next command, so views of it are only valid
+    until then.
+
+    fd must be open read-write on an sg device node (see find_sg_device()).
+    The driver may limit the reserved buffer to less than the requested size;
+    the actual size is available as the size attribute.  Only one command
+    can use the reserved buffer at a time, so it can't be used with several
+    commands outstanding in a CommandQueue.
+    """
+    def __init__(self, fd, size):
+        self.fd = fd
+        fcntl.ioctl(self.fd, SG_SET_RESERVED_SIZE, struct.pack('i', size))
+        actual = array.array('i', [0])
+        fcntl.ioctl(self.fd, SG_GET_RESERVED_SIZE, actual, True)
+        self.size = actual[0]
+
+        self.map = mmap.mmap(self.fd, self.size, mmap.MAP_SHARED,
+                             mmap.PROT_READ | mmap.PROT_WRITE)
+        self.data = cbuf.CBuffer(self.map)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ex_type, ex_value, ex_traceback):
+        self.close()
+
+    def close(self):
+        if self.map is not None:
+            self.data = None
+            self.map.close()
+            self.map = None
+
+    def sgCmd(self, direction, cmd, length, sense_len=0xff, timeout=5000):
+        """
+        Issue a command that transfers length bytes through the reserved
+        buffer.
+
+        Returns the number of bytes actually transferred.
+        """
+        if length > self.size:
+            raise ValueError('transfer length %d is larger than the '
+                             'reserved buffer (%d bytes)' %
+                             (length, self.size))
+
+        sense = _get_sense_buffer(sense_len)
+        try:
+            sg_io_hdr = SgIoHdr()
+            _init_sg_io_hdr(sg_io_hdr, direction, cmd, None, sense, timeout)
+            sg_io_hdr.dxfer_len = length
+            sg_io_hdr.flags = SG_FLAG_MMAP_IO
+
+            stats = get_stats()
+            if stats is None:
+                call_sg_io(self.fd, sg_io_hdr)
+            else:
+                start_time = time.time()
+                call_sg_io(self.fd, sg_io_hdr)
+                _record_stats(stats, sg_io_hdr, cmd, sense, start_time)
+            _check_status(sg_io_hdr, sense)
+        finally:
+            if sense is not None:
+                cbuf.default_pool.put(sense)
+        return length - sg_io_hdr.resid
+
+    def view(self, start=0, end=None):
+        """
+        Get part of the reserved buffer as a memoryview, without copying it.
+        """
+        return self.data.view(start, end)
+
+    def getBuffer(self, start, end):
+        """
+        Get part of the reserved buffer as a read-only buffer object, without
+        copying it.
+
+        Unlike a memoryview, this can be passed to functions that accept
+        strings, such as zlib.crc32() and file.write().
+        """
+        return buffer(self.map, start, end - start)
+
+
+class QueuedCommand(object):
+    """
+    A command submitted to a CommandQueue.
+
+    context is an arbitrary value supplied by the caller when the command was
+    submitted.  Once the command has completed, error contains the exception
+    for the command's status (a ScsiError or CheckConditionError), or None if
+    the command succeeded.
+    """
+    def __init__(self, pack_id, cmd, dxfer, sense, context):
+        self.packId = pack_id
+        # The sg driver only has pointers to cmd, dxfer and sense,
+        # so references to them must be kept until the command completes.
+        self.cmd = cmd
+        self.dxfer = dxfer
+        self.sense = sense
+        self.context = context
+        self.completed = False
+        self.error = None
+        self.submitTime = None
+
+    def check(self):
+        """
+        Raise the command's error, if it failed.
+        """
+        if self.error is not None:
+            raise self.error
+
+
+class CommandQueue(object):
+    """
+    CommandQueue issues commands using the sg driver's asynchronous
+    write()/read() interface, so that several commands can be outstanding at
+    once.  While the host is processing the data from one command, the drive
+    can already be working on the next ones.
+
+    fd must be open read-write on an sg device node (see find_sg_device()).
+    Each command is tagged with a pack_id, and wait() retrieves the result for
+    a particular command.
+    """
+    def __init__(self, fd, depth=DEFAULT_QUEUE_DEPTH):
+        self.fd = fd
+        self.depth = depth
+        self.nextPackId = 0
+        self.outstanding = {}
+
+        # Make read() return the result for the pack_id we ask for,
+        # rather than for whichever command finished first.
+        self.setForcePackId()
+
+    def setForcePackId(self):
+        fcntl.ioctl(self.fd, SG_SET_FORCE_PACK_ID, struct.pack('i', 1))
+
+    def sendHeader(self, sg_io_hdr):
+        libc = _get_libc()
+        _check_errno(libc.write(self.fd, ctypes.byref(sg_io_hdr),
+                                ctypes.sizeof(sg_io_hdr)), 'write')
+
+    def receiveHeader(self, sg_io_hdr):
+        libc = _get_libc()
+        _check_errno(libc.read(self.fd, ctypes.byref(sg_io_hdr),
+                               ctypes.sizeof(sg_io_hdr)), 'read')
+
+    def __len__(self):
+        return len(self.outstanding)
+
+    def isFull(self):
+        return len(self.outstanding) >= self.depth
+
+    def submit(self, direction, cmd, dxfer, context=None, sense_len=0xff,
+               timeout=5000):
+        """
+        Submit a command, without waiting for it to complete.
+
+        Returns a QueuedCommand object.
+        """
+        pack_id = self.nextPackId
+        self.nextPackId = (self.nextPackId + 1) & 0x7fffffff
+
+        sense = _get_sense_buffer(sense_len)
+        command = QueuedCommand(pack_id, cmd, dxfer, sense, context)
+        sg_io_hdr = SgIoHdr()
+        _init_sg_io_hdr(sg_io_hdr, direction, cmd, dxfer, sense, timeout)
+        sg_io_hdr.pack_id = pack_id
+
+        command.submitTime = time.time()
+        try:
+            self.sendHeader(sg_io_hdr)
+        except:
+            if sense is not None:
+                cbuf.default_pool.put(sense)
+            raise
+        self.outstanding[pack_id] = command
+        return command
+
+    def wait(self, command):
+        """
+        Wait for a command to complete.
+
+        Sets command.error if the command failed.  Returns the command.
+        """
+        sg_io_hdr = SgIoHdr()
+        sg_io_hdr.interface_id = ord('S')
+        sg_io_hdr.pack_id = command.packId
+        self.receiveHeader(sg_io_hdr)
+
+        del self.outstanding[command.packId]
+        command.completed = True
+        # The wall clock time for a queued command includes the time it
+        # spent waiting behind the other outstanding commands.
+        stats = get_stats()
+        if stats is not None:
+            _record_stats(stats, sg_io_hdr, command.cmd, command.sense,
+                          command.submitTime)
+        try:
+            _check_status(sg_io_hdr, command.sense)
+        except ScsiError, ex:
+            command.error = ex
+        finally:
+            if command.sense is not None:
+                cbuf.default_pool.put(command.sense)
+                command.sense = None
+        return command
+
+    def drain(self):
+        """
+        Wait for all outstanding commands to complete, discarding the results.
+        """
+        for command in sorted(self.outstanding.values(),
+                              key=lambda c: c.packId):
+            self.wait(command)
+
+    def run(self, commands, timeout=5000):
+        """
+        Run a sequence of commands, keeping up to depth of them outstanding.
+
+        commands is an iterable of (direction, cmd, dxfer, context) tuples.
+        It is consumed lazily, so it may allocate each dxfer buffer only when
+        it is needed.
+
+        This is a generator, which yields each QueuedCommand once it has
+        completed, in the order that they were submitted.  Failed commands are
+        yielded too, with their error attribute set.  If the caller stops
+        before the end, the remaining commands are waited for and discarded.
+        """
+        pending = []
+        commands = iter(commands)
+        try:
+            while True:
+                while len(pending) < self.depth:
+                    try:
+                        (direction, cmd, dxfer, context) = commands.next()
+                    except StopIteration:
+                        break
+                    pending.append(self.submit(direction, cmd, dxfer,
+                                               context, timeout=timeout))
+                if not pending:
+                    break
+
+                command = pending.pop(0)
+                yield self.wait(command)
+        finally:
+            self.drain()
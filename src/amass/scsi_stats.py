@@ -0,0 +1,243 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2011, Adam Simpkins
+#
+"""
+Statistics about the SCSI commands sent to a drive.
+
+scsi_sg records every command it issues into the CommandStats object enabled
+for the current thread, if any (see scsi_sg.enable_stats()).  For each command
+opcode this tracks the number of commands, the number of bytes transferred,
+the resulting SCSI status and sense key, and histograms of the command
+latency.  Two latencies are tracked: the time the sg driver reports for the
+command (the duration field of sg_io_hdr_t), and the wall clock time we spent
+waiting for it.  A large gap between the two means the time is being lost
+outside of the drive, either in the kernel or in our own code.
+
+The histograms keep both totals and the last minute or so of data, so a dump
+taken while the drive is struggling shows the current behavior as well as
+the overall picture.  Recording a command costs a few dictionary and list
+updates, so the statistics are cheap enough to leave enabled.
+"""
+
+import json
+import threading
+import time
+
+# The number of histogram buckets.  Bucket N holds values less than 2**N
+# microseconds, so the last bucket holds everything 2**30 us (about 18
+# minutes) and above.
+NUM_BUCKETS = 31
+
+DEFAULT_SLICE_SECONDS = 10
+DEFAULT_NUM_SLICES = 6
+
+
+def _get_bucket(value):
+    if value <= 0:
+        return 0
+    return min(int(value).bit_length(), NUM_BUCKETS - 1)
+
+
+class Histogram(object):
+    """
+    A histogram of latencies, in microseconds, with power-of-two buckets.
+    """
+    def __init__(self):
+        self.buckets = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.buckets[_get_bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for (n, count) in enumerate(other.buckets):
+            self.buckets[n] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or
+                                      other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or
+                                      other.max > self.max):
+            self.max = other.max
+
+    def getPercentile(self, percent):
+        """
+        Get an upper bound for the specified percentile, in microseconds.
+
+        The result is only as precise as the bucket boundaries.
+        """
+        if self.count == 0:
+            return None
+        threshold = self.count * percent / 100.0
+        seen = 0
+        for (n, count) in enumerate(self.buckets):
+            seen += count
+            if seen >= threshold:
+                return min(1 << n, self.max)
+        return self.max
+
+    def toJson(self):
+        if self.count:
+            mean = self.total / float(self.count)
+        else:
+            mean = None
+        # Only include the non-empty buckets, keyed by their upper bound
+        buckets = dict(('<%d' % (1 << n,), count)
+                       for (n, count) in enumerate(self.buckets) if count)
+        return {
+            'count': self.count,
+            'min_us': self.min,
+            'max_us': self.max,
+            'mean_us': mean,
+            'p50_us': self.getPercentile(50),
+            'p99_us': self.getPercentile(99),
+            'buckets': buckets,
+        }
+
+
+class RollingHistogram(object):
+    """
+    A Histogram of all values, plus a Histogram of just the recent values.
+
+    The recent data is kept in numSlices slices of sliceSeconds each.  Once
+    a slice is older than that, it is dropped from the recent data.
+    """
+    def __init__(self, slice_seconds=DEFAULT_SLICE_SECONDS,
+                 num_slices=DEFAULT_NUM_SLICES):
+        self.sliceSeconds = slice_seconds
+        self.numSlices = num_slices
+        self.total = Histogram()
+        # A list of (slice_number, Histogram), oldest first
+        self.slices = []
+
+    def add(self, value, now):
+        self.total.add(value)
+
+        slice_number = int(now / self.sliceSeconds)
+        if not self.slices or self.slices[-1][0] != slice_number:
+            self.slices.append((slice_number, Histogram()))
+            if len(self.slices) > self.numSlices:
+                del self.slices[0]
+        self.slices[-1][1].add(value)
+
+    def getRecent(self, now):
+        oldest = int(now / self.sliceSeconds) - self.numSlices + 1
+        recent = Histogram()
+        for (slice_number, hist) in self.slices:
+            if slice_number >= oldest:
+                recent.merge(hist)
+        return recent
+
+    def toJson(self, now):
+        return {
+            'total': self.total.toJson(),
+            'recent': self.getRecent(now).toJson(),
+        }
+
+
+class OpcodeStats(object):
+    """
+    Statistics for all of the commands with a particular opcode.
+    """
+    def __init__(self, opcode):
+        self.opcode = opcode
+        self.count = 0
+        self.bytes = 0
+        # The total wall clock time spent in these commands, in microseconds
+        self.wallTime = 0
+        # Maps SCSI status to the number of commands that returned it
+        self.statuses = {}
+        # Maps sense key to the number of CHECK CONDITION errors with it
+        self.senseKeys = {}
+        self.driverLatency = RollingHistogram()
+        self.wallLatency = RollingHistogram()
+
+    def toJson(self, now):
+        if self.wallTime:
+            bytes_per_second = self.bytes * 1000000.0 / self.wallTime
+        else:
+            bytes_per_second = None
+        return {
+            'opcode': '0x%02x' % (self.opcode,),
+            'count': self.count,
+            'bytes': self.bytes,
+            'bytes_per_second': bytes_per_second,
+            'statuses': dict(('0x%02x' % (status,), count)
+                             for (status, count) in self.statuses.iteritems()),
+            'sense_keys': dict(('0x%x' % (key,), count)
+                               for (key, count) in self.senseKeys.iteritems()),
+            'driver_latency': self.driverLatency.toJson(now),
+            'wall_latency': self.wallLatency.toJson(now),
+        }
+
+
+class CommandStats(object):
+    """
+    Statistics for all of the SCSI commands issued by a thread.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.opcodes = {}
+            self.startTime = time.time()
+
+    def record(self, opcode, length, duration_ms, wall_seconds, status,
+               sense_key=None):
+        """
+        Record a command.
+
+        duration_ms is the duration reported by the sg driver, in
+        milliseconds.  wall_seconds is the wall clock time spent waiting for
+        the command.  sense_key should be supplied for commands that failed
+        with a CHECK CONDITION status.
+        """
+        now = time.time()
+        wall_us = int(wall_seconds * 1000000)
+        with self.lock:
+            stats = self.opcodes.get(opcode)
+            if stats is None:
+                stats = OpcodeStats(opcode)
+                self.opcodes[opcode] = stats
+
+            stats.count += 1
+            stats.bytes += length
+            stats.wallTime += wall_us
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            if sense_key is not None:
+                stats.senseKeys[sense_key] = \
+                        stats.senseKeys.get(sense_key, 0) + 1
+            stats.driverLatency.add(duration_ms * 1000, now)
+            stats.wallLatency.add(wall_us, now)
+
+    def toJson(self):
+        now = time.time()
+        with self.lock:
+            return {
+                'start_time': self.startTime,
+                'end_time': now,
+                'opcodes': [self.opcodes[opcode].toJson(now)
+                            for opcode in sorted(self.opcodes)],
+            }
+
+    def dump(self, path):
+        """
+        Write the statistics to a file, as JSON.
+        """
+        data = self.toJson()
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.write('\n')
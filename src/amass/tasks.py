@@ -0,0 +1,543 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2011, Adam Simpkins
+#
+"""
+Generator-based tasks, run on the MultiProcRunner epoll loop.
+
+A task is a generator.  Whenever it needs to wait for something it yields a
+Future, and it is resumed with the Future's result once the Future is done.
+If the Future failed, the exception is raised inside the generator instead.
+A task can finish with a result by raising Return(value).  For example:
+
+    def encode(scheduler, wav_path, flac_path):
+        child = scheduler.spawn(['flac', '-o', flac_path, wav_path])
+        while True:
+            line = yield child.readLine()
+            if line is None:
+                break
+            (stream, text) = line
+            ...
+        status = yield child.wait()
+        raise tasks.Return(status)
+
+    tasks.run(encode)
+
+This lets a single thread supervise many rips and encodes at once.  They can
+be combined with gather(), and the number running at once can be limited
+with a Semaphore.
+
+Every process belongs to the task that spawned it.  If the task finishes or is
+cancelled while the process is still running, the process is killed.
+Cancelling a task raises TaskCancelledError inside its generator, at the
+point where it is waiting.  A task that is cancelled while waiting on a
+gather() also cancels the tasks it was gathering.
+"""
+
+import collections
+import sys
+
+from . import proc
+
+
+class TaskCancelledError(Exception):
+    def __str__(self):
+        return 'task cancelled'
+
+
+class TaskDeadlockError(Exception):
+    def __init__(self, num_tasks):
+        Exception.__init__(self)
+        self.numTasks = num_tasks
+
+    def __str__(self):
+        return ('%d tasks are still waiting, but no processes are running' %
+                (self.numTasks,))
+
+
+class Return(Exception):
+    """
+    Raise Return(value) inside a task to finish it with a result.
+
+    (Python 2 generators cannot return a value.)
+    """
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+
+class Future(object):
+    """
+    A Future holds the result of an operation that may not have finished yet.
+    """
+    def __init__(self):
+        self.finished = False
+        self.value = None
+        self.excInfo = None
+        self.callbacks = []
+
+    def done(self):
+        return self.finished
+
+    def failed(self):
+        return self.excInfo is not None
+
+    def getResult(self):
+        """
+        Get the result.
+
+        If the operation failed, the exception is re-raised here, with its
+        original traceback.
+        """
+        if not self.finished:
+            raise ValueError('the operation has not finished yet')
+        if self.excInfo is not None:
+            (ex_type, ex_value, ex_traceback) = self.excInfo
+            raise ex_type, ex_value, ex_traceback
+        return self.value
+
+    def setResult(self, value=None):
+        self._finish(value, None)
+
+    def setError(self, exc_info=None):
+        """
+        Mark the operation as failed.
+
+        exc_info is a sys.exc_info() tuple, and defaults to the exception
+        currently being handled.
+        """
+        if exc_info is None:
+            exc_info = sys.exc_info()
+        self._finish(None, exc_info)
+
+    def cancel(self):
+        """
+        Cancel the operation.
+
+        Returns False if the operation has already finished.
+        """
+        if self.finished:
+            return False
+        self.setError(_cancelled_error())
+        return True
+
+    def addCallback(self, callback):
+        """
+        Call callback(future) once the future is done.
+
+        If the future is already done, the callback is called immediately.
+        """
+        if self.finished:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def _finish(self, value, exc_info):
+        if self.finished:
+            raise ValueError('the operation has already finished')
+        self.finished = True
+        self.value = value
+        self.excInfo = exc_info
+        callbacks = self.callbacks
+        self.callbacks = None
+        for callback in callbacks:
+            callback(self)
+
+
+def _cancelled_error():
+    return (TaskCancelledError, TaskCancelledError(), None)
+
+
+class Task(Future):
+    """
+    A Task runs a generator on a Scheduler.
+
+    The Task is a Future for the generator's result, so other tasks can
+    yield it to wait for it to finish.
+    """
+    def __init__(self, scheduler, gen):
+        Future.__init__(self)
+        self.scheduler = scheduler
+        self.gen = gen
+        # The Future that the generator is currently waiting on
+        self.waitingOn = None
+        # The (value, exc_info) to resume the generator with, once it has
+        # been put on the scheduler's ready queue
+        self.nextStep = None
+        # The ChildProcess objects spawned by this task
+        self.children = []
+
+    def cancel(self):
+        if self.finished:
+            return False
+
+        future = self.waitingOn
+        self.waitingOn = None
+        if future is not None:
+            future.cancel()
+        self._wake(None, _cancelled_error())
+        return True
+
+    def close(self):
+        """
+        Stop the task without resuming it, by closing its generator.
+        """
+        if self.finished:
+            return
+        self.waitingOn = None
+        self.nextStep = None
+        try:
+            self.gen.close()
+        except:
+            self._done(None, sys.exc_info())
+        else:
+            self._done(None, _cancelled_error())
+
+    def _wake(self, value, exc_info):
+        queued = self.nextStep is not None
+        self.nextStep = (value, exc_info)
+        if not queued:
+            self.scheduler.ready.append(self)
+
+    def _step(self):
+        (value, exc_info) = self.nextStep
+        self.nextStep = None
+        if self.finished:
+            return
+
+        self.scheduler.current = self
+        try:
+            if exc_info is None:
+                future = self.gen.send(value)
+            else:
+                future = self.gen.throw(*exc_info)
+        except StopIteration:
+            self._done(None, None)
+            return
+        except Return, ex:
+            self._done(ex.value, None)
+            return
+        except:
+            self._done(None, sys.exc_info())
+            return
+        finally:
+            self.scheduler.current = None
+
+        if not isinstance(future, Future):
+            try:
+                raise TypeError('tasks must yield Future objects, not %s' %
+                                (type(future).__name__,))
+            except TypeError:
+                self._wake(None, sys.exc_info())
+            return
+
+        self.waitingOn = future
+        future.addCallback(self._resume)
+
+    def _resume(self, future):
+        if future is not self.waitingOn:
+            # We stopped waiting on this future when we were cancelled
+            return
+        self.waitingOn = None
+        self._wake(future.value, future.excInfo)
+
+    def _done(self, value, exc_info):
+        for child in self.children:
+            if child.isRunning():
+                self.scheduler.kill(child.entry)
+        self._finish(value, exc_info)
+
+
+class ChildProcess(object):
+    """
+    A process started by a task, with Scheduler.spawn().
+
+    If the process was spawned without a monitor, its output is split into
+    lines, which can be read with readLine().
+    """
+    def __init__(self, scheduler, monitor):
+        self.scheduler = scheduler
+        self.entry = None
+        if monitor is None:
+            monitor = proc.ProcLineMonitor(self)
+        self.monitor = monitor
+
+        # The lines that have been received but not read yet
+        self.lines = collections.deque()
+        # Futures for readLine() calls waiting on more output
+        self.lineWaiters = collections.deque()
+        # A list of (future, expected_rc, expected_sig) for wait() calls
+        self.exitWaiters = []
+
+    def isRunning(self):
+        return self.entry.isRunning()
+
+    def readLine(self):
+        """
+        Read the next line that the process printed.
+
+        Returns a Future.  Its result is a tuple of ('stdout', line) or
+        ('stderr', line), or None once the process has exited and all of its
+        output has been read.  If the process was spawned with a timeout and
+        no output arrives within that time, the Future fails with a
+        proc.TimeoutError.
+        """
+        future = Future()
+        if self.lines:
+            future.setResult(self.lines.popleft())
+        elif not self.isRunning():
+            future.setResult(None)
+        else:
+            self.lineWaiters.append(future)
+        return future
+
+    def wait(self, expected_rc=(0,), expected_sig=()):
+        """
+        Wait for the process to exit.
+
+        Returns a Future for the exit status.  If the status does not match
+        expected_rc or expected_sig, the Future fails with a CmdStatusError
+        or CmdTerminatedError.  It also fails if the monitor raised an
+        exception while handling the process' output.
+        """
+        future = Future()
+        if self.isRunning():
+            self.exitWaiters.append((future, expected_rc, expected_sig))
+        else:
+            self.__finishWait(future, expected_rc, expected_sig)
+        return future
+
+    def stdoutLine(self, line):
+        self.__addLine(('stdout', line))
+
+    def stderrLine(self, line):
+        self.__addLine(('stderr', line))
+
+    def timeoutExpired(self):
+        future = self.__nextLineWaiter()
+        if future is None:
+            return
+        try:
+            raise proc.TimeoutError(self.entry.process)
+        except proc.TimeoutError:
+            future.setError()
+
+    def _exited(self):
+        while True:
+            future = self.__nextLineWaiter()
+            if future is None:
+                break
+            future.setResult(None)
+
+        waiters = self.exitWaiters
+        self.exitWaiters = []
+        for (future, expected_rc, expected_sig) in waiters:
+            if not future.done():
+                self.__finishWait(future, expected_rc, expected_sig)
+
+    def __addLine(self, line):
+        future = self.__nextLineWaiter()
+        if future is None:
+            self.lines.append(line)
+        else:
+            future.setResult(line)
+
+    def __nextLineWaiter(self):
+        # Skip over futures that were cancelled
+        while self.lineWaiters:
+            future = self.lineWaiters.popleft()
+            if not future.done():
+                return future
+        return None
+
+    def __finishWait(self, future, expected_rc, expected_sig):
+        if self.entry.error is not None:
+            future.setError(self.entry.error)
+            return
+        try:
+            proc.check_status(self.entry.process, self.entry.status,
+                              expected_rc, expected_sig)
+        except proc.CmdFailedError:
+            future.setError()
+        else:
+            future.setResult(self.entry.status)
+
+
+class Scheduler(proc.MultiProcRunner):
+    """
+    A Scheduler runs tasks, and the processes they spawn, from a single
+    thread.
+
+    Add tasks with start(), then call run() to run until all of the tasks
+    have finished.  Tasks may start more tasks while they run.
+    """
+    def __init__(self):
+        proc.MultiProcRunner.__init__(self)
+        self.tasks = []
+        # Tasks that are ready to be resumed
+        self.ready = collections.deque()
+        # The task that is currently running, if any
+        self.current = None
+        # Maps ManagedProc --> ChildProcess
+        self.children = {}
+
+    def start(self, gen):
+        """
+        Start a task.
+
+        gen is a generator, or a function to call with the scheduler as its
+        only argument to get one.  Returns a Task object.
+        """
+        if not hasattr(gen, 'send'):
+            gen = gen(self)
+        task = Task(self, gen)
+        self.tasks.append(task)
+        task._wake(None, None)
+        return task
+
+    def spawn(self, process, monitor=None, timeout=None):
+        """
+        Start a process, owned by the currently running task.
+
+        process is a Proc, or a command argument list.  If monitor is None,
+        the output is available through the returned ChildProcess object's
+        readLine() method.  Otherwise the output is passed to the monitor,
+        just like with MultiProcRunner.add().
+
+        Returns a ChildProcess object.
+        """
+        if self.current is None:
+            raise ValueError('spawn() may only be called from a task')
+        child = ChildProcess(self, monitor)
+        # The exit status is checked by ChildProcess.wait(), instead of by
+        # the runner.
+        child.entry = self.add(process, child.monitor, timeout=timeout,
+                               expected_rc=None, expected_sig=None)
+        self.children[child.entry] = child
+        self.current.children.append(child)
+        return child
+
+    def run(self):
+        try:
+            proc.MultiProcRunner.run(self)
+        except:
+            (ex_type, ex_value, ex_traceback) = sys.exc_info()
+            self.__closeTasks()
+            raise ex_type, ex_value, ex_traceback
+
+        blocked = [task for task in self.tasks if not task.done()]
+        if blocked:
+            self.__closeTasks()
+            raise TaskDeadlockError(len(blocked))
+
+    def beforePoll(self):
+        while self.ready:
+            task = self.ready.popleft()
+            task._step()
+
+    def processExited(self, entry):
+        child = self.children.pop(entry, None)
+        if child is None:
+            return
+        # Errors from the monitor are reported through ChildProcess.wait(),
+        # so don't let MultiProcRunner.run() raise them too.
+        entry.error = None
+        child._exited()
+
+    def __closeTasks(self):
+        for task in self.tasks:
+            task.close()
+
+
+class _GatherFuture(Future):
+    def __init__(self, futures, cancel_on_error):
+        Future.__init__(self)
+        self.futures = futures
+        self.cancelOnError = cancel_on_error
+        self.remaining = len(futures)
+        if not futures:
+            self.setResult([])
+            return
+        for future in futures:
+            future.addCallback(self.__childDone)
+
+    def cancel(self):
+        if not Future.cancel(self):
+            return False
+        for future in self.futures:
+            future.cancel()
+        return True
+
+    def __childDone(self, future):
+        if self.finished:
+            return
+        self.remaining -= 1
+
+        if future.failed() and self.cancelOnError:
+            self.setError(future.excInfo)
+            for other in self.futures:
+                other.cancel()
+            return
+
+        if self.remaining > 0:
+            return
+        for other in self.futures:
+            if other.failed():
+                self.setError(other.excInfo)
+                return
+        self.setResult([other.value for other in self.futures])
+
+
+def gather(futures, cancel_on_error=True):
+    """
+    Get a Future that waits for several other Futures.
+
+    The result is a list of their results, in the same order.  If one of them
+    fails, the returned Future fails with the same error.  If cancel_on_error
+    is True, this happens immediately, and the others are cancelled.
+    Otherwise the others are allowed to finish first.
+    """
+    return _GatherFuture(list(futures), cancel_on_error)
+
+
+class Semaphore(object):
+    """
+    A Semaphore limits how many tasks may do something at once.
+
+    A task calls acquire(), and yields the returned Future to wait for its
+    turn.  It must call release() when it is done.
+    """
+    def __init__(self, value=1):
+        self.value = value
+        self.waiters = collections.deque()
+
+    def acquire(self):
+        future = Future()
+        if self.value > 0:
+            self.value -= 1
+            future.setResult()
+        else:
+            self.waiters.append(future)
+        return future
+
+    def release(self):
+        while self.waiters:
+            future = self.waiters.popleft()
+            # Futures that were cancelled while waiting don't get a turn
+            if not future.done():
+                future.setResult()
+                return
+        self.value += 1
+
+
+def run(gen):
+    """
+    Run a single task, and the tasks it starts, until they finish.
+
+    gen is the same as for Scheduler.start().  Returns the task's result, or
+    raises its exception.
+    """
+    scheduler = Scheduler()
+    task = scheduler.start(gen)
+    scheduler.run()
+    return task.getResult()
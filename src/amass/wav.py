@@ -0,0 +1,90 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2011, Adam Simpkins
+#
+"""
+Minimal support for writing CD audio data as .wav files.
+"""
+import os
+import struct
+
+HEADER_SIZE = 44
+
+CHANNELS = 2
+SAMPLE_RATE = 44100
+BITS_PER_SAMPLE = 16
+
+
+def make_header(data_length):
+    """
+    Build the header for a .wav file containing data_length bytes of
+    16-bit stereo 44.1kHz PCM data.
+    """
+    block_align = CHANNELS * (BITS_PER_SAMPLE / 8)
+    byte_rate = SAMPLE_RATE * block_align
+    return struct.pack('<4sI4s4sIHHIIHH4sI',
+                       'RIFF', HEADER_SIZE - 8 + data_length, 'WAVE',
+                       'fmt ', 16, 1, CHANNELS, SAMPLE_RATE, byte_rate,
+                       block_align, BITS_PER_SAMPLE,
+                       'data', data_length)
+
+
+class WavWriter(object):
+    """
+    Writes audio data to a .wav file.
+
+    The header is written when the file is closed, once the total data length
+    is known.
+
+    If resume_length is specified, an existing (possibly incomplete) file is
+    opened instead.  Only the first resume_length bytes of its audio data are
+    kept, and new data is appended after them.  IOError is raised if the file
+    does not contain that much data.
+    """
+    def __init__(self, path, resume_length=None):
+        self.path = path
+        if resume_length is None:
+            self.file = open(path, 'wb')
+            self.dataLength = 0
+            # Leave room for the header
+            self.file.write('\0' * HEADER_SIZE)
+        else:
+            self.file = open(path, 'r+b')
+            self.file.seek(0, os.SEEK_END)
+            size = self.file.tell()
+            if size < HEADER_SIZE + resume_length:
+                self.file.close()
+                raise IOError('%s contains only %d bytes of audio data, '
+                              'expected at least %d' %
+                              (path, max(0, size - HEADER_SIZE),
+                               resume_length))
+            self.file.truncate(HEADER_SIZE + resume_length)
+            self.file.seek(HEADER_SIZE + resume_length)
+            self.dataLength = resume_length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ex_type, ex_value, ex_trace):
+        self.close()
+
+    def write(self, data):
+        self.file.write(data)
+        self.dataLength += len(data)
+
+    def sync(self):
+        """
+        Make sure all data written so far has reached the disk.
+
+        (The header is not updated until the file is closed.)
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.seek(0)
+        self.file.write(make_header(self.dataLength))
+        self.file.close()
+        self.file = None
@@ -0,0 +1,139 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2011, Adam Simpkins
+#
+"""
+A simple thread-based worker pool.
+
+Most of the heavy lifting we do (encoding, tagging, ripping) happens in
+external processes, so python threads are sufficient to keep many of them
+running at once.
+"""
+import multiprocessing
+import Queue
+import sys
+import threading
+
+# Waiting on a lock without a timeout can't be interrupted with Ctrl-C in
+# python 2, so waits are done in a loop with this timeout.
+WAIT_INTERVAL = 0.5
+
+
+def get_cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+class Job(object):
+    """
+    A Job represents a single function call submitted to a WorkerPool.
+    """
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+        self.result = None
+        self.excInfo = None
+        self.doneEvent = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.fn(*self.args, **self.kwargs)
+        except:
+            self.excInfo = sys.exc_info()
+        self.doneEvent.set()
+
+    def done(self):
+        return self.doneEvent.is_set()
+
+    def failed(self):
+        return self.excInfo is not None
+
+    def wait(self, timeout=None):
+        """
+        Wait for the job to finish, and return its result.
+
+        If the job raised an exception, the exception is re-raised here, with
+        its original traceback.  Returns None if the timeout expired before
+        the job finished.
+        """
+        if timeout is None:
+            while not self.doneEvent.is_set():
+                self.doneEvent.wait(WAIT_INTERVAL)
+        else:
+            self.doneEvent.wait(timeout)
+            if not self.doneEvent.is_set():
+                return None
+
+        if self.excInfo is not None:
+            (ex_type, ex_value, ex_traceback) = self.excInfo
+            raise ex_type, ex_value, ex_traceback
+        return self.result
+
+
+class WorkerPool(object):
+    """
+    A WorkerPool runs submitted jobs on a fixed number of worker threads.
+
+    Jobs are started in the order they were submitted.  Callers that need
+    deterministic output should wait on the returned Job objects in order,
+    rather than reporting results as they complete.
+    """
+    def __init__(self, num_workers=None):
+        if num_workers is None:
+            num_workers = get_cpu_count()
+        if num_workers < 1:
+            raise ValueError('a WorkerPool requires at least 1 worker, '
+                             'not %d' % (num_workers,))
+
+        self.numWorkers = num_workers
+        self.queue = Queue.Queue()
+        self.threads = []
+        for n in range(num_workers):
+            thread = threading.Thread(target=self.__workerLoop,
+                                      name='amass-worker-%d' % (n,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ex_type, ex_value, ex_trace):
+        self.close()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Submit a function to be called on one of the worker threads.
+
+        Returns a Job object, which can be used to wait for the result.
+        """
+        if self.threads is None:
+            raise ValueError('cannot submit jobs to a closed WorkerPool')
+        job = Job(fn, args, kwargs)
+        self.queue.put(job)
+        return job
+
+    def close(self):
+        """
+        Wait for all outstanding jobs to finish, and stop the worker threads.
+        """
+        if self.threads is None:
+            return
+
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            while thread.is_alive():
+                thread.join(WAIT_INTERVAL)
+        self.threads = None
+
+    def __workerLoop(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            job.run()
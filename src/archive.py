@@ -3,22 +3,128 @@
 # Copyright (c) 2009-2010, Adam Simpkins
 #
 import optparse
+import os
 import sys
+import traceback
 
 from amass import archive
 from amass import cddb
 from amass import cdrom
+from amass import drives
 from amass import file_util
 from amass import mb
 from amass import metadata
+from amass import rip
+from amass import workers
+
+
+def load_drive_profile(device, options, display):
+    if options.drive_store is None:
+        return None
+
+    profile = drives.find_profile(device, options.drive_store)
+    if profile is None:
+        display.message('No profile for drive %s; run probe_drive.py to '
+                        'create one' % (device,))
+        return None
+
+    if profile.readOffset is None:
+        display.message('Read offset for drive %s is unknown' % (device,))
+    if options.rip_mode != rip.RIP_PARANOIA and not profile.accurateStream:
+        display.message('warning: drive %s does not report accurate '
+                        'streaming; consider ripping with cdparanoia' %
+                        (device,))
+    return profile
+
+
+def archive_disc(device, options, display, encode_pool):
+    """
+    Save the data off the physical CD in the specified device.
+
+    Returns the AlbumDir the data was saved to.
+    """
+    if display is None:
+        display = rip.CliDisplay()
+
+    archiver = archive.Archiver(device, display)
+    archiver.encodeFlac = options.flac or options.pipeline
+    archiver.keepWav = options.keep_wav
+    archiver.encodePool = encode_pool
+    archiver.ripMode = options.rip_mode
+    archiver.scsiStats = options.scsi_stats
+    archiver.driveProfile = load_drive_profile(device, options, display)
+    if (options.rip_mode == rip.RIP_C2 and archiver.driveProfile is not None
+        and not archiver.driveProfile.c2Pointers):
+        display.message('Drive %s does not support C2 error pointers; '
+                        'ripping with cdparanoia instead' % (device,))
+        archiver.ripMode = rip.RIP_PARANOIA
+    if options.adaptive_speed:
+        max_speed = None
+        if archiver.driveProfile is not None:
+            max_speed = archiver.driveProfile.maxReadSpeed
+        archiver.speedController = rip.SpeedController(max_speed)
+    if options.resume:
+        return archiver.resume()
+    else:
+        return archiver.archive()
+
+
+def archive_discs(options, encode_pool):
+    """
+    Archive the discs in all of the specified devices concurrently.
+
+    Returns a tuple of (results, failed).  results is a list of
+    (device, AlbumDir) tuples for the drives that were archived successfully,
+    and failed is a list of the devices where archiving failed.  Each failure
+    is printed to stderr along with its traceback.
+    """
+    display = rip.MultiCliDisplay(options.devices)
+
+    # Run each drive on its own thread.  The drives spend nearly all of their
+    # time waiting on I/O, so this doesn't compete much with the encoders.
+    with workers.WorkerPool(len(options.devices)) as drive_pool:
+        jobs = []
+        for (n, device) in enumerate(options.devices):
+            job = drive_pool.submit(archive_disc, device, options,
+                                    display.getDrive(n), encode_pool)
+            jobs.append((device, job))
+
+        # Report the results in the order the devices were specified
+        results = []
+        failed = []
+        for (device, job) in jobs:
+            try:
+                results.append((device, job.wait()))
+            except Exception, ex:
+                print >> sys.stderr, 'error archiving %s: %s\n%s' % \
+                        (device, ex, traceback.format_exc())
+                failed.append(device)
+
+    return (results, failed)
+
+
+def fetch_metadata(dir):
+    # Fetch metadata information from CDDB and MusicBrainz
+    toc = dir.album.toc
+    cddb.fetch_cddb(toc, dir)
+    mb.fetch_mb(toc, dir)
+
+    # Merge the metadata information
+    metadata.merge.automerge(dir)
+    chooser = metadata.merge.CliChooser(dir, 100)
+    chooser.choose()
+    with file_util.open_new(dir.layout.getMetadataInfoPath()) as f:
+        dir.album.writeTracks(f)
 
 
 def main(argv):
     usage = '%prog [options]'
     parser = optparse.OptionParser(usage=usage)
-    parser.add_option('-d', '--device', action='store',
-                      dest='device', default='/dev/cdrom',
-                      metavar='DEVICE', help='The CD-ROM device')
+    parser.add_option('-d', '--device', action='append',
+                      dest='devices', default=[],
+                      metavar='DEVICE', help='The CD-ROM device.  May be '
+                      'specified multiple times to archive several discs at '
+                      'once (defaults to /dev/cdrom)')
     parser.add_option('-e', '--eject',
                       action='store_true', default=False,
                       help='Eject after the archive operation completes')
@@ -29,6 +135,62 @@ def main(argv):
     parser.add_option('--only', action='store_true',
                       dest='archive_only', default=False,
                       help='Only archive the CD data, do not fetch metadata')
+    parser.add_option('--burst', action='store_const',
+                      dest='rip_mode', const=rip.RIP_BURST,
+                      default=rip.RIP_PARANOIA,
+                      help='Read audio tracks directly at full drive speed, '
+                      'without cdparanoia\'s verification.  Only use this '
+                      'for clean discs')
+    parser.add_option('--test-and-copy', action='store_const',
+                      dest='rip_mode', const=rip.RIP_TEST_AND_COPY,
+                      help='Read each audio track twice at full drive speed, '
+                      'and only fall back to cdparanoia if the two reads '
+                      'differ')
+    parser.add_option('--c2', action='store_const',
+                      dest='rip_mode', const=rip.RIP_C2,
+                      help='Read audio tracks at full drive speed with C2 '
+                      'error pointers, and only re-read the sectors the drive '
+                      'reports errors in.  Requires a drive with C2 support')
+    parser.add_option('--adaptive-speed', action='store_true',
+                      dest='adaptive_speed', default=False,
+                      help='Slow the drive down when it has trouble reading '
+                      'the disc, and speed it back up once reads are clean '
+                      'again.  Only used with --burst, --c2, and '
+                      '--test-and-copy')
+    parser.add_option('--scsi-stats', action='store_true',
+                      dest='scsi_stats', default=False,
+                      help='Save statistics about the SCSI commands sent to '
+                      'the drive with each track\'s rip log, to help find '
+                      'out why ripping is slow.  (Audio tracks ripped by '
+                      'cdparanoia are not covered.)')
+    parser.add_option('--flac', action='store_true',
+                      dest='flac', default=False,
+                      help='Encode the audio tracks to flac while ripping, '
+                      'instead of saving .wav files')
+    parser.add_option('--keep-wav', action='store_true',
+                      dest='keep_wav', default=False,
+                      help='Also keep the .wav files when using --flac')
+    parser.add_option('--pipeline', action='store_true',
+                      dest='pipeline', default=False,
+                      help='Rip each track to a .wav file and encode it to '
+                      'flac in the background while ripping the next track '
+                      '(implies --flac)')
+    parser.add_option('-j', '--jobs', action='store', type='int',
+                      dest='jobs', default=None,
+                      metavar='N',
+                      help='Run at most N background encode jobs with '
+                      '--pipeline (defaults to the number of CPUs, minus one '
+                      'for each additional device)')
+
+    parser.add_option('--drive-db', action='store',
+                      dest='drive_db', default=None,
+                      metavar='PATH',
+                      help='The drive profile database, used to look up '
+                      'each drive\'s read offset and capabilities (defaults '
+                      'to %s)' % (drives.DEFAULT_DB_PATH,))
+    parser.add_option('--no-drive-profile', action='store_false',
+                      dest='use_drive_profile', default=True,
+                      help='Ignore any stored drive profiles')
 
     (options, args) = parser.parse_args(argv[1:])
 
@@ -37,31 +199,58 @@ def main(argv):
         print >> sys.stderr, 'trailing arguments: %s' % (args,)
         return 1
 
-    # Save the data off the physical CD
-    archiver = archive.Archiver(options.device)
-    if options.resume:
-        dir = archiver.resume()
+    if not options.devices:
+        options.devices = ['/dev/cdrom']
+    if options.use_drive_profile:
+        options.drive_store = drives.ProfileStore(options.drive_db)
     else:
-        dir = archiver.archive()
+        options.drive_store = None
+    multiple_drives = (len(options.devices) > 1)
 
-    if options.archive_only:
-        return os.EX_OK
+    # When archiving several discs at once, all drives share a single pool of
+    # encoders.  Each drive keeps ripping while its tracks wait to be encoded,
+    # so the drives never sit idle waiting on the CPU.  To avoid
+    # oversubscribing the CPU, the default number of encoders leaves a core
+    # free for every extra drive (for cdparanoia and our monitoring of it).
+    if options.jobs is None:
+        options.jobs = max(1, (workers.get_cpu_count() -
+                               (len(options.devices) - 1)))
+    if multiple_drives and options.flac:
+        options.pipeline = True
 
-    # Fetch metadata information from CDDB and MusicBrainz
-    toc = dir.album.toc
-    cddb.fetch_cddb(toc, dir)
-    mb.fetch_mb(toc, dir)
+    encode_pool = None
+    if options.pipeline:
+        encode_pool = workers.WorkerPool(options.jobs)
+    try:
+        if multiple_drives:
+            (results, failed) = archive_discs(options, encode_pool)
+        else:
+            device_name = options.devices[0]
+            results = [(device_name,
+                        archive_disc(device_name, options, None,
+                                     encode_pool))]
+            failed = []
+    finally:
+        if encode_pool is not None:
+            encode_pool.close()
 
-    # Merge the metadata information
-    metadata.merge.automerge(dir)
-    chooser = metadata.merge.CliChooser(dir, 100)
-    chooser.choose()
-    with file_util.open_new(dir.layout.getMetadataInfoPath()) as f:
-        dir.album.writeTracks(f)
+    # Finish up the drives that succeeded, even if others failed.
+    # The exit status still reports the failure.
+    rc = os.EX_OK
+    if failed:
+        rc = 1
+    if options.archive_only:
+        return rc
+
+    for (device_name, dir) in results:
+        fetch_metadata(dir)
 
     if options.eject:
-        with cdrom.binary.Device(options.device) as device:
-            device.eject()
+        for (device_name, dir) in results:
+            with cdrom.binary.Device(device_name) as device:
+                device.eject()
+
+    return rc
 
 
 if __name__ == '__main__':
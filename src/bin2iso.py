@@ -40,16 +40,23 @@ The current approach is much simpler, but there are downsides to using sparse
 files.  Users may not realize that the file takes up less space on disk than
 the actual file size, since many tools aren't good at displaying this
 distinction.  Also, if you copy it, many programs will write the full copy out
-to disk so that it is no longer sparse.
+to disk so that it is no longer sparse.  (The --preallocate option can be used
+to allocate the full image up front, if a non-sparse file is wanted.)
+Programs that only need to read the image can use amass.archive.IsoImage
+instead, which presents the same data without creating a file at all.
+
+The track data is copied inside the kernel where possible (with
+copy_file_range() or sendfile()), and any holes in the ripped track files are
+skipped rather than being written out as zeros.
 """
 
 import optparse
 import os
 import sys
-import shutil
 
 import amass.cdrom
 import amass.archive
+from amass import file_util
 
 RETCODE_SUCCESS = 0
 RETCODE_ARGUMENTS_ERROR = 1
@@ -96,6 +103,10 @@ class Options(optparse.OptionParser):
                         dest='headerTrack', default=None, metavar='PATH',
                         help='Use the ISO header from the track specified by '
                         'PATH, instead of the last track specified')
+        self.add_option('-p', '--preallocate', action='store_true',
+                        dest='preallocate', default=False,
+                        help='Allocate disk space for the entire image, '
+                        'instead of creating a sparse file')
         self.add_option('-?', '--help',
                         action='callback', callback=self.__helpCallback,
                         help='Print this help message and exit')
@@ -157,7 +168,7 @@ class Options(optparse.OptionParser):
                 self.tracks.append(TrackInfo(path, offset))
         else:
             # Hmm.  More than 1 argument, but they don't come in pairs.
-            raise OverlapError('odd number of arguments; '
+            raise OptionsError('odd number of arguments; '
                                'expected track, offset pairs')
 
 
@@ -168,12 +179,15 @@ def do_tracks_overlap(track1, track2):
         track1, track2 = track2, track1
 
     # The tracks overlap iff track1's end is past the start of track2.
-    if track1.offset + track1.length > track2.offset:
+    # (The offsets are in sectors, and the lengths are in bytes.)
+    track1_end = track1.offset * SECTOR_SIZE + track1.length
+    if track1_end > track2.offset * SECTOR_SIZE:
         return True
     return False
 
 
-def merge_tracks(output_path, track_list, header_track_path=None):
+def merge_tracks(output_path, track_list, header_track_path=None,
+                 preallocate=False):
     # If the header track path is None, treat the last track in the list
     # as the header track
     if header_track_path is None:
@@ -184,6 +198,7 @@ def merge_tracks(output_path, track_list, header_track_path=None):
         if os.path.normpath(header_track_path) not in norm_track_paths:
             raise Exception('header track %r is not in the list of '
                             'supplied tracks' % (header_track_path,))
+    header_track_path = os.path.normpath(header_track_path)
 
     # Before we start, validate the arguments.
     # Compute the sizes for all of the tracks, and make sure none of them
@@ -197,56 +212,63 @@ def merge_tracks(output_path, track_list, header_track_path=None):
         for track2 in new_track_list:
             if do_tracks_overlap(track, track2):
                 raise OverlapError(track, track2)
+        new_track_list.append(track)
 
     # Sort the tracks in order of the offset
     new_track_list.sort(key=lambda t: t.offset)
+    output_length = max(t.offset * SECTOR_SIZE + t.length
+                        for t in new_track_list)
 
     # Now begin writing the output file.
-    outf = open(output_path, 'wb')
-
-    # Write out each track
-    for track_info in track_list:
-        inf = open(track_info.path, 'rb')
-
-        # If we are supposed to get the header information from this track,
-        # output the track's header to the start of the file.
-        if track.path == header_track_path:
-            # Read the header sectors from the input file
-            header = inf.read(NUM_HEADER_SECTORS * SECTOR_SIZE)
-
-            # Write the header to the start of the file
-            outf.seek(0)
-            outf.write(header)
-
-            # Write out the track data to the specified offset
-            # Manually write the header before calling copyfileobj(), since the
-            # inf file pointer is already past it, and we already have it in
-            # memory.
-            outf.seek(track.offset * SECTOR_SIZE)
-            outf.write(header)
-            shutil.copyfileobj(inf, outf)
+    out_fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0666)
+    try:
+        # Set the file size up front.  Anything we don't write is left as
+        # a hole, unless we were asked to allocate the whole file.
+        if preallocate:
+            file_util.preallocate(out_fd, output_length)
         else:
-            # If this track's offset is 0, skip the header, so it doesn't
-            # overwrite the header from the selected header track.
-            if track.offset < NUM_HEADER_SECTORS:
-                # Offset should normally be 0.  It doesn't make much sense
-                # For a data track to start partway through the header region.
-                # Just skip outputting the first NUM_HEADER_SECTORS sectors.
-                inf.seek(NUM_HEADER_SECTORS * SECTOR_SIZE)
-                outf.seek((track.offset + NUM_HEADER_SECTORS) * SECTOR_SIZE)
-            else:
-                outf.seek(track.offset + NUM_HEADER_SECTORS)
-
-            # Copy the track data
-            shutil.copyfileobj(inf, outf)
+            os.ftruncate(out_fd, output_length)
 
-        inf.close()
+        # Write out each track
+        for track in new_track_list:
+            is_header_track = (os.path.normpath(track.path) ==
+                               header_track_path)
+            copy_track(out_fd, track, is_header_track)
+    finally:
+        os.close(out_fd)
 
-    outf.close()
     return RETCODE_SUCCESS
 
 
-def process_archive_dir(output_path, dir):
+def copy_track(out_fd, track, is_header_track):
+    in_fd = os.open(track.path, os.O_RDONLY)
+    try:
+        out_offset = track.offset * SECTOR_SIZE
+        skip = 0
+        if is_header_track:
+            # Copy the track's header to the start of the file.
+            # The track data itself is copied in full below.
+            header_length = min(HEADER_SIZE, track.length)
+            file_util.copy_data(in_fd, 0, out_fd, 0, header_length)
+        elif track.offset < NUM_HEADER_SECTORS:
+            # If this track's offset is 0, skip the header, so it doesn't
+            # overwrite the header from the selected header track.
+            # Offset should normally be 0.  It doesn't make much sense
+            # For a data track to start partway through the header region.
+            # Just skip outputting the first NUM_HEADER_SECTORS sectors.
+            skip = HEADER_SIZE
+
+        # Copy the track data, skipping any holes in the input file
+        for (start, end) in file_util.find_data_ranges(in_fd, skip,
+                                                       track.length):
+            file_util.copy_data(in_fd, start, out_fd, out_offset + start,
+                                end - start)
+    finally:
+        os.close(in_fd)
+
+
+def process_archive_dir(output_path, dir, preallocate=False):
     toc = dir.album.toc
 
     track_info_list = []
@@ -264,7 +286,8 @@ def process_archive_dir(output_path, dir):
     header_track_path = os.path.join(dir.layout.getDataTrackDir(),
                                      'track%02d.bin' % (header_track_num,))
 
-    return merge_tracks(output_path, track_info_list, header_track_path)
+    return merge_tracks(output_path, track_info_list, header_track_path,
+                        preallocate)
 
 
 def err_msg(msg):
@@ -284,11 +307,17 @@ def main(argv):
         options.printHelp()
         return RETCODE_SUCCESS
 
-    if options.archiveDir:
-        dir = amass.archive.AlbumDir(options.archiveDir)
-        return process_archive_dir(options.outputPath, dir)
-    else:
-        return merge_tracks(options.outputPath, options.tracks)
+    try:
+        if options.archiveDir:
+            dir = amass.archive.AlbumDir(options.archiveDir)
+            return process_archive_dir(options.outputPath, dir,
+                                       options.preallocate)
+        else:
+            return merge_tracks(options.outputPath, options.tracks,
+                                preallocate=options.preallocate)
+    except OverlapError, error:
+        err_msg(error)
+        return RETCODE_ARGUMENTS_ERROR
 
 
 if __name__ == '__main__':
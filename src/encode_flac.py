@@ -5,19 +5,70 @@
 import errno
 import optparse
 import os
-import subprocess
+import StringIO
 import sys
 
 from amass import archive
 from amass import file_util
 from amass import flac
+from amass import tasks
+from amass import workers
 
 
-def flac_encode(wav_path, flac_path):
-    flac_options = ['-V']
-    cmd = ['flac'] + flac_options + ['-o', flac_path, wav_path]
-    print 'Encoding %s' % (flac_path,)
-    subprocess.check_call(cmd)
+def flac_encode(scheduler, sem, wav_path, flac_path, metadata):
+    """
+    A task to encode and tag a single track.
+
+    The task's result is a tuple of (output, error), where output is the text
+    that would normally be printed while encoding, and error is the exception
+    that occurred, or None on success.
+    """
+    # Wait for our turn, so that no more than --jobs encoders run at once
+    yield sem.acquire()
+    out = StringIO.StringIO()
+    try:
+        yield scheduler.start(flac.encode_file_task(scheduler, wav_path,
+                                                    flac_path, metadata,
+                                                    out=out))
+    except tasks.TaskCancelledError:
+        raise
+    except Exception, ex:
+        # Report any error (e.g., an unsupported tag in update_comments())
+        # as a failure of this track, so the other tracks still get encoded
+        raise tasks.Return((out.getvalue(), ex))
+    finally:
+        sem.release()
+    raise tasks.Return((out.getvalue(), None))
+
+
+def encode_all(scheduler, info_list, flac_dir, num_jobs):
+    """
+    A task to encode all of the tracks, and report the results.
+
+    Returns the list of flac files that failed to encode.
+    """
+    sem = tasks.Semaphore(num_jobs)
+    jobs = []
+    for info in info_list:
+        wav_path = info.path
+        (base, suffix) = os.path.splitext(os.path.basename(wav_path))
+        assert suffix == '.wav'
+        flac_path = os.path.join(flac_dir, base + '.flac')
+        task = scheduler.start(flac_encode(scheduler, sem, wav_path,
+                                           flac_path, info.metadata))
+        jobs.append((flac_path, task))
+
+    # Report the results in track order, regardless of the order in which
+    # the jobs actually finish.
+    failures = []
+    for (flac_path, task) in jobs:
+        (output, error) = yield task
+        print 'Encoding %s' % (flac_path,)
+        sys.stdout.write(output)
+        if error is not None:
+            print >> sys.stderr, 'error encoding %s: %s' % (flac_path, error)
+            failures.append(flac_path)
+    raise tasks.Return(failures)
 
 
 def main(argv):
@@ -27,6 +78,11 @@ def main(argv):
     parser.add_option('--no-tag',
                       action='store_false', dest='tag', default=True,
                       help='Do not tag the flac files')
+    parser.add_option('-j', '--jobs', action='store', type='int',
+                      dest='jobs', default=workers.get_cpu_count(),
+                      metavar='N',
+                      help='Encode N tracks in parallel (defaults to the '
+                      'number of CPUs)')
     (options, args) = parser.parse_args(argv[1:])
 
     if not args:
@@ -37,6 +93,10 @@ def main(argv):
         parser.print_help(sys.stderr)
         print >> sys.stderr, 'trailing arguments: %s' % (args[1:],)
         return 1
+    if options.jobs < 1:
+        parser.print_help(sys.stderr)
+        print >> sys.stderr, 'invalid number of jobs: %d' % (options.jobs,)
+        return 1
 
     dir = archive.AlbumDir(args[0])
 
@@ -60,14 +120,13 @@ def main(argv):
         if ex.errno != errno.EEXIST:
             raise
 
-    for info in info_list:
-        wav_path = info.path
-        (base, suffix) = os.path.splitext(os.path.basename(wav_path))
-        assert suffix == '.wav'
-        flac_path = os.path.join(flac_dir, base + '.flac')
-        flac_encode(wav_path, flac_path)
-        if info.metadata is not None:
-            flac.tag_file(flac_path, info.metadata)
+    failures = tasks.run(lambda scheduler: encode_all(scheduler, info_list,
+                                                      flac_dir, options.jobs))
+    if failures:
+        print >> sys.stderr, ('failed to encode %d of %d tracks' %
+                              (len(failures), len(info_list)))
+        return 1
+    return 0
 
 
 if __name__ == '__main__':
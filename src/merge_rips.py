@@ -6,89 +6,130 @@
 Merge several different ripped versions of a track.  Useful when cdparanoia
 reports some uncorrectable errors.  If you have ripped the track several times,
 this tool can merge them all, by choosing the most popular value from all files
-for each byte value.
+for each sample.
+
+The rips don't need to have been made with the same read offset: each file is
+aligned against the first one before merging, and the offsets found are
+reported.
 
 Usage: merge.py FILE1 FILE2 [...] > merged.wav
+
+The ranges where the rips disagreed can be saved with --index.  Later, after
+making more rips, "--update merged.wav" re-merges only the ranges listed in
+the index, instead of voting over all of the data again.  If the index is
+saved as metadata/disagreements/trackNN.idx in an archive directory,
+"archive.py --resume" re-reads the contested sectors from the disc.
 """
 
+import optparse
 import sys
 
+from amass import rip_merge
+from amass import workers
+
+
 def msg(s):
     print >> sys.stderr, str(s)
 
 
-def handle_difference(outf, bytes, offset):
-    values = {}
-    for b in bytes:
-        try:
-            values[b] += 1
-        except KeyError:
-            values[b] = 1
-
-    max_count = 0
-    max_byte = []
-    for (b, count) in values.items():
-        if count > max_count:
-            max_count = count
-            max_byte = [b]
-        elif count == max_count:
-            max_byte.append(b)
-
-    if len(max_byte) != 1:
-        raise Exception('tie at offset %d: %s' % (offset, max_byte))
-
-    msg('%d: %s --> %r' % (offset, values, max_byte[0]))
-    outf.write(max_byte[0])
-
-
-def handle_chunks(outf, chunks, offset):
-    # See if there are any differences
-    v = chunks[0]
-    for c in chunks:
-        if c != v:
-            break
-    else:
-        # Great, all identical
-        outf.write(v)
-        sys.stderr.write('%d\r' % (offset,))
-        return
-
-    # Hmm.  We found differences.
-    # Try to split the chunks in half, and recurse on each half.
-    l = len(v)
-    if l == 1:
-        # Down to single byte chunks.
-        # Handle the difference.
-        handle_difference(outf, chunks, offset)
+def report_offset(path, position, offset):
+    sample_offset = offset / rip_merge.SAMPLE_SIZE
+    if position == 0:
+        msg('%s: offset %+d samples' % (path, sample_offset))
     else:
-        h = l / 2
-        first_half = [c[:h] for c in chunks]
-        second_half = [c[h:] for c in chunks]
-        handle_chunks(outf, first_half, offset)
-        handle_chunks(outf, second_half, offset + h)
+        msg('%s: re-aligned to offset %+d samples at %d' %
+            (path, sample_offset, position))
 
 
-def main(argv):
-    filenames = argv[1:]
-    msg(filenames)
-
-    outf = sys.stdout
-
-    files = [open(name, 'r') for name in filenames]
+def report_progress(offset, length):
+    sys.stderr.write('%d\r' % (offset,))
 
-    block_size = 2048
-    offset = 0
-    while True:
-        blocks = [f.read(block_size) for f in files]
 
-        # FIXME: detect end of file better.
-        # If some end before others, handle the error.
-        if not blocks[0]:
-            break
+def report_ranges(index):
+    for r in index.ranges:
+        tie_str = ''
+        if r.tie:
+            tie_str = ' (tie)'
+        msg('%d-%d: %d/%d votes%s' % (r.offset, r.end, r.bestCount,
+                                      r.totalVotes, tie_str))
 
-        handle_chunks(outf, blocks, offset)
-        offset += block_size
 
+def main(argv):
+    usage = '%prog [options] FILE1 FILE2 [...] > merged.wav'
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-j', '--jobs', action='store', type='int',
+                      dest='jobs', default=workers.get_cpu_count(),
+                      metavar='N',
+                      help='Merge using N worker processes (defaults to the '
+                      'number of CPUs)')
+    parser.add_option('-i', '--index', action='store',
+                      dest='index_path', default=None,
+                      metavar='PATH',
+                      help='Save the ranges where the inputs disagreed to '
+                      'PATH')
+    parser.add_option('-u', '--update', action='store',
+                      dest='update_path', default=None,
+                      metavar='MERGED',
+                      help='Re-merge only the ranges listed in the --index '
+                      'file, updating MERGED in place, and save the new '
+                      'index')
+    parser.add_option('--allow-ties', action='store_true',
+                      dest='allow_ties', default=False,
+                      help='Keep the first file\'s value when the vote for '
+                      'a sample is tied, instead of failing')
+    parser.add_option('-v', '--verbose', action='store_true',
+                      dest='verbose', default=False,
+                      help='Print each range where the inputs disagreed')
+
+    (options, filenames) = parser.parse_args(argv[1:])
+    if len(filenames) < 2:
+        parser.print_help(sys.stderr)
+        return 1
+    if options.update_path is not None and options.index_path is None:
+        msg('--update requires --index')
+        return 1
+
+    # The index is also used to print the ranges with --verbose,
+    # even if it isn't being saved.
+    index = None
+    if options.index_path is not None or options.verbose:
+        index = rip_merge.DisagreementIndex(options.index_path)
+    old_ranges = None
+    if options.update_path is not None:
+        if not index.load():
+            msg('%s does not exist' % (options.index_path,))
+            return 1
+        old_ranges = [(r.offset, r.end) for r in index.ranges]
+        index.ranges = []
+        output = open(options.update_path, 'r+b')
+    else:
+        output = sys.stdout
+
+    merger = rip_merge.Merger(filenames, output)
+    merger.numJobs = options.jobs
+    merger.allowTies = options.allow_ties
+    merger.index = index
+    merger.onOffset = report_offset
+    merger.onProgress = report_progress
+    try:
+        if old_ranges is not None:
+            merger.update(old_ranges)
+        else:
+            merger.run()
+    except rip_merge.MergeError, ex:
+        msg('\nerror: %s' % (ex,))
+        return 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    msg('\n%d samples differed' % (merger.numDifferences,))
+    if options.verbose:
+        report_ranges(index)
+    if options.index_path is not None:
+        index.save()
+        msg('%d ranges (%d ties) saved to %s' %
+            (len(index.ranges), index.getNumTies(), index.path))
     return 0
 
 
@@ -0,0 +1,60 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2011, Adam Simpkins
+#
+import optparse
+import os
+import sys
+
+from amass import drives
+
+
+def main(argv):
+    usage = '%prog [options]'
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-d', '--device', action='store',
+                      dest='device', default='/dev/cdrom',
+                      metavar='DEVICE', help='The CD-ROM device')
+    parser.add_option('-O', '--read-offset', action='store', type='int',
+                      dest='read_offset', default=None,
+                      metavar='SAMPLES',
+                      help='The drive\'s read offset correction, in samples '
+                      '(as listed in the AccurateRip drive database).  If '
+                      'not specified, any previously stored offset is kept')
+    parser.add_option('--db', action='store',
+                      dest='db_path', default=None,
+                      metavar='PATH',
+                      help='The drive profile database (defaults to %s)' %
+                      (drives.DEFAULT_DB_PATH,))
+    parser.add_option('-n', '--dry-run', action='store_true',
+                      dest='dry_run', default=False,
+                      help='Print the drive profile without saving it')
+
+    (options, args) = parser.parse_args(argv[1:])
+
+    if args:
+        parser.print_help(sys.stderr)
+        print >> sys.stderr, 'trailing arguments: %s' % (args,)
+        return 1
+
+    store = drives.ProfileStore(options.db_path)
+    profile = drives.probe_drive(options.device)
+    old_profile = store.get(profile.vendor, profile.model, profile.revision)
+    if options.read_offset is not None:
+        profile.readOffset = options.read_offset
+    elif old_profile is not None:
+        profile.readOffset = old_profile.readOffset
+
+    print profile
+    if options.dry_run:
+        return os.EX_OK
+
+    store.add(profile)
+    store.save()
+    print 'Saved profile to %s' % (store.path,)
+    return os.EX_OK
+
+
+if __name__ == '__main__':
+    rc = main(sys.argv)
+    sys.exit(rc)
@@ -2,6 +2,8 @@
 #
 # Copyright (c) 2009, Adam Simpkins
 #
+import ctypes
+import mmap
 import os
 import sys
 import unittest
@@ -115,6 +117,101 @@ class CbufTests(unittest.TestCase):
         except IndexError:
             pass
 
+    def testView(self):
+        cb = self.__getCbuf32()
+        view = cb.view(4, 8)
+        self.assertEqual(view.tobytes(), '\x04\x05\x06\x07')
+        # The view shares memory with the buffer
+        cb[5] = 0xff
+        self.assertEqual(view.tobytes(), '\x04\xff\x06\x07')
+        self.assertEqual(len(cb.view()), 32)
+
+    def testSharedMemory(self):
+        # Data written through the ctypes array (e.g., by SG_IO) is visible
+        # through the python accessors, and vice versa.
+        cb = cbuf.CBuffer(8)
+        ctypes.memmove(cb.buf, '\x12\x34\x56\x78', 4)
+        self.assertEqual(cb.getU32BE(0), 0x12345678)
+        cb[4:8] = 'abcd'
+        self.assertEqual(ctypes.string_at(cb.buf, 8), '\x12\x34\x56\x78abcd')
+
+        # A bytearray is used directly, rather than copied
+        data = bytearray('wxyz')
+        cb = cbuf.CBuffer(data)
+        cb[0] = 'W'
+        self.assertEqual(str(data), 'Wxyz')
+
+    def testSetSliceResize(self):
+        cb = self.__getCbuf32()
+        self.assertRaises(ValueError, cb.__setslice__, 0, 4, 'abc')
+        self.assertRaises(ValueError, cb.__setslice__, 32, 34, 'ab')
+
+    def testAligned(self):
+        cb = cbuf.allocate_aligned(100)
+        self.assertEqual(len(cb), 100)
+        self.assertEqual(ctypes.sizeof(cb.buf), 100)
+        self.assertEqual(ctypes.addressof(cb.buf) % mmap.PAGESIZE, 0)
+
+        cb[0:4] = [0x12, 0x34, 0x56, 0x78]
+        cb[4] = 'a'
+        self.assertEqual(cb.getU32BE(0), 0x12345678)
+        self.assertEqual(cb[0:5], '\x12\x34\x56\x78a')
+        self.assertEqual(cb[4], 'a')
+        self.assertEqual(cb.getByteSlice(3, 5), [0x78, 0x61])
+        self.assertEqual(cb.view(1, 3).tobytes(), '\x34\x56')
+        self.assertRaises(ValueError, cb.__setitem__, 0, 0x100)
+
+
+class BufferPoolTests(unittest.TestCase):
+    def testReuse(self):
+        pool = cbuf.BufferPool()
+        with pool.buffer(64) as buf:
+            self.assertEqual(len(buf), 64)
+            first = buf
+        with pool.buffer(64) as buf:
+            self.assertTrue(buf is first)
+        with pool.buffer(32) as buf:
+            self.assertEqual(len(buf), 32)
+        self.assertEqual(pool.numAllocated, 2)
+        self.assertEqual(pool.numReused, 1)
+
+    def testNested(self):
+        pool = cbuf.BufferPool()
+        a = pool.get(16)
+        b = pool.get(16)
+        self.assertFalse(a is b)
+        pool.put(a)
+        pool.put(b)
+        self.assertEqual(pool.numAllocated, 2)
+        pool.get(16)
+        pool.get(16)
+        self.assertEqual(pool.numAllocated, 2)
+
+    def testMaxFree(self):
+        pool = cbuf.BufferPool(max_free=1)
+        bufs = [pool.get(16) for n in range(3)]
+        for buf in bufs:
+            pool.put(buf)
+        self.assertEqual(len(pool.free[16]), 1)
+
+    def testMaxFreeBytes(self):
+        pool = cbuf.BufferPool(max_free_bytes=64)
+        # Buffers of sizes that aren't asked for again get discarded,
+        # least recently returned first
+        for length in (16, 24, 32):
+            pool.put(pool.get(length))
+        self.assertEqual(pool.free.keys(), [24, 32])
+        self.assertEqual(pool.freeBytes, 56)
+
+        # The free list for a size goes away once it is empty
+        pool.get(24)
+        self.assertEqual(pool.free.keys(), [32])
+        self.assertEqual(pool.freeBytes, 32)
+
+        # Buffers larger than the limit are never kept
+        pool.put(pool.get(128))
+        self.assertEqual(pool.free.keys(), [32])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2011, Adam Simpkins
+#
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+lib_dir = os.path.normpath(os.path.join(sys.path[0], '..', 'src'))
+sys.path = [sys.path[0], lib_dir] + sys.path[1:]
+
+from amass import cdrom
+from amass import drives
+
+# A capabilities mode page reporting CD-DA, accurate stream and C2 support,
+# a 2MB buffer, and a maximum read speed of 24x
+CAPS_PAGE = (
+    '\x2a\x1c\x3f\x37\xf1\x77\x29\x23\x10\x89\x01\x00\x08\x00\x10\x89'
+    '\x00\x00\x10\x89\x10\x89\x00\x01\x00\x00\x00\x00\x10\x89')
+
+
+class CapabilitiesTests(unittest.TestCase):
+    def testParse(self):
+        caps = cdrom.binary.caps.parse_capabilities(CAPS_PAGE)
+        self.assertTrue(caps.cddaSupported)
+        self.assertTrue(caps.accurateStream)
+        self.assertTrue(caps.c2Pointers)
+        self.assertEqual(caps.maxReadSpeed, 0x1089)
+        self.assertEqual(caps.cacheSize, 0x800)
+
+
+class ProfileStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='amass-test-')
+        self.path = os.path.join(self.tmpdir, 'subdir', 'drives.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testSaveLoad(self):
+        store = drives.ProfileStore(self.path)
+        self.assertEqual(store.get('PLEXTOR', 'DVDR   PX-760A', '1.07'), None)
+
+        profile = drives.DriveProfile('PLEXTOR', 'DVDR   PX-760A', '1.07')
+        profile.readOffset = 30
+        profile.c2Pointers = True
+        profile.cacheSize = 2048
+        store.add(profile)
+        store.save()
+
+        store = drives.ProfileStore(self.path)
+        loaded = store.get('PLEXTOR', 'DVDR   PX-760A', '1.07')
+        self.assertEqual(loaded.toDict(), profile.toDict())
+        # A different firmware revision is a different drive
+        self.assertEqual(store.get('PLEXTOR', 'DVDR   PX-760A', '1.06'),
+                         None)
+
+    def testCacheSectors(self):
+        profile = drives.DriveProfile('A', 'B', 'C')
+        self.assertTrue(profile.hasCache())
+        self.assertEqual(profile.getCacheSectors(), None)
+        profile.cacheSize = 0
+        self.assertFalse(profile.hasCache())
+        profile.cacheSize = 2048
+        # 2MB, rounded up to a whole sector
+        self.assertEqual(profile.getCacheSectors(), 892)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2011, Adam Simpkins
+#
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+lib_dir = os.path.normpath(os.path.join(sys.path[0], '..', 'src'))
+sys.path = [sys.path[0], lib_dir] + sys.path[1:]
+
+from amass import file_util
+
+
+class CopyDataTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='amass-test-')
+        self.inPath = os.path.join(self.tmpdir, 'input')
+        self.outPath = os.path.join(self.tmpdir, 'output')
+        self.data = ''.join(chr(n % 251) for n in range(300000))
+        with open(self.inPath, 'wb') as f:
+            f.write(self.data)
+
+        self.saved = (file_util._copy_file_range, file_util._sendfile)
+
+    def tearDown(self):
+        (file_util._copy_file_range, file_util._sendfile) = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def checkCopy(self):
+        in_fd = os.open(self.inPath, os.O_RDONLY)
+        out_fd = os.open(self.outPath, os.O_WRONLY | os.O_CREAT, 0666)
+        try:
+            file_util.copy_data(in_fd, 1000, out_fd, 50, 200000)
+        finally:
+            os.close(in_fd)
+            os.close(out_fd)
+
+        with open(self.outPath, 'rb') as f:
+            self.assertEqual(f.read(), '\0' * 50 + self.data[1000:201000])
+
+    def testCopy(self):
+        self.checkCopy()
+
+    def testSendfile(self):
+        file_util._copy_file_range = None
+        self.checkCopy()
+
+    def testReadWrite(self):
+        file_util._copy_file_range = None
+        file_util._sendfile = None
+        self.checkCopy()
+
+    def testShortInput(self):
+        in_fd = os.open(self.inPath, os.O_RDONLY)
+        out_fd = os.open(self.outPath, os.O_WRONLY | os.O_CREAT, 0666)
+        try:
+            self.assertRaises(IOError, file_util.copy_data, in_fd, 0,
+                              out_fd, 0, len(self.data) + 10)
+        finally:
+            os.close(in_fd)
+            os.close(out_fd)
+
+    def testDataRanges(self):
+        # Make a file with a large hole in the middle.  Filesystems that
+        # don't support holes report it all as data, which is also fine.
+        hole_start = 1024 * 1024
+        hole_end = 8 * 1024 * 1024
+        with open(self.outPath, 'wb') as f:
+            f.write('a' * hole_start)
+            f.seek(hole_end)
+            f.write('b' * 4096)
+
+        fd = os.open(self.outPath, os.O_RDONLY)
+        try:
+            ranges = file_util.find_data_ranges(fd, 0, hole_end + 4096)
+        finally:
+            os.close(fd)
+
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], hole_end + 4096)
+        for (start, end) in ranges:
+            self.assertTrue(end <= hole_start or start >= hole_end or
+                            (start, end) == (0, hole_end + 4096))
+
+
+if __name__ == '__main__':
+    unittest.main()
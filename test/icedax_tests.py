@@ -58,6 +58,29 @@ class IcedaxTests(unittest.TestCase):
                                              62802, 71810, 82395])
         self.assertEqual(info.getNextTrackPreGap(), 92467)
 
+    def testFormat(self):
+        track = amass.cdrom._full_toc.TrackInfo(1, 1, 0,
+                                                amass.cdrom.Address(0))
+        track.endAddress = amass.cdrom.Address(92510)
+        sub_info = amass.cdrom.binary.SubchannelTrackInfo(track)
+        sub_info.indices = [0, 20440, 30450, 46147, 62802, 71810, 82395]
+        sub_info.nextPreGap = 92467
+
+        # Apart from the "created by" line, the output should be identical
+        # to what icedax writes.
+        data = amass.cdrom.icedax.format_info_string(
+                sub_info, None, 0x4f091c06, 'QJYSSgL6ukRaRI2NtuExvidlmFk-')
+        self.assertEqual(data.splitlines()[1:],
+                         INF_RUSH_2112_TRACK_1.splitlines()[1:])
+
+        sub_info.isrc = 'USMR18000123'
+        data = amass.cdrom.icedax.format_info_string(
+                sub_info, '0123456789012', 0x4f091c06,
+                'QJYSSgL6ukRaRI2NtuExvidlmFk-')
+        info = amass.cdrom.icedax.parse_info_string(data, 'audio_01.inf')
+        self.assertEqual(info.getISRC(), 'US-MR1-80-00123')
+        self.assertEqual(info.getMCN(), '0123456789012')
+
 
 if __name__ == '__main__':
     unittest.main()
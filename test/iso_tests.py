@@ -0,0 +1,81 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2011, Adam Simpkins
+#
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+lib_dir = os.path.normpath(os.path.join(sys.path[0], '..', 'src'))
+sys.path = [sys.path[0], lib_dir] + sys.path[1:]
+
+from amass import archive
+
+SECTOR_SIZE = 2048
+
+
+class IsoImageTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='amass-test-')
+
+        # A two session disc: track 1 at LBA 0, and track 2 at LBA 40
+        self.track1 = self.writeTrack('track01.bin', 'a', 30)
+        self.track2 = self.writeTrack('track02.bin', 'b', 20)
+        self.tracks = [(self.track1, 0), (self.track2, 40)]
+
+        # The expected image contents: the header comes from track 2
+        header = self.trackData('b', archive.NUM_HEADER_SECTORS)
+        self.expected = (header +
+                         self.trackData('a', 30)[len(header):] +
+                         '\0' * (10 * SECTOR_SIZE) +
+                         self.trackData('b', 20))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def trackData(self, char, num_sectors):
+        # Give each sector different contents, so misplaced data is noticed
+        return ''.join(char + chr(n) * (SECTOR_SIZE - 1)
+                       for n in range(num_sectors))
+
+    def writeTrack(self, name, char, num_sectors):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as f:
+            f.write(self.trackData(char, num_sectors))
+        return path
+
+    def testRead(self):
+        with archive.IsoImage(self.tracks) as image:
+            self.assertEqual(image.length, len(self.expected))
+            self.assertEqual(image.read(), self.expected)
+            self.assertEqual(image.read(), '')
+
+    def testSeek(self):
+        with archive.IsoImage(self.tracks) as image:
+            # Read across the end of the header, the gap, and track 2
+            for offset in (100, archive.HEADER_SIZE - 10,
+                           30 * SECTOR_SIZE - 5, 40 * SECTOR_SIZE - 1):
+                image.seek(offset)
+                self.assertEqual(image.read(50),
+                                 self.expected[offset:offset + 50])
+                self.assertEqual(image.tell(), offset + 50)
+
+            image.seek(-10, os.SEEK_END)
+            self.assertEqual(image.read(100), self.expected[-10:])
+            image.seek(-20, os.SEEK_CUR)
+            self.assertEqual(image.read(5), self.expected[-20:-15])
+
+    def testHeaderTrack(self):
+        with archive.IsoImage(self.tracks, self.track1) as image:
+            self.assertEqual(image.read(archive.HEADER_SIZE),
+                             self.trackData('a', archive.NUM_HEADER_SECTORS))
+
+    def testOverlap(self):
+        self.assertRaises(archive.ArchiveError, archive.IsoImage,
+                          [(self.track1, 0), (self.track2, 10)])
+
+
+if __name__ == '__main__':
+    unittest.main()
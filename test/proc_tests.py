@@ -4,6 +4,7 @@
 #
 import os
 import sys
+import time
 import unittest
 
 lib_dir = os.path.normpath(os.path.join(sys.path[0], '..', 'src'))
@@ -55,5 +56,145 @@ class RunCmdTests(unittest.TestCase):
         self.assertEqual(cmd_err, 'bar')
 
 
+def count_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+class ProcWaitTests(unittest.TestCase):
+    def setUp(self):
+        self.numFds = count_fds()
+
+    def tearDown(self):
+        proc._pidfd_supported = True
+        # The exit fd gets closed once the process has been reaped
+        self.assertEqual(count_fds(), self.numFds)
+
+    def testWaitTimeout(self):
+        p = proc.Proc(['/bin/sleep', '30'])
+        self.assertEqual(p.wait(timeout=0.1), None)
+        start = time.time()
+        self.assertEqual(p.kill(), -15)
+        self.assertTrue(time.time() - start < 1)
+
+    def testWaitExit(self):
+        p = proc.Proc(['/bin/sh', '-c', 'exit 4'])
+        self.assertEqual(p.wait(timeout=5), 4)
+        self.assertEqual(p.getExitFd(), None)
+
+    def testKillEscalation(self):
+        # The child ignores SIGTERM, so it has to be killed with SIGKILL
+        p = proc.Proc(['/bin/sh', '-c', 'trap "" TERM; echo; sleep 30'],
+                      stdout=proc.PIPE)
+        p.read(timeout=5)
+        p.closePipes()
+        self.assertEqual(p.kill(sigterm_timeout=0.2), -9)
+
+    def testNoPidfd(self):
+        proc._pidfd_supported = False
+        p = proc.Proc(['/bin/sleep', '30'])
+        self.assertEqual(p.getExitFd(), None)
+        self.assertEqual(p.wait(timeout=0.1), None)
+        self.assertEqual(p.kill(), -15)
+
+        runner = proc.MultiProcRunner()
+        entry = runner.add(['/bin/sh', '-c', 'exit 2'],
+                           proc.ProcOutputBuffer(), expected_rc=(2,))
+        runner.run()
+        self.assertEqual(entry.status, 2)
+
+
+class ChunkMonitor(proc.ProcOutputBuffer):
+    def __init__(self):
+        proc.ProcOutputBuffer.__init__(self)
+        self.chunkSizes = []
+        self.timeouts = 0
+
+    def stdoutData(self, data):
+        proc.ProcOutputBuffer.stdoutData(self, data)
+        self.chunkSizes.append(len(data))
+
+    def timeoutExpired(self):
+        self.timeouts += 1
+
+
+class MultiProcRunnerTests(unittest.TestCase):
+    def testOutput(self):
+        runner = proc.MultiProcRunner()
+        monitors = [proc.ProcOutputBuffer() for n in range(20)]
+        entries = []
+        for (n, monitor) in enumerate(monitors):
+            cmd = ['/bin/sh', '-c', 'echo out%d; echo err%d >&2' % (n, n)]
+            entries.append(runner.add(cmd, monitor))
+        runner.run()
+
+        for (n, monitor) in enumerate(monitors):
+            self.assertEqual(monitor.stdout, 'out%d\n' % (n,))
+            self.assertEqual(monitor.stderr, 'err%d\n' % (n,))
+        self.assertEqual([entry.status for entry in entries], [0] * 20)
+
+    def testLargeOutput(self):
+        runner = proc.MultiProcRunner()
+        monitor = ChunkMonitor()
+        runner.add(['/bin/sh', '-c', 'head -c 4000000 /dev/zero'], monitor)
+        runner.run()
+        self.assertEqual(len(monitor.stdout), 4000000)
+        # The read size grows when the process produces a lot of output
+        self.assertTrue(max(monitor.chunkSizes) > runner.MIN_READ_SIZE)
+
+    def testFailure(self):
+        runner = proc.MultiProcRunner()
+        good = proc.ProcOutputBuffer()
+        runner.add(['/bin/sh', '-c', 'exit 3'], proc.ProcOutputBuffer())
+        good_entry = runner.add(['/bin/sh', '-c', 'sleep 0.2; echo ok'], good)
+        try:
+            runner.run()
+            self.fail('expected a CmdStatusError')
+        except proc.CmdStatusError, ex:
+            self.assertEqual(ex.status, 3)
+        # The other process still ran to completion
+        self.assertEqual(good.stdout, 'ok\n')
+        self.assertEqual(good_entry.status, 0)
+
+    def testExpectedStatus(self):
+        runner = proc.MultiProcRunner()
+        entry = runner.add(['/bin/sh', '-c', 'exit 3'],
+                           proc.ProcOutputBuffer(), expected_rc=(3,))
+        runner.run()
+        self.assertEqual(entry.status, 3)
+
+    def testStopOnError(self):
+        runner = proc.MultiProcRunner()
+        runner.stopOnError = True
+        runner.add(['/bin/sh', '-c', 'exit 3'], proc.ProcOutputBuffer())
+        sleeper = runner.add(['/bin/sh', '-c', 'exec sleep 30'],
+                             proc.ProcOutputBuffer())
+        self.assertRaises(proc.CmdStatusError, runner.run)
+        self.assertEqual(sleeper.status, -15)
+
+    def testTimeout(self):
+        runner = proc.MultiProcRunner()
+        slow = ChunkMonitor()
+        fast = ChunkMonitor()
+        runner.add(['/bin/sh', '-c', 'sleep 0.5; echo done'], slow,
+                   timeout=0.1)
+        runner.add(['/bin/sh', '-c', 'sleep 0.5; echo done'], fast)
+        runner.run()
+        self.assertTrue(slow.timeouts >= 3)
+        self.assertEqual(fast.timeouts, 0)
+        self.assertEqual(slow.stdout, 'done\n')
+
+    def testClosedPipes(self):
+        # The processes close their output pipes well before they exit
+        runner = proc.MultiProcRunner()
+        entries = [runner.add(['/bin/sh', '-c',
+                               'exec >&- 2>&-; sleep 0.2; exit %d' % (n,)],
+                              proc.ProcOutputBuffer(), expected_rc=(n,))
+                   for n in range(5)]
+        num_fds = count_fds()
+        runner.run()
+        self.assertEqual([entry.status for entry in entries], range(5))
+        self.assertTrue(count_fds() < num_fds)
+
+
 if __name__ == '__main__':
     unittest.main()
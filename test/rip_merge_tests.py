@@ -0,0 +1,269 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2011, Adam Simpkins
+#
+import os
+import random
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+lib_dir = os.path.normpath(os.path.join(sys.path[0], '..', 'src'))
+sys.path = [sys.path[0], lib_dir] + sys.path[1:]
+
+from amass import rip_merge
+from amass import wav
+
+
+class VoteTests(unittest.TestCase):
+    def testVote(self):
+        (value, counts) = rip_merge.vote(['a', 'b', 'a'])
+        self.assertEqual(value, 'a')
+        self.assertEqual(counts, {'a': 2, 'b': 1})
+
+    def testTie(self):
+        (value, counts) = rip_merge.vote(['a', 'b'])
+        self.assertEqual(value, None)
+        self.assertEqual(counts, {'a': 1, 'b': 1})
+
+
+class MergerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='amass-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def writeInputs(self, contents):
+        paths = []
+        for n, data in enumerate(contents):
+            path = os.path.join(self.tmpdir, 'rip%d' % (n,))
+            with open(path, 'wb') as f:
+                f.write(data)
+            paths.append(path)
+        return paths
+
+    def makeMerger(self, contents):
+        output = StringIO.StringIO()
+        merger = rip_merge.Merger(self.writeInputs(contents), output)
+        # Use small windows, so the tests exercise the splitting code
+        merger.windowSize = 64
+        merger.blockSize = 16
+        return (merger, output)
+
+    def testMerge(self):
+        good = ''.join(chr(n % 256) * 4 for n in range(100))
+        bad1 = good[:8] + 'xxxx' + good[12:300] + 'yyyy' + good[304:]
+        bad2 = good[:200] + 'zzzz' + good[204:]
+        (merger, output) = self.makeMerger([bad1, good, bad2])
+
+        differences = []
+        merger.onDifference = \
+                lambda offset, counts, value: differences.append(offset)
+        merger.run()
+
+        self.assertEqual(output.getvalue(), good)
+        self.assertEqual(differences, [8, 200, 300])
+        self.assertEqual(merger.numDifferences, 3)
+
+    def testIdentical(self):
+        data = 'abcd' * 1000
+        (merger, output) = self.makeMerger([data, data])
+        merger.run()
+        self.assertEqual(output.getvalue(), data)
+        self.assertEqual(merger.numDifferences, 0)
+
+    def testTie(self):
+        (merger, output) = self.makeMerger(['a' * 64 + 'bbbb',
+                                            'a' * 64 + 'cccc'])
+        try:
+            merger.run()
+            self.fail('expected a TieError')
+        except rip_merge.TieError, ex:
+            self.assertEqual(ex.offset, 64)
+            self.assertEqual(ex.counts, {'bbbb': 1, 'cccc': 1})
+
+    def testLengthMismatch(self):
+        (merger, output) = self.makeMerger(['abcd' * 10, 'abcd' * 11])
+        merger.maxOffset = 0
+        self.assertRaises(rip_merge.MergeError, merger.run)
+
+    def makeAudio(self, num_samples):
+        rng = random.Random(1234)
+        return ''.join(chr(rng.randint(0, 255))
+                       for n in xrange(num_samples * 4))
+
+    def testOffset(self):
+        good = self.makeAudio(2000)
+        # One rip starts 3 samples late, and one starts 5 samples early
+        late = good[12:]
+        early = 'x' * 20 + good[:-20]
+        # Give each rip an error in a different place
+        late = late[:400] + 'zzzz' + late[404:]
+        early = early[:4000] + 'zzzz' + early[4004:]
+        (merger, output) = self.makeMerger([good, late, early])
+        merger.maxOffset = 64
+        merger.numProbes = 4
+
+        offsets = []
+        merger.onOffset = lambda path, position, offset: \
+                offsets.append((os.path.basename(path), position, offset))
+        merger.run()
+
+        self.assertEqual(offsets, [('rip1', 0, -12), ('rip2', 0, 20)])
+        self.assertEqual(output.getvalue(), good)
+        self.assertEqual(merger.numDifferences, 2)
+
+    def makeWav(self, data):
+        return wav.make_header(len(data)) + data
+
+    def testWavOffset(self):
+        good = self.makeAudio(2000)
+        # Both shifted rips start 6 samples late, so their headers agree
+        # with each other but not with the reference's header
+        late = good[24:]
+        (merger, output) = self.makeMerger([self.makeWav(good),
+                                            self.makeWav(late),
+                                            self.makeWav(late)])
+        merger.maxOffset = 64
+        merger.numProbes = 4
+        merger.index = rip_merge.DisagreementIndex(None)
+
+        offsets = []
+        merger.onOffset = lambda path, position, offset: \
+                offsets.append((os.path.basename(path), position, offset))
+        merger.run()
+
+        self.assertEqual(merger.dataStart, wav.HEADER_SIZE)
+        self.assertEqual(offsets, [('rip1', wav.HEADER_SIZE, -24),
+                                   ('rip2', wav.HEADER_SIZE, -24)])
+        self.assertEqual(output.getvalue(), self.makeWav(good))
+        self.assertEqual(merger.numDifferences, 0)
+        self.assertEqual(merger.index.ranges, [])
+
+    def testWavOffsetTwoInputs(self):
+        good = self.makeAudio(2000)
+        early = 'x' * 20 + good[:-20]
+        (merger, output) = self.makeMerger([self.makeWav(good),
+                                            self.makeWav(early)])
+        merger.maxOffset = 64
+        merger.numProbes = 4
+        merger.run()
+
+        # The headers aren't voted on, so they can't tie
+        self.assertEqual(output.getvalue(), self.makeWav(good))
+        self.assertEqual(merger.numDifferences, 0)
+
+    def testWavUpdate(self):
+        good = self.makeWav(self.makeAudio(500))
+        late = good[:wav.HEADER_SIZE] + good[wav.HEADER_SIZE + 8:]
+        paths = self.writeInputs([good, late, late])
+        # The index ranges also cover the header, which must be left alone
+        merged = 'h' * wav.HEADER_SIZE + good[wav.HEADER_SIZE:]
+        output = StringIO.StringIO(merged)
+        merger = rip_merge.Merger(paths, output)
+        merger.maxOffset = 64
+        merger.update([(0, wav.HEADER_SIZE + 4)])
+        self.assertEqual(output.getvalue(), merged)
+        self.assertEqual(merger.numDifferences, 0)
+
+    def testJitter(self):
+        good = self.makeAudio(2000)
+        # rip1 drops 2 samples partway through, and rip2 repeats a sample
+        dropped = good[:3000] + good[3008:]
+        repeated = good[:5000] + good[4996:5000] + good[5000:]
+        (merger, output) = self.makeMerger([good, dropped, repeated])
+        merger.maxOffset = 64
+        merger.maxJitter = 64
+        merger.numProbes = 4
+
+        offsets = []
+        merger.onOffset = lambda path, position, offset: \
+                offsets.append((os.path.basename(path), position, offset))
+        merger.run()
+
+        self.assertEqual(offsets, [('rip1', 0, 0), ('rip2', 0, 0),
+                                   ('rip1', 3008, -8), ('rip2', 5008, 4)])
+        self.assertEqual(output.getvalue(), good)
+
+    def testChunks(self):
+        good = self.makeAudio(2000)
+        bad1 = good[:100] + 'zzzz' + good[104:5000] + 'yyyy' + good[5004:]
+        bad2 = good[:3000] + 'xxxx' + good[3004:]
+        (merger, output) = self.makeMerger([bad1, good, bad2])
+        merger.chunkSize = 1024
+        merger.numJobs = 2
+        merger.index = rip_merge.DisagreementIndex(None)
+        merger.run()
+
+        self.assertEqual(output.getvalue(), good)
+        self.assertEqual([(r.offset, r.length, r.bestCount, r.totalVotes)
+                          for r in merger.index.ranges],
+                         [(100, 4, 2, 3), (3000, 4, 2, 3), (5000, 4, 2, 3)])
+
+    def testAllowTies(self):
+        (merger, output) = self.makeMerger(['a' * 64 + 'bbbb',
+                                            'a' * 64 + 'cccc'])
+        merger.allowTies = True
+        merger.index = rip_merge.DisagreementIndex(None)
+        merger.run()
+        self.assertEqual(output.getvalue(), 'a' * 64 + 'bbbb')
+        self.assertEqual(merger.index.getNumTies(), 1)
+
+    def testUpdate(self):
+        good = self.makeAudio(500)
+        bad1 = good[:100] + 'zzzz' + good[104:]
+        paths = self.writeInputs([bad1, good, good])
+        # Pretend an earlier merge got sample 100 wrong, and sample 200
+        # differed too.  Only the ranges given are re-merged.
+        merged = good[:100] + 'zzzz' + good[104:200] + 'yyyy' + good[204:]
+        output = StringIO.StringIO(merged)
+        merger = rip_merge.Merger(paths, output)
+        merger.update([(100, 104), (200, 204)])
+        self.assertEqual(output.getvalue(), good)
+        self.assertEqual(merger.numDifferences, 1)
+
+
+class DisagreementIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='amass-test-')
+        self.path = os.path.join(self.tmpdir, 'test.idx')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testSaveLoad(self):
+        index = rip_merge.DisagreementIndex(self.path)
+        self.assertFalse(index.load())
+        index.addSample(100, {'aaaa': 2, 'bbbb': 1}, 'aaaa')
+        index.addSample(104, {'aaaa': 2, 'cccc': 1}, 'aaaa')
+        index.addSample(200, {'aaaa': 1, 'bbbb': 1}, None)
+        index.save()
+
+        loaded = rip_merge.DisagreementIndex(self.path)
+        self.assertTrue(loaded.load())
+        self.assertEqual([(r.offset, r.length, r.bestCount, r.totalVotes,
+                           r.tie) for r in loaded.ranges],
+                         [(100, 8, 2, 3, False), (200, 4, 1, 2, True)])
+        self.assertEqual(loaded.getNumSamples(), 3)
+        self.assertEqual(loaded.getNumTies(), 1)
+
+    def testSectorRanges(self):
+        index = rip_merge.DisagreementIndex(self.path)
+        for offset in (10, 50, 96, 310):
+            index.addSample(offset, {'aaaa': 2, 'bbbb': 1}, 'aaaa')
+        # Sectors of 100 bytes, after a 10 byte header
+        self.assertEqual(index.getSectorRanges(100, 10),
+                         [(0, 1), (3, 4)])
+
+    def testBadFile(self):
+        with open(self.path, 'wb') as f:
+            f.write('not an index')
+        index = rip_merge.DisagreementIndex(self.path)
+        self.assertRaises(rip_merge.MergeError, index.load)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,308 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2011, Adam Simpkins
+#
+import ctypes
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+lib_dir = os.path.normpath(os.path.join(sys.path[0], '..', 'src'))
+sys.path = [sys.path[0], lib_dir] + sys.path[1:]
+
+from amass import cbuf
+from amass import cdrom
+from amass import rip
+from amass import scsi_sg
+
+NO_ERRORS = '\0' * cdrom.binary.C2_ERROR_SIZE
+
+
+def make_audio(first_sample):
+    return first_sample + 'a' * (cdrom.BYTES_PER_FRAME - len(first_sample))
+
+
+def first_sample_errors():
+    # Flag all 4 bytes of the first sample
+    return '\xf0' + NO_ERRORS[1:]
+
+
+class VoteTests(unittest.TestCase):
+    def testClean(self):
+        audio = make_audio('good')
+        self.assertEqual(rip.vote_samples([(audio, NO_ERRORS)], 2),
+                         (audio, True))
+
+    def testCorrected(self):
+        copies = [(make_audio('bad!'), first_sample_errors()),
+                  (make_audio('good'), NO_ERRORS),
+                  (make_audio('bad?'), first_sample_errors()),
+                  (make_audio('good'), NO_ERRORS)]
+        self.assertEqual(rip.vote_samples(copies, 2),
+                         (make_audio('good'), True))
+
+    def testNotEnoughVotes(self):
+        copies = [(make_audio('bad!'), first_sample_errors()),
+                  (make_audio('good'), NO_ERRORS)]
+        (audio, resolved) = rip.vote_samples(copies, 2)
+        self.assertFalse(resolved)
+
+    def testSampleErrors(self):
+        errors = '\x0f' + NO_ERRORS[1:]
+        self.assertFalse(rip.get_c2_sample_errors(errors, 0))
+        self.assertTrue(rip.get_c2_sample_errors(errors, 1))
+        self.assertFalse(rip.get_c2_sample_errors(errors, 2))
+
+
+class FakeDevice(object):
+    def __init__(self):
+        self.speeds = []
+
+    def set_speed(self, speed):
+        self.speeds.append(speed)
+
+
+class FakeOutput(object):
+    def log(self, message):
+        pass
+
+
+class QuietOutput(rip.CliOutput):
+    def redisplay(self):
+        pass
+
+    def log(self, message):
+        pass
+
+
+class SpeedControllerTests(unittest.TestCase):
+    def testSteps(self):
+        device = FakeDevice()
+        monitor = rip.Monitor(FakeOutput())
+        controller = rip.SpeedController(max_speed=24 * 176)
+        self.assertEqual(controller.speeds, [4 * 176, 8 * 176, 12 * 176,
+                                             16 * 176, cdrom.binary.MAX_SPEED])
+        window = controller.windowSectors
+
+        controller.start(device, monitor, 0)
+        self.assertEqual(device.speeds, [cdrom.binary.MAX_SPEED])
+
+        # An uncorrected error steps the speed down at the end of the window
+        monitor.errors.append(('skip', 100))
+        controller.update(device, window - 1)
+        self.assertEqual(len(device.speeds), 1)
+        controller.update(device, window)
+        self.assertEqual(device.speeds[-1], 16 * 176)
+
+        # Clean windows step it back up
+        for n in range(controller.stepUpWindows):
+            controller.update(device, window * (n + 2))
+        self.assertEqual(device.speeds[-1], cdrom.binary.MAX_SPEED)
+
+    def testDisabled(self):
+        device = FakeDevice()
+        monitor = rip.Monitor(FakeOutput())
+        controller = rip.SpeedController()
+        controller.enabled = False
+        controller.start(device, monitor, 0)
+        controller.update(device, controller.windowSectors * 10)
+        self.assertEqual(device.speeds, [])
+
+
+def make_check_condition(sense_key):
+    sense = cbuf.CBuffer(18)
+    sense[0] = scsi_sg.ERROR_CURRENT
+    sense[2] = sense_key
+    return scsi_sg.StdCheckConditionError(sense)
+
+
+class FakeDisc(object):
+    """
+    Replaces one of the cdrom.binary read functions with a fake that fills
+    each sector with its LBA's low byte.
+
+    Reads of sectors in errors raise a CHECK CONDITION with the specified
+    sense key.  Sectors in flaky fail the specified number of times before
+    they can be read.
+    """
+    def __init__(self, errors, flaky=None, name='read_cd',
+                 sector_size=cdrom.BYTES_PER_FRAME):
+        self.errors = errors
+        self.flaky = dict(flaky or {})
+        self.name = name
+        self.sectorSize = sector_size
+        # A list of the (lba, count) reads that succeeded
+        self.reads = []
+
+    def __enter__(self):
+        self.origRead = getattr(cdrom.binary, self.name)
+        setattr(cdrom.binary, self.name, self.read)
+        return self
+
+    def __exit__(self, ex_type, ex_value, ex_traceback):
+        setattr(cdrom.binary, self.name, self.origRead)
+
+    def read(self, device, lba, count, buf):
+        for n in range(lba, lba + count):
+            if n in self.errors:
+                raise make_check_condition(self.errors[n])
+            if self.flaky.get(n):
+                self.flaky[n] -= 1
+                raise make_check_condition(scsi_sg.SENSE_MEDIUM_ERROR)
+        for n in range(count):
+            ctypes.memset(ctypes.addressof(buf.buf) + n * self.sectorSize,
+                          (lba + n) & 0xff, self.sectorSize)
+        self.reads.append((lba, count))
+
+
+def sector_data(lba, sector_size=cdrom.BYTES_PER_FRAME):
+    return chr(lba & 0xff) * sector_size
+
+
+class OverreadTests(unittest.TestCase):
+    def readLastSector(self, errors, lead_out):
+        # A ripper for sectors 0-9, with a read offset of one sample.
+        # Reading the last sector needs the first sample of sector 10.
+        monitor = rip.Monitor(QuietOutput())
+        monitor.ripStart(0, 10)
+        ripper = rip.NativeRipper('/dev/null', 0, 10, None, monitor)
+        ripper.readOffset = 1
+        ripper.leadOutSector = lead_out
+        ripper.mappedIo = False
+        buf = cbuf.CBuffer(2 * cdrom.BYTES_PER_FRAME)
+        with FakeDisc(errors):
+            data = ripper.readSectors(None, 9, 1, buf)
+        return (ripper, monitor, data)
+
+    def testNextTrack(self):
+        (ripper, monitor, data) = self.readLastSector({}, 20)
+        self.assertEqual(data, sector_data(9)[4:] + sector_data(10)[:4])
+        self.assertFalse(ripper.hadSkip)
+
+    def testNextTrackError(self):
+        # An error reading the start of the next track must be reported
+        (ripper, monitor, data) = self.readLastSector(
+                {10: scsi_sg.SENSE_MEDIUM_ERROR}, 20)
+        self.assertEqual(data, sector_data(9)[4:] + '\0' * 4)
+        self.assertTrue(ripper.hadSkip)
+        self.assertEqual(monitor.errors,
+                         [('skip', 10 * cdrom.SAMPLES_PER_FRAME)])
+
+    def testLeadOut(self):
+        # The drive can't read the lead-out, so silence is used instead
+        (ripper, monitor, data) = self.readLastSector(
+                {10: scsi_sg.SENSE_ILLEGAL_REQUEST}, 10)
+        self.assertEqual(data, sector_data(9)[4:] + '\0' * 4)
+        self.assertFalse(ripper.hadSkip)
+        self.assertEqual(monitor.errors, [])
+
+        # Errors that aren't about the disc data are still raised
+        self.assertRaises(scsi_sg.StdCheckConditionError,
+                          self.readLastSector,
+                          {10: scsi_sg.SENSE_NOT_READY}, 10)
+
+
+class DataTrackReaderTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='amass-test-')
+        self.path = os.path.join(self.tmpdir, 'track.iso')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def readTrack(self, errors, flaky=None, start=100, end=120):
+        monitor = rip.Monitor(QuietOutput())
+        monitor.ripStart(start, end - 1)
+        reader = rip.DataTrackReader('/dev/null', start, end, self.path,
+                                     monitor)
+        reader.batchSectors = 8
+        reader.retries = 2
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+        try:
+            with FakeDisc(errors, flaky, name='read_data',
+                          sector_size=cdrom.BYTES_PER_DATA_SECTOR) as disc:
+                reader.readAll(None, fd)
+        finally:
+            os.close(fd)
+
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        skips = [offset / cdrom.SAMPLES_PER_FRAME
+                 for (function, offset) in monitor.errors
+                 if function == 'skip']
+        return (data, skips, disc)
+
+    def expectedData(self, start, end, bad):
+        data = []
+        for lba in range(start, end):
+            if lba in bad:
+                data.append('\0' * cdrom.BYTES_PER_DATA_SECTOR)
+            else:
+                data.append(sector_data(lba, cdrom.BYTES_PER_DATA_SECTOR))
+        return ''.join(data)
+
+    def testClean(self):
+        (data, skips, disc) = self.readTrack({})
+        self.assertEqual(data, self.expectedData(100, 120, ()))
+        self.assertEqual(skips, [])
+        self.assertEqual(disc.reads, [(100, 8), (108, 8), (116, 4)])
+
+    def testBadSectors(self):
+        bad = {105: scsi_sg.SENSE_MEDIUM_ERROR,
+               113: scsi_sg.SENSE_MEDIUM_ERROR,
+               119: scsi_sg.SENSE_MEDIUM_ERROR}
+        (data, skips, disc) = self.readTrack(bad)
+        # The bad sectors are zero-filled, and everything else stays at its
+        # correct offset in the file
+        self.assertEqual(data, self.expectedData(100, 120, bad))
+        self.assertEqual(skips, [105, 113, 119])
+
+        # Failed batches are split in half around the bad sectors
+        self.assertEqual(disc.reads, [(100, 4), (104, 1), (106, 2),
+                                      (108, 4), (112, 1), (114, 2),
+                                      (116, 2), (118, 1)])
+
+    def testRetry(self):
+        # Sector 103 fails in the batch read, the three split reads, and the
+        # first single-sector read.  The last retry succeeds.
+        (data, skips, disc) = self.readTrack({}, flaky={103: 5})
+        self.assertEqual(data, self.expectedData(100, 120, ()))
+        self.assertEqual(skips, [])
+        self.assertTrue((103, 1) in disc.reads)
+
+        # One more failure than that, and the sector is skipped
+        (data, skips, disc) = self.readTrack({}, flaky={103: 6})
+        self.assertEqual(data, self.expectedData(100, 120, (103,)))
+        self.assertEqual(skips, [103])
+
+    def testNotReadError(self):
+        # Errors that aren't about the disc data are raised, not skipped
+        self.assertRaises(scsi_sg.StdCheckConditionError, self.readTrack,
+                          {110: scsi_sg.SENSE_NOT_READY})
+
+
+class MultiCliDisplayTests(unittest.TestCase):
+    def getStatus(self, display):
+        return ' '.join(d.getStatusString() for d in display.drives)
+
+    def testWidth(self):
+        devices = ['/dev/sr%d' % (n,) for n in range(4)]
+        display = rip.MultiCliDisplay(devices, total_width=79)
+        self.assertEqual(len(self.getStatus(display)), 79)
+
+        # Progress output for a track takes up the same space
+        output = display.getDrive(2).newTrackOutput()
+        output.initialize(0, 1000)
+        self.assertEqual(len(self.getStatus(display)), 79)
+
+    def testTruncate(self):
+        # Fields that can't fit even a 1-column progress bar are truncated
+        devices = ['/dev/cdrom-long-name%d' % (n,) for n in range(4)]
+        display = rip.MultiCliDisplay(devices, total_width=79)
+        self.assertTrue(len(self.getStatus(display)) <= 79)
+
+
+if __name__ == '__main__':
+    unittest.main()
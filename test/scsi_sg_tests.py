@@ -0,0 +1,157 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2011, Adam Simpkins
+#
+import ctypes
+import fcntl
+import os
+import struct
+import sys
+import unittest
+
+lib_dir = os.path.normpath(os.path.join(sys.path[0], '..', 'src'))
+sys.path = [sys.path[0], lib_dir] + sys.path[1:]
+
+from amass import cbuf
+from amass import scsi_sg
+
+SECTOR_SIZE = 16
+
+
+class FakeQueue(scsi_sg.CommandQueue):
+    """
+    A CommandQueue that completes commands itself, instead of sending them to
+    a device.
+
+    Each command is a 4-byte sector number.  Its data is SECTOR_SIZE copies
+    of the sector number's low byte.  Sectors listed in badSectors fail with
+    a MEDIUM ERROR.
+    """
+    def __init__(self, depth):
+        scsi_sg.CommandQueue.__init__(self, -1, depth)
+        self.submitted = {}
+        self.badSectors = set()
+        self.maxOutstanding = 0
+
+    def setForcePackId(self):
+        pass
+
+    def sendHeader(self, sg_io_hdr):
+        hdr = scsi_sg.SgIoHdr.from_buffer_copy(sg_io_hdr)
+        self.submitted[hdr.pack_id] = hdr
+        self.maxOutstanding = max(self.maxOutstanding, len(self.submitted))
+
+    def receiveHeader(self, sg_io_hdr):
+        hdr = self.submitted.pop(sg_io_hdr.pack_id)
+        sector = cbuf.CBuffer(ctypes.string_at(hdr.cmdp, 4)).getU32BE(0)
+        if sector in self.badSectors:
+            sense = '\x70\x00\x03' + '\x00' * 15
+            ctypes.memmove(hdr.sbp, sense, len(sense))
+            hdr.sb_len_wr = len(sense)
+            hdr.status = scsi_sg.STATUS_CHECK_CONDITION
+        else:
+            ctypes.memset(hdr.dxferp, sector & 0xff, hdr.dxfer_len)
+            hdr.status = scsi_sg.STATUS_SUCCESS
+        ctypes.memmove(ctypes.addressof(sg_io_hdr), ctypes.addressof(hdr),
+                       ctypes.sizeof(hdr))
+
+
+def make_commands(sectors):
+    for sector in sectors:
+        cmd = cbuf.CBuffer(4)
+        cmd[0:4] = [(sector >> 24) & 0xff, (sector >> 16) & 0xff,
+                    (sector >> 8) & 0xff, sector & 0xff]
+        output = cbuf.CBuffer(SECTOR_SIZE)
+        yield (scsi_sg.SG_DXFER_FROM_DEV, cmd.buf, output.buf,
+               (sector, output))
+
+
+class CommandQueueTests(unittest.TestCase):
+    def testRun(self):
+        queue = FakeQueue(depth=3)
+        sectors = range(10)
+        results = []
+        for command in queue.run(make_commands(sectors)):
+            (sector, output) = command.context
+            self.assertEqual(command.error, None)
+            self.assertEqual(output[:], chr(sector) * SECTOR_SIZE)
+            results.append(sector)
+
+        self.assertEqual(results, sectors)
+        self.assertEqual(queue.maxOutstanding, 3)
+        self.assertEqual(len(queue), 0)
+
+    def testErrors(self):
+        queue = FakeQueue(depth=4)
+        queue.badSectors = set([2, 5])
+        failed = []
+        for command in queue.run(make_commands(range(8))):
+            if command.error is not None:
+                self.assertTrue(isinstance(command.error,
+                                           scsi_sg.StdCheckConditionError))
+                self.assertEqual(command.error.senseKey,
+                                 scsi_sg.SENSE_MEDIUM_ERROR)
+                self.assertRaises(scsi_sg.StdCheckConditionError,
+                                  command.check)
+                failed.append(command.context[0])
+        self.assertEqual(failed, [2, 5])
+
+    def testStopEarly(self):
+        queue = FakeQueue(depth=4)
+        commands = queue.run(make_commands(range(10)))
+        command = commands.next()
+        self.assertEqual(command.context[0], 0)
+        self.assertEqual(len(queue), 3)
+
+        # Closing the generator waits for the outstanding commands
+        commands.close()
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.submitted, {})
+
+    def testStats(self):
+        queue = FakeQueue(depth=2)
+        queue.badSectors = set([3])
+        stats = scsi_sg.enable_stats()
+        try:
+            for command in queue.run(make_commands(range(5))):
+                pass
+        finally:
+            scsi_sg.disable_stats()
+        self.assertEqual(scsi_sg.get_stats(), None)
+
+        # The first byte of each fake command is the opcode
+        op_stats = stats.opcodes[0]
+        self.assertEqual(op_stats.count, 5)
+        self.assertEqual(op_stats.bytes, 5 * SECTOR_SIZE)
+        self.assertEqual(op_stats.statuses,
+                         {scsi_sg.STATUS_SUCCESS: 4,
+                          scsi_sg.STATUS_CHECK_CONDITION: 1})
+        self.assertEqual(op_stats.senseKeys, {scsi_sg.SENSE_MEDIUM_ERROR: 1})
+
+    def testForcePackId(self):
+        # The ioctl argument must point to an int, rather than be the
+        # integer value itself.
+        calls = []
+        orig_ioctl = fcntl.ioctl
+        fcntl.ioctl = lambda fd, request, arg: calls.append((fd, request, arg))
+        try:
+            scsi_sg.CommandQueue(17)
+        finally:
+            fcntl.ioctl = orig_ioctl
+        self.assertEqual(calls, [(17, scsi_sg.SG_SET_FORCE_PACK_ID,
+                                  struct.pack('i', 1))])
+
+
+class SgIoTests(unittest.TestCase):
+    def testIoctlError(self):
+        # Errors from the SG_IO ioctl itself must not be ignored
+        with open('/dev/null', 'rb') as f:
+            try:
+                scsi_sg.call_sg_io(f.fileno(), scsi_sg.SgIoHdr())
+                self.fail('expected an OSError')
+            except OSError, ex:
+                self.assertNotEqual(ex.errno, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
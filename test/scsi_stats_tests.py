@@ -0,0 +1,92 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2011, Adam Simpkins
+#
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+lib_dir = os.path.normpath(os.path.join(sys.path[0], '..', 'src'))
+sys.path = [sys.path[0], lib_dir] + sys.path[1:]
+
+from amass import scsi_stats
+
+
+class HistogramTests(unittest.TestCase):
+    def testBuckets(self):
+        hist = scsi_stats.Histogram()
+        for value in (0, 1, 3, 4, 1000, 1000):
+            hist.add(value)
+        self.assertEqual(hist.count, 6)
+        self.assertEqual(hist.min, 0)
+        self.assertEqual(hist.max, 1000)
+        self.assertEqual(hist.buckets[0], 1)
+        self.assertEqual(hist.buckets[1], 1)
+        self.assertEqual(hist.buckets[2], 1)
+        self.assertEqual(hist.buckets[3], 1)
+        self.assertEqual(hist.buckets[10], 2)
+
+        self.assertEqual(hist.getPercentile(50), 4)
+        self.assertEqual(hist.getPercentile(99), 1000)
+
+    def testHuge(self):
+        hist = scsi_stats.Histogram()
+        hist.add(1 << 40)
+        self.assertEqual(hist.buckets[-1], 1)
+
+    def testRolling(self):
+        hist = scsi_stats.RollingHistogram(slice_seconds=10, num_slices=3)
+        hist.add(100, 1000)
+        hist.add(200, 1015)
+        hist.add(300, 1025)
+        self.assertEqual(hist.getRecent(1025).count, 3)
+        # After 30 seconds, the first slice is no longer recent
+        self.assertEqual(hist.getRecent(1030).count, 2)
+        self.assertEqual(hist.getRecent(1030).min, 200)
+        self.assertEqual(hist.total.count, 3)
+
+        # Old slices are discarded as new ones are added
+        hist.add(400, 1100)
+        self.assertEqual(len(hist.slices), 3)
+        self.assertEqual(hist.getRecent(1100).count, 1)
+
+
+class CommandStatsTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='amass-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testDump(self):
+        stats = scsi_stats.CommandStats()
+        stats.record(0xbe, 2352 * 32, 10, 0.012, 0)
+        stats.record(0xbe, 2352 * 32, 14, 0.015, 0)
+        stats.record(0xbe, 0, 200, 0.2, 2, sense_key=3)
+        stats.record(0x43, 100, 1, 0.001, 0)
+
+        path = os.path.join(self.tmpdir, 'stats.json')
+        stats.dump(path)
+        with open(path) as f:
+            data = json.load(f)
+
+        self.assertEqual([op['opcode'] for op in data['opcodes']],
+                         ['0x43', '0xbe'])
+        read_cd = data['opcodes'][1]
+        self.assertEqual(read_cd['count'], 3)
+        self.assertEqual(read_cd['bytes'], 2352 * 64)
+        self.assertEqual(read_cd['statuses'], {'0x00': 2, '0x02': 1})
+        self.assertEqual(read_cd['sense_keys'], {'0x3': 1})
+        self.assertEqual(read_cd['driver_latency']['total']['max_us'],
+                         200000)
+        self.assertEqual(read_cd['wall_latency']['recent']['count'], 3)
+
+        stats.reset()
+        self.assertEqual(stats.toJson()['opcodes'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
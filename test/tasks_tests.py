@@ -0,0 +1,135 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2011, Adam Simpkins
+#
+import os
+import sys
+import time
+import unittest
+
+lib_dir = os.path.normpath(os.path.join(sys.path[0], '..', 'src'))
+sys.path = [sys.path[0], lib_dir] + sys.path[1:]
+
+from amass import proc
+from amass import tasks
+
+
+def read_all(child):
+    lines = []
+    while True:
+        line = yield child.readLine()
+        if line is None:
+            break
+        lines.append(line)
+    raise tasks.Return(lines)
+
+
+class TaskTests(unittest.TestCase):
+    def testReadLines(self):
+        def task(scheduler):
+            child = scheduler.spawn(['/bin/sh', '-c',
+                                     'echo a; echo b >&2; echo c'])
+            lines = yield scheduler.start(read_all(child))
+            status = yield child.wait()
+            raise tasks.Return((lines, status))
+
+        (lines, status) = tasks.run(task)
+        self.assertEqual(status, 0)
+        self.assertEqual(sorted(lines), [('stderr', 'b'), ('stdout', 'a'),
+                                         ('stdout', 'c')])
+
+    def testStatusError(self):
+        def task(scheduler):
+            child = scheduler.spawn(['/bin/sh', '-c', 'exit 3'])
+            try:
+                yield child.wait()
+            except proc.CmdStatusError, ex:
+                raise tasks.Return(ex.status)
+
+        self.assertEqual(tasks.run(task), 3)
+
+    def testSemaphore(self):
+        state = {'running': 0, 'max': 0}
+
+        def worker(scheduler, sem, n):
+            yield sem.acquire()
+            try:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+                child = scheduler.spawn(['/bin/sh', '-c', 'sleep 0.05'])
+                yield child.wait()
+                state['running'] -= 1
+            finally:
+                sem.release()
+            raise tasks.Return(n * 2)
+
+        def main(scheduler):
+            sem = tasks.Semaphore(2)
+            workers = [scheduler.start(worker(scheduler, sem, n))
+                       for n in range(6)]
+            results = yield tasks.gather(workers)
+            raise tasks.Return(results)
+
+        self.assertEqual(tasks.run(main), [0, 2, 4, 6, 8, 10])
+        self.assertEqual(state['max'], 2)
+
+    def testCancelOnError(self):
+        cancelled = []
+
+        def sleeper(scheduler):
+            child = scheduler.spawn(['/bin/sleep', '30'])
+            try:
+                yield child.wait()
+            except tasks.TaskCancelledError:
+                cancelled.append(child)
+                raise
+
+        def failer(scheduler):
+            child = scheduler.spawn(['/bin/sh', '-c', 'exit 1'])
+            yield child.wait()
+
+        def main(scheduler):
+            yield tasks.gather([scheduler.start(sleeper),
+                                scheduler.start(failer)])
+
+        start = time.time()
+        self.assertRaises(proc.CmdStatusError, tasks.run, main)
+        self.assertTrue(time.time() - start < 5)
+        # The sleeper was cancelled, and its process killed
+        self.assertEqual(len(cancelled), 1)
+        self.assertEqual(cancelled[0].entry.status, -15)
+
+    def testCancel(self):
+        def sleeper(scheduler):
+            child = scheduler.spawn(['/bin/sleep', '30'])
+            yield child.wait()
+
+        def main(scheduler):
+            task = scheduler.start(sleeper)
+            child = scheduler.spawn(['/bin/sh', '-c', 'sleep 0.05'])
+            yield child.wait()
+            task.cancel()
+            try:
+                yield task
+            except tasks.TaskCancelledError:
+                raise tasks.Return(task.children[0].entry.status)
+
+        self.assertEqual(tasks.run(main), -15)
+
+    def testTimeout(self):
+        def task(scheduler):
+            child = scheduler.spawn(['/bin/sh', '-c', 'sleep 30'],
+                                    timeout=0.05)
+            yield child.readLine()
+
+        self.assertRaises(proc.TimeoutError, tasks.run, task)
+
+    def testDeadlock(self):
+        def task(scheduler):
+            yield tasks.Future()
+
+        self.assertRaises(tasks.TaskDeadlockError, tasks.run, task)
+
+
+if __name__ == '__main__':
+    unittest.main()
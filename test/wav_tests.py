@@ -0,0 +1,58 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2011, Adam Simpkins
+#
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+lib_dir = os.path.normpath(os.path.join(sys.path[0], '..', 'src'))
+sys.path = [sys.path[0], lib_dir] + sys.path[1:]
+
+from amass import wav
+
+
+class WavWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='amass-test-')
+        self.path = os.path.join(self.tmpdir, 'test.wav')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def readFile(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def testWrite(self):
+        with wav.WavWriter(self.path) as writer:
+            writer.write('a' * 100)
+            writer.write('b' * 50)
+        self.assertEqual(self.readFile(),
+                         wav.make_header(150) + 'a' * 100 + 'b' * 50)
+
+    def testResume(self):
+        # Simulate a writer that was interrupted before it could write the
+        # header
+        writer = wav.WavWriter(self.path)
+        writer.write('a' * 100)
+        writer.write('x' * 30)
+        writer.file.close()
+
+        # Keep only the first 100 bytes, and append to them
+        with wav.WavWriter(self.path, resume_length=100) as writer:
+            writer.write('b' * 50)
+        self.assertEqual(self.readFile(),
+                         wav.make_header(150) + 'a' * 100 + 'b' * 50)
+
+    def testResumeTooShort(self):
+        with wav.WavWriter(self.path) as writer:
+            writer.write('a' * 100)
+        self.assertRaises(IOError, wav.WavWriter, self.path,
+                          resume_length=200)
+
+
+if __name__ == '__main__':
+    unittest.main()
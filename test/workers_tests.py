@@ -0,0 +1,77 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2011, Adam Simpkins
+#
+import os
+import sys
+import threading
+import unittest
+
+lib_dir = os.path.normpath(os.path.join(sys.path[0], '..', 'src'))
+sys.path = [sys.path[0], lib_dir] + sys.path[1:]
+
+from amass import workers
+
+
+class WorkerPoolTests(unittest.TestCase):
+    def testResults(self):
+        with workers.WorkerPool(4) as pool:
+            jobs = [pool.submit(lambda x: x * 2, n) for n in range(20)]
+            results = [job.wait() for job in jobs]
+        self.assertEqual(results, [n * 2 for n in range(20)])
+
+    def testException(self):
+        def fail(n):
+            raise KeyError(n)
+
+        with workers.WorkerPool(2) as pool:
+            ok_job = pool.submit(lambda: 'ok')
+            bad_job = pool.submit(fail, 17)
+            self.assertRaises(KeyError, bad_job.wait)
+            self.assertTrue(bad_job.failed())
+            self.assertEqual(ok_job.wait(), 'ok')
+            self.assertFalse(ok_job.failed())
+
+    def testParallel(self):
+        # Make sure that jobs really do run concurrently:
+        # each job blocks until all of them have started.
+        num_jobs = 3
+        barrier_lock = threading.Lock()
+        all_started = threading.Event()
+        started = [0]
+
+        def job_fn():
+            with barrier_lock:
+                started[0] += 1
+                if started[0] == num_jobs:
+                    all_started.set()
+            all_started.wait(5)
+            return all_started.is_set()
+
+        with workers.WorkerPool(num_jobs) as pool:
+            jobs = [pool.submit(job_fn) for n in range(num_jobs)]
+            results = [job.wait() for job in jobs]
+        self.assertEqual(results, [True] * num_jobs)
+
+    def testWaitTimeout(self):
+        release = threading.Event()
+
+        def job_fn():
+            release.wait(5)
+            return 'done'
+
+        with workers.WorkerPool(1) as pool:
+            job = pool.submit(job_fn)
+            self.assertEqual(job.wait(0.01), None)
+            self.assertFalse(job.done())
+            release.set()
+            self.assertEqual(job.wait(), 'done')
+
+    def testClosed(self):
+        pool = workers.WorkerPool(1)
+        pool.close()
+        self.assertRaises(ValueError, pool.submit, lambda: None)
+
+
+if __name__ == '__main__':
+    unittest.main()